@@ -21,6 +21,7 @@ sys.path.append(os.path.dirname(os.getcwd()))
 import async_netconf.base as base
 import async_netconf.server as server
 import async_netconf.util as util
+import netconf.error as error
 from async_netconf import nsmap_add, NSMAP, MAXSSHBUF
 
 
@@ -35,8 +36,18 @@ nsmap_add("tailf", "http://tail-f.com/yang/common")
 nsmap_add("ncwr", "urn:ietf:params:netconf:capability:writable-running:1.0")
 
 class SystemServer(object):
-    def __init__(self, port, host_key, debug=False):
-        self.server = server.NetconfSSHServer(passwords, self, port, host_key, debug)
+    def __init__(self, port, host_key, config_data, debug=False, session_ids=None, options=None):
+        self.server = server.NetconfSSHServer(passwords,
+                                              self,
+                                              port,
+                                              host_key,
+                                              debug,
+                                              session_ids=session_ids,
+                                              options=options)
+        # The serialized get-config data, which never changes.
+        self.config_data = config_data
+        self.server.dispatcher.add_validator("sys:system-restart", self._no_params)
+        self.server.dispatcher.add_validator("sys:system-shutdown", self._no_params)
 
     async def listen(self):
         await self.server.listen()
@@ -103,16 +114,18 @@ class SystemServer(object):
 
     def rpc_get_config(self, session, rpc, source_elm, filter_or_none):  # pylint: disable=W0613
         """Passed the source element"""
-        data = util.elm("nc:data")
-        router = etree.parse('router.xml')
-        data.append(router.getroot())
-        return data
+        return self.config_data
         #TODO: Fix filtering
         return util.filter_results(rpc, data, filter_or_none)
 
     def rpc_edit_config(self, session, rpc, source_elm, filter_or_none):  # pylint: disable=W0613
         return etree.Element("ok")
 
+    def _no_params(self, session, rpc, rpc_method):  # pylint: disable=W0613
+        if len(rpc_method):
+            raise error.UnknownElementProtoError(rpc, rpc_method[0])
+        return []
+
     def rpc_system_restart(self, session, rpc, *params):
         raise error.AccessDeniedAppError(rpc)
 
@@ -120,15 +133,23 @@ class SystemServer(object):
         raise error.AccessDeniedAppError(rpc)
 
 
+def get_config_data():
+    """Get the serialized get-config data with router.xml."""
+    data = util.elm("nc:data")
+    data.append(etree.parse('router.xml').getroot())
+    return etree.tostring(data)
+
+
 async def start_servers(n, start_port) -> None:
     logging.basicConfig(level=logging.DEBUG)
-    servers = []
     start = time.monotonic()
 
-    for port in range(0, n):
-        server = SystemServer(start_port+port, 'ssh_host_key', debug=True)
-        servers.append(server)
-        await server.listen()
+    # Read the host key once for all servers.
+    options = server.server_options('ssh_host_key')
+    config_data = get_config_data()
+    servers = [SystemServer(start_port+port, 'ssh_host_key', config_data, debug=True, options=options)
+               for port in range(0, n)]
+    await asyncio.gather(*[s.listen() for s in servers])
 
     elapsed = time.monotonic()-start
     print("Servers started!")
@@ -140,8 +161,8 @@ async def start_servers(n, start_port) -> None:
             await asyncio.sleep(60)
     except KeyboardInterrupt:
         print("Closing!")
-        for server in servers:
-            server.close()
+        for s in servers:
+            s.close()
 
 def main_servers(n, start_port):
     try:
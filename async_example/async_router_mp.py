@@ -5,24 +5,31 @@
 # 10 separate processes with 1000 each.
 
 
-from multiprocessing import Process
 import async_router
+import async_netconf.server as server
+
+
+# Shared by all servers in a worker.
+CONFIG_DATA = async_router.get_config_data()
+
+
+def make_server(port, session_ids):
+    return async_router.SystemServer(port, 'ssh_host_key', CONFIG_DATA, session_ids=session_ids)
 
 
 def main():
     total = 10000
     parallel = 10
     start_port = 30000
-    perproc = total//parallel
-
-    processes = []
-    for i in range(0, parallel):
-        process = Process(target=async_router.main_servers, args=(perproc, start_port))
-        process.start()
-        processes.append(process)
-        start_port += perproc
 
-    [ p.join() for p in processes ]
+    mp_server = server.NetconfMultiProcessServer(make_server,
+                                                 range(start_port, start_port + total),
+                                                 workers=parallel)
+    print(f"Listening on {total} ports: {start_port}-{start_port+total-1}")
+    try:
+        mp_server.serve_forever()
+    except KeyboardInterrupt:
+        print("Closing!")
 
 if __name__ == '__main__':
     main()
@@ -22,10 +22,11 @@ if cdir != '.':
 sys.path.append(os.path.dirname(os.getcwd()))
 
 import async_netconf.base as base
+from async_netconf.datastore import Datastore, DatastoreCache, ReplyCache
 import async_netconf.server as server
 import async_netconf.util as util
 from async_netconf import nsmap_add, NSMAP, MAXSSHBUF
-from netconf_merge import merge_tree, MergeError
+from netconf_merge import compile_schema, merge_tree, MergeError
 
 
 passwords = {'guest': 'guest',          # guest account with no password
@@ -36,11 +37,18 @@ nsmap_add("r", "http://example.com/router")
 nsmap_add("ncwr", "urn:ietf:params:netconf:capability:writable-running:1.0")
 
 class SystemServer(object):
-    def __init__(self, port, host_key, schema, debug=False):
-        self.server = server.NetconfSSHServer(passwords, self, port, host_key, debug)
+    def __init__(self, port, host_key, schema, baseline, debug=False, options=None, cache=None,
+                 replies=None):
+        self.server = server.NetconfSSHServer(passwords, self, port, host_key, debug, options=options)
         self.schema = schema
-        router = etree.parse('router.xml')
-        self.cdb = router.getroot()
+        # All servers share the baseline and only keep their own edits. The
+        # cache keeps the trees of the most recently used servers.
+        self.cdb = Datastore(baseline, self._merge, cache=cache, fingerprints=True)
+        # Serialized get-config replies by datastore fingerprint and filter.
+        self.replies = replies if replies is not None else ReplyCache(fingerprints=True)
+
+    def _merge(self, lnode, rnode, fingerprints=None):
+        merge_tree(lnode, rnode, self.schema, move=True, fingerprints=fingerprints)
 
     async def listen(self):
         await self.server.listen()
@@ -58,13 +66,16 @@ class SystemServer(object):
     def rpc_get(self, session, rpc, filter_or_none):  # pylint: disable=W0613
         """Passed the filter element or None if not present"""
         data = util.elm("nc:data")
-        data.append(self.cdb)
+        data.append(self.cdb.get(filter_or_none))
         return util.filter_results(rpc, data, filter_or_none, self.server.debug)
 
     def rpc_get_config(self, session, rpc, source_elm, filter_or_none):  # pylint: disable=W0613
         """Passed the source element"""
+        return self.replies.get(self.cdb, filter_or_none, lambda: self._get_config(filter_or_none))
+
+    def _get_config(self, filter_or_none):
         data = util.elm("nc:data")
-        data.append(self.cdb)
+        data.append(self.cdb.get(filter_or_none))
         return data
         #TODO: Fix filtering
         #return util.filter_results(rpc, data, filter_or_none)
@@ -74,21 +85,26 @@ class SystemServer(object):
         ec = rpc.find('edit-config', rpc.nsmap)
         config = ec.find('config', rpc.nsmap)
         sys = config.find('{http://example.com/router}sys')
-        merge_tree(self.cdb, sys, self.schema)
+        self.cdb.edit(sys)
+        # Replies of unchanged content stay valid by their fingerprint.
+        if not self.replies.fingerprints:
+            self.replies.invalidate(self.cdb)
         return etree.Element("ok")
 
 
 async def start_servers(n, start_port, schema_file) -> None:
-    schema_file = json.loads(open(schema_file).read())
-    tree = schema_file['tree']
-    schema = tree['router:sys'][1] # container sub elems
-    servers = []
+    baseline = etree.parse('router.xml').getroot()
+    schema = compile_schema(json.loads(open(schema_file).read())).child(baseline.tag)
     start = time.monotonic()
 
-    for port in range(0, n):
-        server = SystemServer(start_port+port, 'ssh_host_key', schema)
-        servers.append(server)
-        await server.listen()
+    # Read the host key once for all servers.
+    options = server.server_options('ssh_host_key')
+    cache = DatastoreCache(max_trees=1000)
+    replies = ReplyCache(fingerprints=True)
+    servers = [SystemServer(start_port+port, 'ssh_host_key', schema, baseline, options=options, cache=cache,
+                            replies=replies)
+               for port in range(0, n)]
+    await asyncio.gather(*[s.listen() for s in servers])
 
     elapsed = time.monotonic()-start
     print("Servers started!")
@@ -100,8 +116,8 @@ async def start_servers(n, start_port, schema_file) -> None:
             await asyncio.sleep(60)
     except KeyboardInterrupt:
         print("Closing!")
-        for server in servers:
-            server.close()
+        for s in servers:
+            s.close()
 
 def main_servers(n, start_port):
     try:
@@ -19,11 +19,11 @@
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
 
 import argparse
+import asyncio
 import logging
 import os
 import sys
 from lxml import etree
-from sshutil.server import from_private_key_file
 from . import client
 from . import nsmap_add
 
@@ -111,8 +111,11 @@ def main(*margs):
     else:
         args.password = parse_password_arg(args.password)
 
+    ssh_options = {}
     if args.keyfile:
-        args.password = from_private_key_file(args.keyfile, password=args.password)
+        ssh_options["client_keys"] = [args.keyfile]
+        ssh_options["passphrase"] = args.password
+        args.password = None
 
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -127,58 +130,7 @@ def main(*margs):
         prefix, namespace = ns.split("=", 1)
         nsmap_add(prefix, namespace)
 
-    session = client.NetconfSSHSession(args.host,
-                                       args.port,
-                                       args.username,
-                                       args.password,
-                                       debug=args.debug)
-
-    if args.hello:
-        result = "\n".join(session.capabilities) + "\n"
-    elif args.get is not None or args.get_config is not None:
-        if args.get:
-            select = args.get
-        elif args.get_config:
-            select = args.get_config
-        elif args.infile:
-            if args.infile == "-":
-                select = sys.stdin.read()
-            else:
-                select = open(args.infile).read()
-        else:
-            select = None
-
-        if args.get is not None:
-            result = session.get(select, args.timeout)
-        else:
-            assert args.get_config is not None
-            result = session.get_config(args.source, select, args.timeout)
-        result = "  " + etree.tounicode(result, pretty_print=True)
-    else:
-        if args.infile:
-            xml = open(args.infile).read()
-        else:
-            xml = sys.stdin.read()
-        if not xml:
-            print("Nothing to do.", file=sys.stderr)
-            sys.exit(1)
-
-        if args.edit_config is None:
-            result = session.send_rpc(xml)[2]
-        else:
-            testopt = ""
-            if args.edit_set_only:
-                testopt = "set"
-            if args.edit_test_only:
-                testopt = "test-only"
-            erroropt = ""
-            if args.edit_continue_on_error:
-                erroropt = "continue-on-error"
-            if args.edit_rollback_on_error:
-                erroropt = "rollback-on-error"
-            result = session.edit_config(args.source, args.edit_config, xml, testopt, erroropt,
-                                         args.timeout)
-        result = etree.tounicode(result, pretty_print=True)
+    result = asyncio.run(run_command(args, ssh_options))
 
     if args.outfile and args.outfile != "-":
         with open(args.outfile, "w") as f:
@@ -186,7 +138,61 @@ def main(*margs):
     else:
         sys.stdout.write(result)
 
-    session.close()
+
+async def run_command(args, ssh_options):
+    async with client.connect_ssh(args.host,
+                                  args.port,
+                                  args.username,
+                                  args.password,
+                                  debug=args.debug,
+                                  **ssh_options) as session:
+        if args.hello:
+            result = "\n".join(session.capabilities) + "\n"
+        elif args.get is not None or args.get_config is not None:
+            if args.get:
+                select = args.get
+            elif args.get_config:
+                select = args.get_config
+            elif args.infile:
+                if args.infile == "-":
+                    select = sys.stdin.read()
+                else:
+                    select = open(args.infile).read()
+            else:
+                select = None
+
+            if args.get is not None:
+                result = await session.get(select, args.timeout)
+            else:
+                assert args.get_config is not None
+                result = await session.get_config(args.source, select, args.timeout)
+            result = "  " + etree.tounicode(result, pretty_print=True)
+        else:
+            if args.infile:
+                xml = open(args.infile).read()
+            else:
+                xml = sys.stdin.read()
+            if not xml:
+                print("Nothing to do.", file=sys.stderr)
+                sys.exit(1)
+
+            if args.edit_config is None:
+                result = (await session.send_rpc(xml))[1]
+            else:
+                testopt = ""
+                if args.edit_set_only:
+                    testopt = "set"
+                if args.edit_test_only:
+                    testopt = "test-only"
+                erroropt = ""
+                if args.edit_continue_on_error:
+                    erroropt = "continue-on-error"
+                if args.edit_rollback_on_error:
+                    erroropt = "rollback-on-error"
+                result = await session.edit_config(args.source, args.edit_config, xml, testopt,
+                                                   erroropt, args.timeout)
+            result = etree.tounicode(result, pretty_print=True)
+        return result
 
 
 if __name__ == "__main__":
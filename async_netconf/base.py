@@ -27,7 +27,7 @@ import traceback
 import asyncssh
 from lxml import etree
 
-from async_netconf import NSMAP, MAXSSHBUF
+from async_netconf import NSMAP, MAXSSHBUF, compile_xpath
 from netconf.error import ChannelClosed, FramingError, SessionError
 import async_netconf.util as ncutil
 
@@ -108,6 +108,109 @@ def chunkit(msg, maxsend, minsend=0, pad=b"\n"):
     yield msg[right:]
 
 
+class MessageFormat(object):
+    """How a session serializes the messages it sends.
+
+    A server shares one of these among all its sessions.
+
+    :param pretty_print: True to indent the sent XML. This is easier for humans
+                         to read but larger and slower to produce.
+    :param xml_declaration: True to start each message with the XML declaration.
+    :param cache_hello: True to encode the server hello once and reuse it for all
+                        sessions. Only use this if the capabilities added by
+                        ``nc_append_capabilities`` do not change.
+    """
+
+    def __init__(self, pretty_print=False, xml_declaration=True, cache_hello=False):
+        self.pretty_print = pretty_print
+        self.xml_declaration = xml_declaration
+        self.cache_hello = cache_hello
+        self.hello = None
+
+    def tostring(self, elm):
+        """Serialize an element.
+
+        :param elm: The element to serialize.
+        :return: The serialized element.
+        :rtype: bytes
+        """
+        return etree.tostring(elm, pretty_print=self.pretty_print)
+
+
+class NetconfStreamParser(object):
+    """Incrementally parse the XML of a framed message as its data arrives.
+
+    `feed` is called with message data (never framing) and `close` at the
+    end of the message. Syntax errors are held until `close` so the rest of
+    the message can still be consumed from the transport.
+    """
+    def __init__(self):
+        # No events, otherwise every parsed tree is queued until read.
+        self.parser = etree.XMLPullParser(events=())
+        self.started = False
+        self.error = None
+
+    def feed(self, data):
+        if self.error is not None:
+            return
+        if not self.started:
+            # Allow leading whitespace before the XML declaration.
+            data = data.lstrip()
+            if not data:
+                return
+            self.started = True
+        try:
+            self.parser.feed(data)
+        except etree.XMLSyntaxError as error:
+            self.error = error
+
+    def close(self):
+        """Finish the message.
+
+        :return: The parsed message (`lxml.etree.ElementTree`) or the
+                 `lxml.etree.XMLSyntaxError` found while parsing it.
+        """
+        error = self.error
+        self.started = False
+        self.error = None
+        try:
+            root = self.parser.close()
+        except etree.XMLSyntaxError as close_error:
+            return error or close_error
+        if error is not None:
+            return error
+        return root.getroottree()
+
+
+class NetconfStreamWriter(object):
+    """A file-like object sending what is written to it as the chunks of a
+    single PDU. Small writes are gathered into chunks of about max_chunk.
+    Use with `lxml.etree.xmlfile` to serialize a message incrementally.
+    """
+    def __init__(self, pkt_stream, new_framing):
+        self.pkt_stream = pkt_stream
+        self.new_framing = new_framing
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if self.pkt_stream.stream is None:
+            raise ChannelClosed(self.pkt_stream)
+        self.buffer += data
+        if len(self.buffer) >= self.pkt_stream.max_chunk:
+            self.flush()
+
+    def flush(self):
+        if self.buffer and self.pkt_stream.stream is not None:
+            self.pkt_stream.send_chunk(self.buffer, self.new_framing)
+        self.buffer = bytearray()
+
+    def close(self):
+        """Send anything buffered and end the PDU."""
+        self.flush()
+        if self.pkt_stream.stream is not None:
+            self.pkt_stream.end_pdu(self.new_framing)
+
+
 class NetconfTransportMixin(object):
     def connect(self):
         raise NotImplementedError()
@@ -132,10 +235,19 @@ class NetconfFramingTransport(NetconfPacketTransport):
         self.stream = stream
         self.max_chunk = max_chunk
         self.debug = debug
+        # Received data is parsed in place: rpos is the offset of the first
+        # unparsed byte and chunks holds the (start, end) offsets of the chunks
+        # of the current message. The buffer is only compacted once a message
+        # is complete.
         self.rbuffer = bytearray()
+        self.rpos = 0
         self.searchfrom = 0
         self.chunklen = -1
         self.chunks = []
+        # If set (e.g., to a `NetconfStreamParser`) message data is fed to it
+        # as it arrives instead of being buffered, and the result of its
+        # close() is returned in place of the message bytes.
+        self.feeder = None
 
     def __del__(self):
         self.close()
@@ -149,15 +261,25 @@ class NetconfFramingTransport(NetconfPacketTransport):
             stream.close()
 
     def is_active(self):
+        stream = self.stream
+        if stream is None:
+            return False
+        try:
+            # asyncssh channels
+            is_closing = stream.is_closing
+        except AttributeError:
+            pass
+        else:
+            return not is_closing()
         try:
-            self.stream.is_active
+            stream.is_active
         except AttributeError:
-            transport = self.stream.get_transport()
+            transport = stream.get_transport()
             if not transport:
                 return False
             return transport.is_active()
         else:
-            return self.stream.is_active()
+            return stream.is_active()
 
     def add_to_buffer(self, data, new_framing):
         if new_framing:
@@ -174,37 +296,108 @@ class NetconfFramingTransport(NetconfPacketTransport):
             return await self._receive_10()
 
     def send_pdu(self, msg, new_framing):
+        """Frame and send a PDU.
+
+        :param msg: The message, either a bytes-like object or a sequence of
+                    them which are sent back to back as one message.
+        :param new_framing: True for chunked (1.1) framing.
+        """
         assert self.stream is not None
+        if isinstance(msg, (bytes, bytearray, memoryview)):
+            msg = (msg,)
         if new_framing:
-            bmsg = msg
-            blen = len(bmsg)
-            msg = bytearray()
-            msg += f"\n#{blen}\n".encode('utf-8')
-            msg += bmsg
-            msg += b"\n##\n"
+            blen = sum(len(part) for part in msg)
+            header = f"\n#{blen}\n".encode('utf-8')
+            trailer = b"\n##\n"
         else:
-            msg += b"]]>]]>"
-        #TODO: Async - Use MemoryView for no copy
-        # Apparently ssh has a bug that requires minimum of 64 bytes?
+            header = None
+            trailer = b"]]>]]>"
+
         try:
-            for chunk in chunkit(msg, self.max_chunk, 64):
-                self.stream.write(chunk)
+            if header:
+                self.stream.write(header)
+            for part in msg:
+                self._write_view(part)
+            self.stream.write(trailer)
         except BrokenPipeError as e:
             #TODO: How to handle broken connection properly?
             pass
 
+    def send_chunk(self, data, new_framing):
+        """Send part of a PDU whose total length isn't known yet. With chunked
+        framing `data` is sent as one chunk. Finish the PDU with `end_pdu`.
+        """
+        assert self.stream is not None
+        if not data:
+            return
+        try:
+            if new_framing:
+                self.stream.write(f"\n#{len(data)}\n".encode('utf-8'))
+            self._write_view(data)
+        except BrokenPipeError:
+            pass
+
+    def end_pdu(self, new_framing):
+        """Finish a PDU sent with `send_chunk`."""
+        assert self.stream is not None
+        try:
+            self.stream.write(b"\n##\n" if new_framing else b"]]>]]>")
+        except BrokenPipeError:
+            pass
+
+    def _write_view(self, data):
+        # The channel copies what it is given into its send buffer, so write
+        # memoryview slices of at most max_chunk instead of first building a
+        # framed copy of the message and slicing that again.
+        write = self.stream.write
+        max_chunk = self.max_chunk
+        view = memoryview(data)
+        for offset in range(0, len(view), max_chunk):
+            write(view[offset:offset + max_chunk])
+
+    def _span(self, start, end):
+        """Return a copy of rbuffer[start:end] as bytes (copied only once)."""
+        with memoryview(self.rbuffer) as view:
+            return bytes(view[start:end])
+
+    def _take_message(self, end, resume):
+        """Return the message made of the buffer spans in self.chunks (or
+        rpos to end if there are none) and drop everything before resume.
+        """
+        if self.feeder is not None:
+            if end > self.rpos:
+                self.feeder.feed(self._span(self.rpos, end))
+            del self.rbuffer[:resume]
+            self.rpos = 0
+            self.searchfrom = 0
+            return self.feeder.close()
+
+        with memoryview(self.rbuffer) as view:
+            if self.chunks:
+                spans = [view[start:stop] for start, stop in self.chunks]
+                msg = b"".join(spans)
+                del spans
+            else:
+                msg = bytes(view[self.rpos:end])
+        del self.rbuffer[:resume]
+        self.rpos = 0
+        self.searchfrom = 0
+        self.chunks = []
+        return msg
+
     def _add_10(self, data):
         self.rbuffer += data
-        eomidx = self.rbuffer.find(b"]]>]]>", self.searchfrom)
+        eomidx = self.rbuffer.find(b"]]>]]>", max(self.rpos, self.searchfrom))
         if eomidx != -1:
-            msg = self.rbuffer[:eomidx]
-            self.rbuffer = self.rbuffer[eomidx + 6:]
-            self.searchfrom = 0
-            return msg
-        self.searchfrom = max(0, len(self.rbuffer) - 5)
+            return self._take_message(eomidx, eomidx + 6)
+        self.searchfrom = max(self.rpos, len(self.rbuffer) - 5)
+        if self.feeder is not None and self.searchfrom > self.rpos:
+            # Keep back anything that could be the start of the end marker.
+            self.feeder.feed(self._span(self.rpos, self.searchfrom))
+            del self.rbuffer[:self.searchfrom]
+            self.rpos = self.searchfrom = 0
         return None
 
-
     #TODO: Async - To be removed.
     async def _receive_10(self):
         searchfrom = 0
@@ -285,32 +478,47 @@ class NetconfFramingTransport(NetconfPacketTransport):
 
     def _add_11(self, data):
         self.rbuffer += data
+        rbuffer = self.rbuffer
         while True:
+            blen = len(rbuffer)
+            rpos = self.rpos
             if self.chunklen == -1:
-                if len(self.rbuffer)>2:
-                    self.searchfrom = self.searchfrom or 2
-                    if self.rbuffer[:2] != b"\n#":
-                        raise FramingError(self.rbuffer)
-                    idx = self.rbuffer.find(b"\n", self.searchfrom)
-                    if idx != -1:
-                        lenstr = self.rbuffer[2:idx]
-                        if lenstr == b'#':
-                            self.rbuffer = self.rbuffer[idx+1:]
-                            chunks = self.chunks
-                            self.chunks = []
-                            self.chunklen = -1
-                            return b''.join(chunks)
-                        self.rbuffer = self.rbuffer[idx + 1:]
-                        try:
-                            self.chunklen = int(lenstr)
-                            if not (4294967295 >= self.chunklen > 0):
-                                raise FramingError("Unacceptable chunk length: {}".format(chunklen))
-                        except ValueError:
-                            raise FramingError("Frame length not integer: {}".format(lenstr))
-            elif self.chunklen and len(self.rbuffer)>=self.chunklen:
-                chunk = self.rbuffer[:self.chunklen]
-                self.rbuffer = self.rbuffer[self.chunklen:]
-                self.chunks.append(chunk)
+                # Chunk header: "\n#<chunk-size>\n" or end of chunks "\n##\n"
+                if blen - rpos < 3:
+                    return None
+                if rbuffer[rpos:rpos + 2] != b"\n#":
+                    raise FramingError(rbuffer[rpos:rpos + 14])
+                idx = rbuffer.find(b"\n", rpos + 2, rpos + 14)
+                if idx == -1:
+                    if blen - rpos >= 14:
+                        raise FramingError(rbuffer[rpos:rpos + 14])
+                    return None
+                lenstr = bytes(rbuffer[rpos + 2:idx])
+                if lenstr == b'#':
+                    return self._take_message(rpos, idx + 1)
+                try:
+                    chunklen = int(lenstr)
+                except ValueError:
+                    raise FramingError("Frame length not integer: {}".format(lenstr))
+                if not 4294967295 >= chunklen > 0:
+                    raise FramingError("Unacceptable chunk length: {}".format(chunklen))
+                self.chunklen = chunklen
+                self.rpos = idx + 1
+            elif self.feeder is not None:
+                if blen == rpos:
+                    return None
+                # Pass on what we have of the chunk and drop it.
+                end = rpos + min(blen - rpos, self.chunklen)
+                self.feeder.feed(self._span(rpos, end))
+                del rbuffer[:end]
+                self.rpos = 0
+                self.chunklen -= end - rpos
+                if not self.chunklen:
+                    self.chunklen = -1
+            elif blen - rpos >= self.chunklen:
+                end = rpos + self.chunklen
+                self.chunks.append((rpos, end))
+                self.rpos = end
                 self.chunklen = -1
             else:
                 return None
@@ -328,8 +536,16 @@ class NetconfSession(object):
     # figure a way to factor the commonality. One issue is that this class can
     # be used with any transport not just SSH so where should it go?
 
-    def __init__(self, stream, debug, session_id, max_chunk=MAXSSHBUF):
+    def __init__(self,
+                 stream,
+                 debug,
+                 session_id,
+                 max_chunk=MAXSSHBUF,
+                 stream_parse=False,
+                 msg_format=None):
         self.debug = debug
+        self.stream_parse = stream_parse
+        self.msg_format = msg_format if msg_format is not None else MessageFormat()
         self.pkt_stream = NetconfFramingTransport(stream, max_chunk, debug)
         self.new_framing = False
         self.initial_hello = True
@@ -361,16 +577,24 @@ class NetconfSession(object):
             return
         if self.debug:
             logger.debug("Sending message (%d): %s", len(msg), msg)
-        pkt_stream.send_pdu(XML_HEADER + msg, self.new_framing)
+        if self.msg_format.xml_declaration:
+            pkt_stream.send_pdu((XML_HEADER, msg), self.new_framing)
+        else:
+            pkt_stream.send_pdu(msg, self.new_framing)
 
     def data_received(self, data, datatype):
         assert(datatype == None)
-        msg = self.pkt_stream.add_to_buffer(data, self.new_framing)
-        if msg:
+        # A single read may complete several (pipelined) messages.
+        while self.pkt_stream is not None:
+            msg = self.pkt_stream.add_to_buffer(data, self.new_framing)
+            if msg is None:
+                break
+            data = b""
+            if not msg:
+                continue
             if self.initial_hello:
                 #TODO: Async - What to do it initial hello fails?
-                #TODO: Async - How to get is_server argument?
-                self._handle_initial_hello(msg, True)
+                self._handle_initial_hello(msg, self.is_server)
             else:
                 self._reader_handle_message(msg)
 
@@ -387,46 +611,59 @@ class NetconfSession(object):
         return await pkt_stream.receive_pdu(self.new_framing)
 
     def send_hello(self, caplist, session_id=None):
+        msg_format = self.msg_format
+        if session_id is not None and msg_format.cache_hello:
+            if msg_format.hello is None:
+                hello = msg_format.tostring(self._get_hello(caplist, True))
+                # Keep it open so the session-id can be appended.
+                msg_format.hello = hello[:hello.rindex(b"</hello>")]
+            msg = b"".join((msg_format.hello, b"<session-id>", str(session_id).encode('utf-8'),
+                            b"</session-id></hello>"))
+        else:
+            msg = self._get_hello(caplist, session_id is not None)
+            if session_id is not None:
+                msg.append(ncutil.leaf_elm("session-id", str(session_id)))
+            msg = msg_format.tostring(msg)
+
+        if self.debug:
+            logger.debug("%s: Sending HELLO", str(self))
+        self.send_message(msg)
+
+    def _get_hello(self, caplist, is_server):
         msg = ncutil.elm("hello", attrib={'xmlns': NSMAP['nc']})
         caps = ncutil.elm("capabilities")
         for cap in caplist:
             ncutil.subelm(caps, "capability").text = str(cap)
-        if session_id is not None:
+        if is_server:
             assert hasattr(self, "methods")
             self.methods.nc_append_capabilities(caps)  # pylint: disable=E1101
         msg.append(caps)
-
-        if self.debug:
-            logger.debug("%s: Sending HELLO", str(self))
-        if session_id is not None:
-            msg.append(ncutil.leaf_elm("session-id", str(session_id)))
-        msg = etree.tostring(msg)
-        self.send_message(msg)
+        return msg
 
     def close(self):
         if self.debug:
             logger.debug("%s: Closing.", str(self))
 
         #TODO: Async - Replace? with self.slock:
-            if self.session_open:
-                self.session_open = False
-                self.session_id = None
+        if self.session_open:
+            self.session_open = False
+            self.session_id = None
 
-            #TODO: Async - remove threading
-            #if self.reader_thread:
-            #    self.reader_thread.keep_running = False
-            self.keep_running = False
+        #TODO: Async - remove threading
+        #if self.reader_thread:
+        #    self.reader_thread.keep_running = False
+        self.keep_running = False
 
-            if self.pkt_stream is not None:
-                if self.debug:
-                    logger.debug("%s: Closing transport.", str(self))
+        if self.pkt_stream is not None:
+            if self.debug:
+                logger.debug("%s: Closing transport.", str(self))
 
-                pkt_stream = self.pkt_stream
-                self.pkt_stream = None
+            pkt_stream = self.pkt_stream
+            self.pkt_stream = None
 
-                if pkt_stream:
-                    # If we are blocked on reading this should unblock us
-                    pkt_stream.close()
+            if pkt_stream:
+                # If we are blocked on reading this should unblock us
+                pkt_stream.close()
 
     async def _open_session(self, is_server):
         assert is_server or self.session_id is None
@@ -444,7 +681,7 @@ class NetconfSession(object):
             # Parse reply
             tree = etree.parse(io.BytesIO(reply))
             root = tree.getroot()
-            caps = root.xpath("//nc:hello/nc:capabilities/nc:capability", namespaces=NSMAP)
+            caps = compile_xpath("//nc:hello/nc:capabilities/nc:capability")(root)
 
             # Store capabilities
             for cap in caps:
@@ -458,7 +695,7 @@ class NetconfSession(object):
 
             # Get session ID.
             try:
-                session_id = root.xpath("//nc:hello/nc:session-id", namespaces=NSMAP)[0].text
+                session_id = compile_xpath("//nc:hello/nc:session-id")(root)[0].text
                 # If we are a server it is a failure to receive a session id.
                 if is_server:
                     raise SessionError("Client sent a session-id")
@@ -486,13 +723,15 @@ class NetconfSession(object):
             logger.debug("Received HELLO")
 
         try:
-            # Send hello message.
-            self.send_hello((NC_BASE_10, NC_BASE_11), self.session_id)
+            # Send hello message. A client sends its hello as soon as the
+            # channel opens so only the server answers here.
+            if is_server:
+                self.send_hello((NC_BASE_10, NC_BASE_11), self.session_id)
 
             # Parse reply
             tree = etree.parse(io.BytesIO(reply))
             root = tree.getroot()
-            caps = root.xpath("//nc:hello/nc:capabilities/nc:capability", namespaces=NSMAP)
+            caps = compile_xpath("//nc:hello/nc:capabilities/nc:capability")(root)
 
             # Store capabilities
             for cap in caps:
@@ -506,7 +745,7 @@ class NetconfSession(object):
 
             # Get session ID.
             try:
-                session_id = root.xpath("//nc:hello/nc:session-id", namespaces=NSMAP)[0].text
+                session_id = compile_xpath("//nc:hello/nc:session-id")(root)[0].text
                 # If we are a server it is a failure to receive a session id.
                 if is_server:
                     raise SessionError("Client sent a session-id")
@@ -521,10 +760,25 @@ class NetconfSession(object):
                 logger.debug("%s: Opened version %s session.", str(self), "1.1"
                              if self.new_framing else "1.0")
             self.initial_hello = False
+            if self.stream_parse:
+                self.pkt_stream.feeder = NetconfStreamParser()
         except Exception:
             self.close()
             raise
 
+    def _parse_message(self, msg):
+        """Return the lxml tree for a received message.
+
+        :param msg: The message bytes or, when parsing as the data arrives,
+                    the result from `NetconfStreamParser.close`.
+        :raises: `lxml.etree.XMLSyntaxError`
+        """
+        if isinstance(msg, etree.XMLSyntaxError):
+            raise msg
+        if isinstance(msg, (bytes, bytearray)):
+            return etree.parse(io.BytesIO(msg.lstrip()))
+        return msg
+
     def _reader_exits(self):
         """This function is called from the session reader thread as it exits. No more
         messages will be read from the session socket.
@@ -17,19 +17,18 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
-from contextlib import contextmanager
+import asyncio
+from contextlib import asynccontextmanager
+import getpass
 import logging
-import io
-import threading
 import socket
 
+import asyncssh
 from lxml import etree
-from monotonic import monotonic
-import sshutil.conn
-from netconf import NSMAP, qmap
-from netconf.base import NetconfSession
+from async_netconf import NSMAP, qmap, compile_xpath
+from async_netconf.base import NetconfSession, NC_BASE_10, NC_BASE_11
 from netconf.error import RPCError, SessionError, ReplyTimeoutError
-from netconf import util
+from async_netconf import util
 
 logger = logging.getLogger(__name__)
 
@@ -57,60 +56,64 @@ def _get_selection(elm, select):
         felm.attrib[qmap("nc") + "select"] = select
 
 
-class Timeout(object):
-    def __init__(self, timeout):
-        self.start_time = monotonic()
-        if timeout is None:
-            self.end_time = None
-        else:
-            self.end_time = self.start_time + timeout
+class NetconfClientSession(NetconfSession):
+    """Netconf Protocol
 
-    def is_expired(self):
-        if self.end_time is None:
-            return False
-        return self.end_time < monotonic()
+    Replies are delivered through an `asyncio.Future` per outstanding
+    message-id so a single event loop can drive any number of sessions.
 
-    def remaining(self):
-        if self.end_time is None:
-            return None
-        ctime = monotonic()
-        if self.end_time < ctime:
-            return 0
-        else:
-            return self.end_time - ctime
+    RPCs awaited through the coroutine methods (`send_rpc`, `get`, ...) are
+    pipelined: each is sent without waiting for earlier replies. If
+    `max_outstanding` is given at most that many are in flight at once and
+    further callers wait for a free slot.
 
+    If `stream_parse` is True replies are parsed as their data arrives
+    rather than once they are complete.
+    """
+    is_server = False
 
-class NetconfClientSession(NetconfSession):
-    """Netconf Protocol"""
-    def __init__(self, stream, debug=False):
-        super(NetconfClientSession, self).__init__(stream, debug, None)
+    def __init__(self, stream, debug=False, max_outstanding=None, stream_parse=False):
+        super(NetconfClientSession, self).__init__(stream, debug, None, stream_parse=stream_parse)
         self.message_id = 0
         self.closing = False
         self.rpc_out = {}
 
-        # Condition to handle rpc_out queue
-        self.cv = threading.Condition()
+        # Bound on pipelined RPCs and SSH channel write flow control.
+        self.window = asyncio.Semaphore(max_outstanding) if max_outstanding else None
+        self.writable = asyncio.Event()
+        self.writable.set()
 
-        super(NetconfClientSession, self)._open_session(False)
+        loop = asyncio.get_event_loop()
+        # Resolved once the server hello has been processed
+        self.opened = loop.create_future()
+
+        # Our hello is sent as soon as the channel is open, the server hello
+        # is handled by data_received.
+        self.send_hello((NC_BASE_10, NC_BASE_11))
 
     def __str__(self):
         return "NetconfClientSession(sid:{})".format(self.session_id)
 
+    async def wait_open(self, timeout=None):
+        """Wait for the hello exchange with the server to complete.
+
+        :param timeout: A value in fractional seconds to wait for the server hello or
+                        `None` for no timeout.
+        :raises: ReplyTimeoutError, SessionError
+        """
+        try:
+            await asyncio.wait_for(asyncio.shield(self.opened), timeout)
+        except asyncio.TimeoutError:
+            raise ReplyTimeoutError("Timeout ({}s) while waiting for server hello".format(timeout))
+
     def close(self):
         """Close the session."""
 
         if self.debug:
             logger.debug("%s: Closing session.", str(self))
 
-        reply = None
         try:
-            # So we need a lock here to check these members.
-            send = False
-            with self.cv:
-                if self.session_id is not None and self.is_active():
-                    send = True
-
-            if send:
+            if self.session_id is not None and self.is_active():
                 self.send_rpc_async("<nc:close-session/>", noreply=True)
                 # Don't wait for a reply the session is closed!
         except socket.error:
@@ -120,59 +123,42 @@ class NetconfClientSession(NetconfSession):
         super(NetconfClientSession, self).close()
 
         if self.debug:
-            logger.debug("%s: Closed: %s", str(self), str(reply))
+            logger.debug("%s: Closed.", str(self))
 
     def is_reply_ready(self, msg_id):
         """Check whether reply is ready (or session closed)"""
-        with self.cv:
-            if not self.is_active():
-                raise SessionError("Session closed while checking for reply")
-            return self.rpc_out[msg_id] is not None
+        if not self.is_active():
+            raise SessionError("Session closed while checking for reply")
+        return self.rpc_out[msg_id].done()
 
-    def wait_reply(self, msg_id, timeout=None):
+    async def wait_reply(self, msg_id, timeout=None):
         """Wait for a reply to a given RPC message ID.
 
         :param msg_id: the RPC message ID returned from one of the async method calls
+        :param timeout: A value in fractional seconds to wait for the reply or
+                        `None` for no timeout.
         :return: (Message as an lxml tree, Parsed reply content, Parsed message content).
         :rtype: (lxml.etree, lxml.Element, lxml.Element)
-        :raises: RPCError, SessionError
+        :raises: ReplyTimeoutError, RPCError, SessionError
         """
         assert msg_id in self.rpc_out
 
-        check_timeout = Timeout(timeout)
-
-        self.cv.acquire()
-        # XXX need to make sure the channel doesn't close
-        while self.rpc_out[msg_id] is None and self.is_active():
-            remaining = check_timeout.remaining()
-
-            self.cv.wait(remaining)
-            if self.rpc_out[msg_id] is not None:
-                break
-
-            if check_timeout.is_expired():
-                raise ReplyTimeoutError(
-                    "Timeout ({}s) while waiting for RPC reply to msg-id: {}".format(
-                        timeout, msg_id))
-
-        if not self.is_active():
-            self.cv.release()
-            raise SessionError("Session closed while waiting for reply")
-
-        tree, reply, msg = self.rpc_out[msg_id]
-        del self.rpc_out[msg_id]
-        self.cv.release()
-
-        error = reply.xpath("nc:rpc-error", namespaces=NSMAP)
+        try:
+            tree, reply, msg = await asyncio.wait_for(self.rpc_out[msg_id], timeout)
+        except asyncio.TimeoutError:
+            raise ReplyTimeoutError("Timeout ({}s) while waiting for RPC reply to msg-id: {}".format(
+                timeout, msg_id))
+        finally:
+            del self.rpc_out[msg_id]
+
+        error = compile_xpath("nc:rpc-error")(reply)
         if error:
             raise RPCError(msg, tree, error[0])
 
-        # data = reply.xpath("nc:data", namespaces=self.nsmap)
-        # ok = reply.xpath("nc:ok", namespaces=self.nsmap)
         return tree, reply, msg
 
     def send_rpc_async(self, rpc, noreply=False):
-        """Send a generic RPC to the server and await the reply.
+        """Send a generic RPC to the server without waiting for the reply.
 
         :param rpc: The XML of the netconf RPC, not including the <nc:rpc> tag.
         :type rpc: str or `lxml.Element`
@@ -180,47 +166,63 @@ class NetconfClientSession(NetconfSession):
         :type noreply: Boolean
 
         :return: The RPC message id which can be passed to wait_reply for the results.
+        :raises: SessionError
         """
 
         # We use strings to allow users to pass malformed data.
         if hasattr(rpc, "nsmap"):
             rpc = etree.tounicode(rpc)
 
+        if self.session_id is None or not self.is_active():
+            raise SessionError("Session closed while sending RPC")
+
         # Get the next message id
-        with self.cv:
-            assert self.session_id is not None
-            msg_id = self.message_id
-            self.message_id += 1
+        msg_id = self.message_id
+        self.message_id += 1
 
         if self.debug:
             logger.debug("%s: Sending RPC message-id: %s", str(self), str(msg_id))
 
-        def sendit():
-            self.send_message(
-                """<nc:rpc nc:message-id="{}" xmlns:nc="urn:ietf:params:xml:ns:netconf:base:1.0">{}</nc:rpc>"""
-                .format(msg_id, rpc))
+        if not noreply:
+            # Mark us as expecting a reply
+            self.rpc_out[msg_id] = asyncio.get_event_loop().create_future()
+
+        self.send_message(
+            """<nc:rpc nc:message-id="{}" xmlns:nc="urn:ietf:params:xml:ns:netconf:base:1.0">{}</nc:rpc>"""
+            .format(msg_id, rpc).encode('utf-8'))
 
         if noreply:
-            sendit()
             return None
-
-        with self.cv:
-            sendit()
-            # Mark us as expecting a reply
-            self.rpc_out[msg_id] = None
-
         return msg_id
 
-    def send_rpc(self, rpc, timeout=None):
+    async def send_rpc(self, rpc, timeout=None):
         """Send a generic RPC to the server and await the reply.
 
         :param rpc (string): The XML of the netconf RPC, not including the <rpc> tag.
         :return: (Message as an lxml tree, Parsed reply content, Parsed message content).
         :rtype: (lxml.etree, lxml.Element, lxml.Element)
-        :raises: RPCError, SessionError
+        :raises: ReplyTimeoutError, RPCError, SessionError
+        """
+        async with self._rpc_slot():
+            msg_id = self.send_rpc_async(rpc)
+            return await self.wait_reply(msg_id, timeout)
+
+    async def send_rpcs(self, rpcs, timeout=None, return_exceptions=False):
+        """Pipeline a batch of generic RPCs on this session and gather the replies.
+
+        The RPCs are sent back to back (subject to `max_outstanding`) and the
+        replies are returned in the order of `rpcs`.
+
+        :param rpcs: An iterable of RPCs as accepted by `send_rpc`.
+        :param timeout: A value in fractional seconds to wait for each reply or
+                        `None` for no timeout.
+        :param return_exceptions: If True errors are returned in place of the
+                                  failed replies instead of being raised.
+        :return: List of (Message as an lxml tree, Parsed reply content, Parsed message content).
+        :raises: ReplyTimeoutError, RPCError, SessionError
         """
-        msg_id = self.send_rpc_async(rpc)
-        return self.wait_reply(msg_id, timeout)
+        return await asyncio.gather(*[self.send_rpc(rpc, timeout) for rpc in rpcs],
+                                    return_exceptions=return_exceptions)
 
     def edit_config_async(self, target, method, newconf, testopt, erroropt):
         """Operate on config in ~target~ using ~newconf~ according to ~method~ ("merge", "replace",
@@ -257,7 +259,7 @@ class NetconfClientSession(NetconfSession):
         rpc += "</nc:edit-config>\n"
         return self.send_rpc_async(rpc)
 
-    def edit_config(self,
+    async def edit_config(self,
                     target="running",
                     method="",
                     newconf="",
@@ -280,8 +282,9 @@ class NetconfClientSession(NetconfSession):
         :rtype: lxml.Element
         :raises: ReplyTimeoutError, RPCError, SessionError
         """
-        msg_id = self.edit_config_async(target, method, newconf, testopt, erroropt)
-        _, reply, _ = self.wait_reply(msg_id, timeout)
+        async with self._rpc_slot():
+            msg_id = self.edit_config_async(target, method, newconf, testopt, erroropt)
+            _, reply, _ = await self.wait_reply(msg_id, timeout)
         return reply
 
     def get_config_async(self, source, select):
@@ -301,7 +304,7 @@ class NetconfClientSession(NetconfSession):
         _get_selection(getelm, select)
         return self.send_rpc_async(getelm)
 
-    def get_config(self, source="running", select=None, timeout=None):
+    async def get_config(self, source="running", select=None, timeout=None):
         """Get config for a given source from the server. If `select` is specified it
         is either an XPATH expression or XML subtree filter for selecting a
         subsection of the config. If `timeout` is not `None` it specifies how
@@ -315,8 +318,9 @@ class NetconfClientSession(NetconfSession):
         :rtype: lxml.Element
         :raises: ReplyTimeoutError, RPCError, SessionError
         """
-        msg_id = self.get_config_async(source, select)
-        _, reply, _ = self.wait_reply(msg_id, timeout)
+        async with self._rpc_slot():
+            msg_id = self.get_config_async(source, select)
+            _, reply, _ = await self.wait_reply(msg_id, timeout)
         return reply.find("nc:data", namespaces=NSMAP)
 
     def get_async(self, select):
@@ -334,7 +338,7 @@ class NetconfClientSession(NetconfSession):
         _get_selection(getelm, select)
         return self.send_rpc_async(getelm)
 
-    def get(self, select=None, timeout=None):
+    async def get(self, select=None, timeout=None):
         """Get operational state from the server. If `select` is specified it is either
         an XPATH expression or XML subtree filter for selecting a subsection of
         the state. If `timeout` is not `None` it specifies how long to wait for
@@ -347,8 +351,9 @@ class NetconfClientSession(NetconfSession):
         :rtype: lxml.Element
         :raises: ReplyTimeoutError, RPCError, SessionError
         """
-        msg_id = self.get_async(select)
-        _, reply, _ = self.wait_reply(msg_id, timeout)
+        async with self._rpc_slot():
+            msg_id = self.get_async(select)
+            _, reply, _ = await self.wait_reply(msg_id, timeout)
         return reply.find("nc:data", namespaces=NSMAP)
 
     def lock_async(self, target):
@@ -364,7 +369,7 @@ class NetconfClientSession(NetconfSession):
         util.subelm(util.subelm(lockelm, "nc:target"), target)
         return self.send_rpc_async(lockelm)
 
-    def lock(self, target="running", timeout=None):
+    async def lock(self, target="running", timeout=None):
         """Lock target datastore asynchronously.
 
         If `timeout` is not `None` it specifies how long to wait for the get operation to complete.
@@ -373,8 +378,9 @@ class NetconfClientSession(NetconfSession):
         :return: None
         :raises: RPCError, SessionError
         """
-        msg_id = self.lock_async(target)
-        _, reply, _ = self.wait_reply(msg_id, timeout)
+        async with self._rpc_slot():
+            msg_id = self.lock_async(target)
+            _, reply, _ = await self.wait_reply(msg_id, timeout)
         return reply.find("nc:data", namespaces=NSMAP)
 
     def unlock_async(self, target):
@@ -390,7 +396,7 @@ class NetconfClientSession(NetconfSession):
         util.subelm(util.subelm(unlockelm, "nc:target"), target)
         return self.send_rpc_async(unlockelm)
 
-    def unlock(self, target="running", timeout=None):
+    async def unlock(self, target="running", timeout=None):
         """Unlock target datastore asynchronously.
 
         If `timeout` is not `None` it specifies how long to wait for the get operation to complete.
@@ -399,35 +405,62 @@ class NetconfClientSession(NetconfSession):
         :return: None
         :raises: RPCError, SessionError
         """
-        msg_id = self.unlock_async(target)
-        _, reply, _ = self.wait_reply(msg_id, timeout)
+        async with self._rpc_slot():
+            msg_id = self.unlock_async(target)
+            _, reply, _ = await self.wait_reply(msg_id, timeout)
         return reply.find("nc:data", namespaces=NSMAP)
 
     # ----------------
     # Internal Methods
     # ----------------
 
+    @asynccontextmanager
+    async def _rpc_slot(self):
+        """Hold one of the `max_outstanding` RPC slots for the duration of an
+        RPC, and don't send while the SSH channel has asked us to pause.
+        """
+        if self.window is None:
+            await self.writable.wait()
+            yield
+            return
+        async with self.window:
+            await self.writable.wait()
+            yield
+
+    def _handle_initial_hello(self, reply, is_server):
+        try:
+            super(NetconfClientSession, self)._handle_initial_hello(reply, is_server)
+        except Exception as error:
+            if not self.opened.done():
+                self.opened.set_exception(error)
+            raise
+        if not self.opened.done():
+            self.opened.set_result(True)
+
     def _reader_exits(self):
-        """This function is called from the session reader thread as it exits. No more
-        messages will be read from the session socket.
+        """This function is called when the session channel is gone. No more
+        messages will be read from the session so fail anyone still waiting.
         """
         if self.debug:
-            logger.debug("%s: Reader thread exited notifying all.", str(self))
-        with self.cv:
-            self.cv.notify_all()
+            logger.debug("%s: Channel closed failing outstanding replies.", str(self))
+        if not self.opened.done():
+            self.opened.set_exception(SessionError("Session closed before hello was received"))
+        for future in self.rpc_out.values():
+            if not future.done():
+                future.set_exception(SessionError("Session closed while waiting for reply"))
 
     def _reader_handle_message(self, msg):
-        """This function is called from the session reader thread to process a received
+        """This function is called from data_received to process a received
         framed netconf message.
         """
         try:
-            tree = etree.parse(io.BytesIO(msg.encode('utf-8')))
+            tree = self._parse_message(msg)
             if not tree:
                 raise SessionError(msg, "Invalid XML from server.")
         except etree.XMLSyntaxError:
             raise SessionError(msg, "Invalid XML from server.")
 
-        replies = tree.xpath("/nc:rpc-reply", namespaces=NSMAP)
+        replies = compile_xpath("/nc:rpc-reply")(tree)
         if not replies:
             raise SessionError(msg, "No rpc-reply found")
 
@@ -439,108 +472,165 @@ class NetconfClientSession(NetconfSession):
                     # Deal with servers not properly setting attribute namespace.
                     msg_id = int(reply.get('message-id'))
                 except (TypeError, ValueError):
-                    # # Cisco is returning errors without message-id attribute which
-                    # # is non-rfc-conforming it is doing this for any malformed XML
-                    # # not simply missing message-id attribute.
-                    # error = reply.xpath("nc:rpc-error", namespaces=self.nsmap)
-                    # if error:
-                    #     raise RPCError(received, tree, error[0])
                     raise SessionError(msg, "No valid message-id attribute found")
 
-            # Queue the message
-            with self.cv:
-                try:
-                    if msg_id not in self.rpc_out:
-                        if self.debug:
-                            logger.debug("Ignoring unwanted reply for message-id %s", str(msg_id))
-                        return
-                    elif self.rpc_out[msg_id] is not None:
-                        logger.warning(
-                            "Received multiple replies for message-id %s:"
-                            " before: %s now: %s", str(msg_id), str(self.rpc_out[msg_id]), str(msg))
-
-                    if self.debug:
-                        logger.debug("%s: Received rpc-reply message-id: %s", str(self),
-                                     str(msg_id))
-                    self.rpc_out[msg_id] = tree, reply, msg
-                except Exception as error:
-                    logger.debug("%s: Unexpected exception: %s", str(self), str(error))
-                    raise
-                finally:
-                    self.cv.notify_all()
+            future = self.rpc_out.get(msg_id)
+            if future is None:
+                if self.debug:
+                    logger.debug("Ignoring unwanted reply for message-id %s", str(msg_id))
+                continue
+            elif future.done():
+                logger.warning("Received multiple replies for message-id %s: now: %s", str(msg_id),
+                               str(msg))
+                continue
+
+            if self.debug:
+                logger.debug("%s: Received rpc-reply message-id: %s", str(self), str(msg_id))
+            future.set_result((tree, reply, msg))
+
+
+class SSHClientSession(asyncssh.SSHClientSession):
+    """Connects an asyncssh channel to a netconf client session."""
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.session = None
+
+    def connection_made(self, chan):
+        self.session = self.session_factory(chan)
+
+    def pause_writing(self):
+        self.session.writable.clear()
+
+    def resume_writing(self):
+        self.session.writable.set()
+
+    def data_received(self, data, datatype):
+        try:
+            self.session.data_received(data, datatype)
+        except Exception as error:
+            # The channel close will fail any outstanding replies.
+            logger.error("%s: Closing session due to error: %s", str(self.session), str(error))
+            self.session.close()
+
+    def connection_lost(self, exc):
+        if self.session is not None:
+            self.session._reader_exits()  # pylint: disable=W0212
 
 
 class NetconfSSHSession(NetconfClientSession):
-    def __init__(self,
-                 host,
-                 port=830,
-                 username=None,
-                 password=None,
-                 debug=False,
-                 cache=None,
-                 proxycmd=None):
-        """A netconf SSH client session.
+    """A netconf SSH client session.
+
+    Sessions are created with `NetconfSSHSession.connect` or the `connect_ssh`
+    context manager.
+    """
+    def __init__(self, stream, debug=False, max_outstanding=None, stream_parse=False):
+        super(NetconfSSHSession, self).__init__(stream, debug, max_outstanding, stream_parse)
+        self.conn = None
+
+    @classmethod
+    async def connect(cls,
+                      host,
+                      port=830,
+                      username=None,
+                      password=None,
+                      debug=False,
+                      timeout=None,
+                      max_outstanding=None,
+                      stream_parse=False,
+                      **ssh_options):
+        """Open a netconf SSH client session.
 
         If `username` is not specified then it will be obtained with
-        getpass.getuser(). If an ssh agent is available it will be used for
-        authentication. A users .ssh/config will be processed for making the ssh
-        connection and any proxycmd found therein will also be utilized.
+        getpass.getuser().
 
         :param host: The host to connect to.
         :param port: The port to connect to.
         :param username: The username to connect with. If not specified getpass.getuser()
                          will be used.
-        :param password: The password or passkey to authenticate with.
+        :param password: The password to authenticate with.
         :param debug: Enable debug logging
-        :param cache: An SSH cache (`sshutil.cache`) to use for caching connections.
-        :param proxycmd: A proxy command string for connecting with
+        :param timeout: A value in fractional seconds to wait for the server hello or
+                        `None` for no timeout.
+        :param max_outstanding: Maximum number of pipelined RPCs in flight or `None` for
+                                no limit.
+        :param stream_parse: True to parse replies as their data arrives.
+        :param ssh_options: Additional options for `asyncssh.connect` (e.g., known_hosts,
+                            client_keys).
+        :return: The open session.
+        :rtype: `NetconfSSHSession`
+        :raises: ReplyTimeoutError, SessionError, asyncssh.Error
         """
         if username is None:
-            import getpass
             username = getpass.getuser()
-        stream = sshutil.conn.SSHClientSession(host,
-                                               port,
-                                               "netconf",
-                                               username,
-                                               password,
-                                               debug,
-                                               cache=cache,
-                                               proxycmd=proxycmd)
-        super(NetconfSSHSession, self).__init__(stream, debug)
-
-    def __enter__(self):
+        conn = await asyncssh.connect(host, port, username=username, password=password, **ssh_options)
+        try:
+            _, ssh_session = await conn.create_session(
+                lambda: SSHClientSession(
+                    lambda chan: cls(chan, debug, max_outstanding, stream_parse)),
+                subsystem="netconf",
+                encoding=None)
+            session = ssh_session.session
+            session.conn = conn
+            await session.wait_open(timeout)
+        except Exception:
+            conn.close()
+            raise
+        return session
+
+    def close(self):
+        super(NetconfSSHSession, self).close()
+        if self.conn is not None:
+            self.conn.close()
+
+    async def wait_closed(self):
+        """Wait for the underlying SSH connection to close."""
+        if self.conn is not None:
+            await self.conn.wait_closed()
+
+    async def __aenter__(self):
         return self
 
-    def __exit__(self, exc_type, exc_value, traceback):
+    async def __aexit__(self, exc_type, exc_value, traceback):
         self.close()
+        await self.wait_closed()
 
 
-@contextmanager
-def connect_ssh(host,
-                port=830,
-                username=None,
-                password=None,
-                debug=False,
-                cache=None,
-                proxycmd=None):
-    """A context manager method for opening a netconf SSH session.
+@asynccontextmanager
+async def connect_ssh(host,
+                      port=830,
+                      username=None,
+                      password=None,
+                      debug=False,
+                      max_outstanding=None,
+                      stream_parse=False,
+                      **ssh_options):
+    """An async context manager for opening a netconf SSH session.
 
     If `username` is not specified then it will be obtained with
-    getpass.getuser(). If an ssh agent is available it will be used for
-    authentication. A users .ssh/config will be processed for making the ssh
-    connection and any proxycmd found therein will also be utilized.
+    getpass.getuser().
 
     :param host: The host to connect to.
     :param port: The port to connect to.
     :param username: The username to connect with. If not specified getpass.getuser() will be used
-    :param password: The password or passkey to authenticate with.
+    :param password: The password to authenticate with.
     :param debug: Enable debug logging
-    :param cache: An SSH cache (`sshutil.cache`) to use for caching connections.
-    :param proxycmd: A proxy command string for connecting with
+    :param max_outstanding: Maximum number of pipelined RPCs in flight or `None` for no limit.
+    :param stream_parse: True to parse replies as their data arrives.
+    :param ssh_options: Additional options for `asyncssh.connect` (e.g., known_hosts, client_keys).
     """
-    session = NetconfSSHSession(host, port, username, password, debug, cache, proxycmd)
-    yield session
-    session.close()
+    session = await NetconfSSHSession.connect(host,
+                                              port,
+                                              username,
+                                              password,
+                                              debug,
+                                              max_outstanding=max_outstanding,
+                                              stream_parse=stream_parse,
+                                              **ssh_options)
+    try:
+        yield session
+    finally:
+        session.close()
+        await session.wait_closed()
 
 
 __author__ = 'Christian Hopps'
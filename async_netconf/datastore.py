@@ -0,0 +1,439 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
+import copy
+import hashlib
+import logging
+import pickle
+import zlib
+from lxml import etree
+
+from async_netconf import qmap
+from netconf.util import Fingerprints
+
+logger = logging.getLogger(__name__)
+
+
+def _new_root(root):
+    return etree.Element(root.tag, attrib=root.attrib, nsmap=root.nsmap)
+
+
+class Datastore(object):
+    """A configuration datastore which shares an immutable baseline tree.
+
+    Many (simulated) devices can share the same baseline. Each datastore only
+    stores the edits made to it and materializes the subtrees, i.e., the
+    children of the root with a given tag, as they are read.
+
+    An edit of a subtree is kept as a delta which is applied to the baseline
+    subtree when it is read. Once a subtree has more than ``max_deltas`` deltas
+    they are folded into a private copy of the subtree.
+
+    :param baseline: The root element of the baseline tree. It must not be
+                     modified while datastores use it.
+    :param merge: Called as ``merge(lnode, rnode)`` to apply the edit ``rnode``
+                  to the tree ``lnode`` (e.g., `netconf_merge.merge_tree` with
+                  a schema bound). Both have the tag of the baseline root.
+                  ``rnode`` is a private copy which may be consumed.
+    :param max_deltas: The number of deltas to keep for a subtree.
+    :param cache: The cache to keep the materialized tree in while this
+                  datastore is in use. Without one nothing is kept.
+    :type cache: `DatastoreCache`
+    :param fingerprints: Whether to keep the `netconf.util.Fingerprints` of
+                         the tree in the cache. Edits are then also merged
+                         into that tree in place, as ``merge(lnode, rnode,
+                         fingerprints)`` which must update the fingerprints
+                         (e.g., `netconf_merge.merge_tree` with
+                         ``fingerprints``), so that `fingerprint` only hashes
+                         the edited elements again.
+
+    The ``version`` is incremented by each successful edit, while the
+    `fingerprint` only changes with the content.
+    """
+
+    def __init__(self, baseline, merge, max_deltas=16, cache=None, fingerprints=False):
+        self.baseline = baseline
+        self.merge = merge
+        self.max_deltas = max_deltas
+        self.cache = cache
+        self.version = 0
+        # Private copies of subtrees by tag, each a root holding the subtrees.
+        self.subtrees = {}
+        # The deltas to apply to the subtrees by tag.
+        self.deltas = {}
+        # The materialized tree while in the cache.
+        self.tree = None
+        # The serialized state while evicted from the cache.
+        self.stored = None
+        # The hashes of the elements of the materialized tree if kept.
+        self.fingerprints = Fingerprints() if fingerprints else None
+        # The hashes of the subtrees by tag, dropped when edited.
+        self.digests = {}
+
+    def get(self, filter_or_none=None):
+        """Materialize the datastore.
+
+        :param filter_or_none: A filter element. Only the subtrees it may
+                               select are materialized.
+        :return: A new root element which the caller owns.
+        """
+        self._access()
+        tags = get_filter_tags(self.baseline.tag, filter_or_none)
+        if self.cache is not None:
+            tree = self._get_tree()
+            if tags is None:
+                return copy.deepcopy(tree)
+            root = _new_root(self.baseline)
+            for tag in tags:
+                root.extend(copy.deepcopy(e) for e in tree.iterchildren(tag))
+            return root
+
+        if tags is None:
+            tags = self.get_tags()
+        root = _new_root(self.baseline)
+        for tag in tags:
+            root.extend(list(self._materialize(tag)))
+        return root
+
+    def fingerprint(self, filter_or_none=None):
+        """Get a hash of the content a filter may select.
+
+        The hash is equal for equal content, whitespace and comments aside,
+        so a reply built for an older version is still valid if the hash is
+        unchanged. The hashes of the subtrees are kept until they are edited,
+        also while evicted from the cache.
+
+        :param filter_or_none: A filter element. Only the subtrees it may
+                               select are hashed.
+        :return: The hash as bytes.
+        """
+        tags = get_filter_tags(self.baseline.tag, filter_or_none)
+        if tags is None:
+            tags = self.get_tags()
+        m = hashlib.sha1()
+        for tag in tags:
+            h = self.digests.get(tag)
+            if h is None:
+                self._access()
+                fingerprints = Fingerprints()
+                if self.cache is None:
+                    subtrees = self._materialize(tag)
+                else:
+                    subtrees = self._get_tree().iterchildren(tag)
+                    if self.fingerprints is not None:
+                        fingerprints = self.fingerprints
+                ms = hashlib.sha1(tag.encode("utf-8"))
+                for e in subtrees:
+                    ms.update(fingerprints.get(e))
+                h = self.digests[tag] = ms.digest()
+            m.update(h)
+        return m.digest()
+
+    def edit(self, config):
+        """Apply an edit.
+
+        Nothing is changed if the edit fails.
+
+        :param config: The root of the edit, it is not modified.
+        :raises: Whatever ``merge`` raises for invalid edits.
+        """
+        if config.tag != self.baseline.tag:
+            raise ValueError("Edit of {} not {}".format(config.tag, self.baseline.tag))
+        self._access()
+
+        edits = {}
+        for child in config:
+            if isinstance(child.tag, str) and child.tag not in edits:
+                delta = edits[child.tag] = _new_root(config)
+                delta.extend(copy.deepcopy(e) for e in config.iterchildren(child.tag))
+
+        # Apply to each subtree first so that a failing edit changes nothing.
+        roots = {}
+        for tag, delta in edits.items():
+            if self.tree is not None:
+                root = roots[tag] = _new_root(self.baseline)
+                root.extend(copy.deepcopy(e) for e in self.tree.iterchildren(tag))
+            else:
+                root = roots[tag] = self._materialize(tag)
+            self.merge(root, copy.deepcopy(delta))
+
+        for tag, delta in edits.items():
+            self.digests.pop(tag, None)
+            deltas = self.deltas.setdefault(tag, [])
+            deltas.append(delta)
+            if len(deltas) > self.max_deltas:
+                self.subtrees[tag] = roots[tag]
+                del self.deltas[tag]
+
+        if self.tree is not None:
+            tree = _new_root(self.baseline)
+            if self.fingerprints is not None:
+                self.fingerprints.invalidate(self.tree)
+            for tag in self.get_tags():
+                if tag not in roots:
+                    tree.extend(list(self.tree.iterchildren(tag)))
+                elif self.fingerprints is None:
+                    tree.extend(copy.deepcopy(e) for e in roots[tag].iterchildren(tag))
+                else:
+                    # Merge again in place so only the hashes along the edited
+                    # paths are dropped.
+                    root = _new_root(self.baseline)
+                    root.extend(list(self.tree.iterchildren(tag)))
+                    self.merge(root, copy.deepcopy(edits[tag]), self.fingerprints)
+                    tree.extend(list(root))
+            self.tree = tree
+        self.version += 1
+
+    def get_tags(self):
+        """Get the tags of the subtrees in the order they are materialized."""
+        tags = {}
+        for child in self.baseline:
+            if isinstance(child.tag, str):
+                tags[child.tag] = True
+        tags.update(dict.fromkeys(self.subtrees, True))
+        tags.update(dict.fromkeys(self.deltas, True))
+        return list(tags)
+
+    def _access(self):
+        # Reload if evicted and mark as recently used.
+        if self.cache is None:
+            return
+        if self.stored is not None:
+            self.cache.backend.load(self, self.stored)
+            self.stored = None
+        self.cache.touch(self)
+
+    def _evict(self):
+        if self.subtrees or self.deltas:
+            self.stored = self.cache.backend.dump(self)
+        self.tree = None
+        self.subtrees = {}
+        self.deltas = {}
+        if self.fingerprints is not None:
+            self.fingerprints = Fingerprints()
+
+    def _get_tree(self):
+        if self.tree is None:
+            tree = _new_root(self.baseline)
+            for tag in self.get_tags():
+                tree.extend(list(self._materialize(tag)))
+            self.tree = tree
+        return self.tree
+
+    def _materialize(self, tag):
+        # Get a new root holding the subtrees with tag with all edits applied.
+        source = self.subtrees.get(tag, self.baseline)
+        root = _new_root(self.baseline)
+        root.extend(copy.deepcopy(e) for e in source.iterchildren(tag))
+        for delta in self.deltas.get(tag, ()):
+            self.merge(root, copy.deepcopy(delta))
+        return root
+
+
+class DatastoreCache(object):
+    """A bounded LRU of datastores with their materialized trees.
+
+    The least recently used datastores are evicted and serialized by the
+    backend. They are reloaded when next used.
+
+    :param max_trees: The number of datastores to keep.
+    :param backend: Serializes evicted datastores, by default `DeltaBackend`.
+    """
+
+    def __init__(self, max_trees=1000, backend=None):
+        self.max_trees = max_trees
+        self.backend = backend if backend is not None else DeltaBackend()
+        self.datastores = collections.OrderedDict()
+
+    def touch(self, datastore):
+        """Mark a datastore as most recently used, evicting others as needed."""
+        try:
+            self.datastores.move_to_end(datastore)
+        except KeyError:
+            self.datastores[datastore] = True
+            while len(self.datastores) > self.max_trees:
+                evicted, _ = self.datastores.popitem(last=False)
+                evicted._evict()  # pylint: disable=W0212
+
+
+class DeltaBackend(object):
+    """Serialize evicted datastores as their compressed deltas from the baseline.
+
+    :param level: The zlib compression level.
+    """
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def dump(self, datastore):
+        state = {}
+        for tag in datastore.get_tags():
+            subtree = datastore.subtrees.get(tag)
+            deltas = datastore.deltas.get(tag, ())
+            if subtree is not None or deltas:
+                state[tag] = (etree.tostring(subtree) if subtree is not None else None,
+                              [etree.tostring(x) for x in deltas])
+        return zlib.compress(pickle.dumps(state), self.level)
+
+    def load(self, datastore, data):
+        for tag, (subtree, deltas) in pickle.loads(zlib.decompress(data)).items():
+            if subtree is not None:
+                datastore.subtrees[tag] = etree.fromstring(subtree)
+            if deltas:
+                datastore.deltas[tag] = [etree.fromstring(x) for x in deltas]
+
+
+class XMLBackend(object):
+    """Serialize evicted datastores as compressed canonical XML of their tree.
+
+    :param level: The zlib compression level.
+    """
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def dump(self, datastore):
+        return zlib.compress(etree.tostring(datastore._get_tree(), method="c14n"), self.level)  # pylint: disable=W0212
+
+    def load(self, datastore, data):
+        root = etree.fromstring(zlib.decompress(data))
+        # The tree replaces the baseline for every subtree.
+        for tag in datastore.get_tags():
+            datastore.subtrees[tag] = root
+        for child in root:
+            if isinstance(child.tag, str):
+                datastore.subtrees[child.tag] = root
+
+
+class ReplyCache(object):
+    """A bounded LRU of serialized replies by datastore version and filter.
+
+    Entries of older versions of a datastore are not returned and can be
+    dropped early with `invalidate`. With ``fingerprints`` the
+    `Datastore.fingerprint` of the content a reply selects is kept with it,
+    and the reply is still returned after edits which did not change that
+    content, e.g., edits of other subtrees.
+
+    :param max_size: The total size in bytes of the replies to keep.
+    :param fingerprints: Whether to keep replies by fingerprint.
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024, fingerprints=False):
+        self.max_size = max_size
+        self.fingerprints = fingerprints
+        self.size = 0
+        # (datastore, filter key) -> (version, fingerprint, reply)
+        self.entries = collections.OrderedDict()
+        self.filters = {}
+
+    def get(self, datastore, filter_or_none, build):
+        """Get the serialized reply for a datastore and filter.
+
+        :param datastore: An object with a ``version``, e.g., a `Datastore`,
+                          and a ``fingerprint`` method with ``fingerprints``.
+        :param filter_or_none: A filter element or None.
+        :param build: Called with no arguments to get the reply element on a miss.
+        :return: The serialized reply as bytes.
+        """
+        key = (datastore, get_filter_key(filter_or_none))
+        entry = self.entries.get(key)
+        if entry is not None:
+            version, fingerprint, reply = entry
+            if version != datastore.version and fingerprint is not None:
+                if fingerprint == datastore.fingerprint(filter_or_none):
+                    version = datastore.version
+                    self.entries[key] = (version, fingerprint, reply)
+            if version == datastore.version:
+                self.entries.move_to_end(key)
+                return reply
+            self._remove(key)
+
+        version = datastore.version
+        fingerprint = datastore.fingerprint(filter_or_none) if self.fingerprints else None
+        reply = etree.tostring(build())
+        if len(reply) <= self.max_size:
+            self.entries[key] = (version, fingerprint, reply)
+            self.filters.setdefault(datastore, set()).add(key[1])
+            self.size += len(reply)
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+        return reply
+
+    def invalidate(self, datastore):
+        """Drop all replies of a datastore."""
+        for fkey in list(self.filters.get(datastore, ())):
+            self._remove((datastore, fkey))
+
+    def _remove(self, key):
+        _, _, reply = self.entries.pop(key)
+        self.size -= len(reply)
+        fkeys = self.filters[key[0]]
+        fkeys.discard(key[1])
+        if not fkeys:
+            del self.filters[key[0]]
+
+
+def get_filter_key(filter_or_none):
+    """Get a key which is equal for filters that select the same.
+
+    Whitespace only text is ignored.
+
+    :param filter_or_none: A filter element or None.
+    :return: The canonical XML of the filter as bytes, or None.
+    """
+    if filter_or_none is None:
+        return None
+    felm = copy.deepcopy(filter_or_none)
+    for elm in felm.iter():
+        if elm.text is not None and not elm.text.strip():
+            elm.text = None
+        if elm.tail is not None and not elm.tail.strip():
+            elm.tail = None
+    felm.tail = None
+    return etree.tostring(felm, method="c14n")
+
+
+def get_filter_tags(root_tag, filter_or_none):
+    """Get the tags of the subtrees of a root which a filter may select.
+
+    :param root_tag: The tag of the root.
+    :param filter_or_none: A filter element or None.
+    :return: A list of tags, or None if any subtree may be selected.
+    """
+    if filter_or_none is None:
+        return None
+    if filter_or_none.get(qmap("nc") + "type", "subtree") != "subtree":
+        return None
+
+    tags = {}
+    localname = etree.QName(root_tag).localname
+    for felm in filter_or_none.iterchildren(tag=etree.Element):
+        # A filter without namespace matches any.
+        if felm.tag not in (root_tag, localname):
+            continue
+        children = [x for x in felm if isinstance(x.tag, str)]
+        # A root with no child selection selects everything.
+        if not children:
+            return None
+        for child in children:
+            # A filter without namespace matches any.
+            if child.tag[0] != "{":
+                return None
+            tags[child.tag] = True
+    return list(tags)
+
+
+__docformat__ = "restructuredtext en"
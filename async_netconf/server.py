@@ -17,10 +17,14 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
-import io
+import asyncio
+import collections
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import sys
+import time
 import traceback
 from typing import Optional
 from lxml import etree
@@ -30,6 +34,7 @@ from async_netconf import base
 import netconf.error as ncerror
 from async_netconf import NSMAP
 from async_netconf import qmap
+from async_netconf import compile_xpath
 from async_netconf import util
 
 if sys.platform == 'win32' and sys.version_info < (3, 5):
@@ -44,23 +49,206 @@ except ImportError:
     have_pam = False
 
 
+def _children_params(unused_session, unused_rpc, rpc_method):
+    return rpc_method.getchildren()
+
+
+def _get_params(unused_session, rpc, rpc_method):
+    params = rpc_method.getchildren()
+    if len(params) > 1:
+        # XXX need to specify all elements not known
+        raise ncerror.MalformedMessageRPCError(rpc)
+    if params and not util.filter_tag_match(params[0], "nc:filter"):
+        raise ncerror.UnknownElementProtoError(rpc, params[0])
+    if not params:
+        params = [None]
+    return params
+
+
+def _get_config_params(unused_session, rpc, rpc_method):
+    params = rpc_method.getchildren()
+    paramslen = len(params)
+    if paramslen > 2:
+        # XXX Should be ncerror.UnknownElementProtoError? for each?
+        raise ncerror.MalformedMessageRPCError(rpc)
+    source_param = rpc_method.find("nc:source", namespaces=NSMAP)
+    if source_param is None:
+        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:source"))
+    filter_param = None
+    if paramslen == 2:
+        filter_param = rpc_method.find("nc:filter", namespaces=NSMAP)
+        if filter_param is None:
+            unknown_elm = params[0] if params[0] != source_param else params[1]
+            raise ncerror.UnknownElementProtoError(rpc, unknown_elm)
+    return [source_param, filter_param]
+
+
+def _target_params(unused_session, rpc, rpc_method):
+    params = rpc_method.getchildren()
+    if len(params) != 1:
+        raise ncerror.MalformedMessageRPCError(rpc)
+    target_param = rpc_method.find("nc:target", namespaces=NSMAP)
+    if target_param is None:
+        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:target"))
+    elms = target_param.getchildren()
+    if len(elms) != 1:
+        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:target"))
+    lock_target = elms[0].tag.replace(qmap('nc'), "")
+    if lock_target not in ["running", "candidate"]:
+        raise ncerror.BadElementProtoError(rpc, util.qname("nc:target"))
+    return [lock_target]
+
+
+class RPCHandler(object):
+    """The handling of an RPC by a server.
+
+    :param name: The RPC name, qualified unless in the netconf base namespace.
+    :param method: The rpc_* function of the methods class, called with the
+                   methods object first, or None if not implemented.
+    :param validator: Called with the session, the rpc element and the RPC
+                      method element, returns the parameters to call the method
+                      with or raises `error.RPCServerError`.
+    """
+    __slots__ = ("name", "method", "validator")
+
+    def __init__(self, name, method, validator):
+        self.name = name
+        self.method = method
+        self.validator = validator
+
+
+class RPCDispatcher(object):
+    """Maps the qualified tags of received RPCs to their handling.
+
+    The table is built once from the rpc_* methods of the methods class, so all
+    objects of the class share it. RPCs outside the netconf base namespace are
+    looked up by their local name the first time they are received, and added
+    if implemented.
+
+    :param methods_class: The class which implements the rpc_* methods.
+    :param validators: The validators by qualified tag, by default those of the
+                       netconf base RPCs.
+    :param dispatchers: The dispatchers sharing ``validators`` by methods class,
+                        see `get_dispatcher`.
+    """
+    max_handlers = 1024
+
+    def __init__(self, methods_class, validators=None, dispatchers=None):
+        self.methods_class = methods_class
+        if validators is None:
+            validators = {
+                qmap('nc') + "get": _get_params,
+                qmap('nc') + "get-config": _get_config_params,
+                qmap('nc') + "lock": _target_params,
+                qmap('nc') + "unlock": _target_params,
+            }
+        self.validators = validators
+        self.dispatchers = dispatchers if dispatchers is not None else {}
+        self.dispatchers[methods_class] = self
+        self.handlers = {}
+        for attr in dir(methods_class):
+            if attr.startswith("rpc_"):
+                self._add_handler(qmap('nc') + attr[4:].replace('_', '-'))
+        for tag in list(self.validators):
+            self._add_handler(tag)
+        for name in NetconfServerSession.handled_rpc_methods:
+            self._add_handler(qmap('nc') + name)
+
+    def get_dispatcher(self, methods_class):
+        """Get the dispatcher for another methods class.
+
+        It is created when first needed and shares the validators, including
+        those added later to any of the dispatchers sharing them.
+
+        :param methods_class: The class which implements the rpc_* methods.
+        :rtype: `RPCDispatcher`
+        """
+        dispatcher = self.dispatchers.get(methods_class)
+        if dispatcher is None:
+            dispatcher = RPCDispatcher(methods_class, self.validators, self.dispatchers)
+        return dispatcher
+
+    def add_validator(self, tag, validator):
+        """Validate the parameters of an RPC before calling its method.
+
+        :param tag: The tag of the RPC (e.g., "sys:system-restart").
+        :param validator: Called with the session, the rpc element and the RPC
+                          method element, returns the parameters to call the
+                          method with or raises `error.RPCServerError`.
+        """
+        tag = util.qname(tag).text
+        self.validators[tag] = validator
+        for dispatcher in self.dispatchers.values():
+            dispatcher._add_handler(tag).validator = validator  # pylint: disable=W0212
+
+    def lookup(self, tag):
+        """Get the handling of an RPC.
+
+        :param tag: The qualified tag of the RPC method element.
+        :return: The handling of the RPC.
+        :rtype: `RPCHandler`
+        """
+        try:
+            return self.handlers[tag]
+        except KeyError:
+            pass
+        handler = self._get_handler(tag)
+        # Only remember implemented RPCs so clients cannot grow the table at will.
+        if handler.method is not None and len(self.handlers) < self.max_handlers:
+            self.handlers[tag] = handler
+        return handler
+
+    def _add_handler(self, tag):
+        handler = self.handlers.get(tag)
+        if handler is None:
+            handler = self.handlers[tag] = self._get_handler(tag)
+        return handler
+
+    def _get_handler(self, tag):
+        name = tag.replace(qmap('nc'), "")
+        # Handle any namespaces or prefixes in the tag, other than "nc" which
+        # was removed above. Of course, this does not handle namespace
+        # collisions, but that seems reasonable for now.
+        method_name = "rpc_" + name.rpartition("}")[-1].replace('-', '_')
+        method = getattr(self.methods_class, method_name, None)
+        return RPCHandler(name, method, self.validators.get(tag, _children_params))
+
 
 class NetconfServerSession(base.NetconfSession):
     """Netconf Server-side session with a client.
 
     This object will be passed to a the server RPC methods.
+
+    An rpc_* method may return an iterator or async iterator of elements (or
+    of already serialized XML as bytes) instead of an element. The reply is
+    then serialized and sent as the items are produced, and messages
+    received meanwhile are handled once it is complete. It may also return
+    the already serialized content of the rpc-reply as bytes, e.g., from a
+    `datastore.ReplyCache`.
     """
     handled_rpc_methods = set(["close-session", "lock", "kill-session", "unlock"])
+    is_server = True
 
-    def __init__(self, stream, server, unused_extra_args, debug):
+    def __init__(self, stream, server, unused_extra_args, debug, methods=None):
         self.server = server
         #print("NetconfServerSession.__init__")
         sid = self.server._allocate_session_id()
         if debug:
             logger.debug("NetconfServerSession: Creating session-id %s", str(sid))
-        super().__init__(stream, debug, sid)
+        super().__init__(stream,
+                         debug,
+                         sid,
+                         stream_parse=server.stream_parse,
+                         msg_format=server.msg_format)
 
-        self.methods = server.server_methods
+        self.methods = methods if methods is not None else server.server_methods
+        self.dispatcher = server.get_dispatcher(self.methods)
+
+        # Streamed replies
+        self.reply_task = None
+        self.pending_msgs = collections.deque()
+        self.writable = asyncio.Event()
+        self.writable.set()
 
         if self.debug:
             logger.debug("%s: Client session-id %s created", str(self), str(sid))
@@ -108,17 +296,116 @@ class NetconfServerSession(base.NetconfSession):
         externally the return value from the rpc_* methods will be returned
         using this method.
         """
+        if hasattr(rpc_reply, "__aiter__"):
+            self._start_rpc_reply_stream(rpc_reply.__aiter__(), origmsg)
+            return
+        if hasattr(rpc_reply, "__next__"):
+            self._start_rpc_reply_stream(rpc_reply, origmsg)
+            return
+
+        if rpc_reply is None:
+            # e.g., rpc_lock and rpc_unlock return None on success.
+            rpc_reply = etree.Element("ok")
         reply = etree.Element(qmap('nc') + "rpc-reply", attrib=origmsg.attrib, nsmap=origmsg.nsmap)
+        if isinstance(rpc_reply, (bytes, bytearray)):
+            # Already serialized content, e.g., from a reply cache.
+            reply.text = ""
+            head, tail = self.msg_format.tostring(reply).rsplit(b"</", 1)
+            ucode = b"".join((head, rpc_reply, b"</", tail))
+            if self.debug:
+                logger.debug("%s: Sending RPC-Reply: %s", str(self), str(ucode))
+            self.send_message(ucode)
+            return
         try:
             rpc_reply.getchildren  # pylint: disable=W0104
             reply.append(rpc_reply)
         except AttributeError:
             reply.extend(rpc_reply)
-        ucode = etree.tostring(reply, pretty_print=True)
+        ucode = self.msg_format.tostring(reply)
         if self.debug:
             logger.debug("%s: Sending RPC-Reply: %s", str(self), str(ucode))
         self.send_message(ucode)
 
+    def _start_rpc_reply_stream(self, items, origmsg):
+        self.reply_task = asyncio.ensure_future(self._stream_rpc_reply(items, origmsg))
+
+    async def _stream_rpc_reply(self, items, origmsg):
+        """Serialize and send the rpc-reply for an rpc_* method that returned an
+        (async) iterator, as the items are produced.
+        """
+
+        end = object()
+
+        async def next_item():
+            if hasattr(items, "__anext__"):
+                try:
+                    return await items.__anext__()
+                except StopAsyncIteration:
+                    return end
+            return next(items, end)
+
+        def get_error(ex):
+            if isinstance(ex, ncerror.RPCServerError):
+                return ex
+            return ncerror.RPCSvrException(origmsg, ex)
+
+        try:
+            # Errors before anything is produced get the usual error reply.
+            try:
+                item = await next_item()
+            except Exception as ex:
+                self._send_rpc_reply_error(get_error(ex))
+                return
+
+            writer = base.NetconfStreamWriter(self.pkt_stream, self.new_framing)
+            with etree.xmlfile(writer, encoding="utf-8", buffered=False) as xf:
+                if self.msg_format.xml_declaration:
+                    xf.write_declaration()
+                with xf.element(qmap('nc') + "rpc-reply",
+                                attrib=dict(origmsg.attrib),
+                                nsmap=origmsg.nsmap):
+                    while item is not end:
+                        if isinstance(item, (bytes, bytearray)):
+                            writer.write(item)
+                        elif etree.iselement(item):
+                            xf.write(item)
+                        else:
+                            raise TypeError("Can not stream {!r} in an rpc-reply".format(item))
+                        if not self.writable.is_set():
+                            writer.flush()
+                            await self.writable.wait()
+                        try:
+                            item = await next_item()
+                        except Exception as ex:
+                            # Part of the reply is sent so finish it with the error.
+                            if self.debug:
+                                logger.debug("%s: Error while streaming reply: %s", str(self),
+                                             str(ex))
+                            for elm in get_error(ex).reply:
+                                xf.write(elm)
+                            break
+            writer.close()
+        except ncerror.ChannelClosed:
+            if self.debug:
+                logger.debug("%s: Channel closed while streaming reply", str(self))
+        except Exception as ex:
+            # Part of the reply may be sent, so it can't be finished.
+            logger.error("%s: Closing session due to error while streaming reply: %s", str(self),
+                         str(ex))
+            self.close()
+        finally:
+            self.reply_task = None
+            self._handle_pending_messages()
+
+    def _handle_pending_messages(self):
+        """Handle messages that arrived while a streamed reply was being sent."""
+        try:
+            while self.pending_msgs and self.reply_task is None and self.pkt_stream is not None:
+                self._reader_handle_message(self.pending_msgs.popleft())
+        except Exception as ex:
+            logger.error("%s: Closing session due to error: %s", str(self), str(ex))
+            self.close()
+
     def _rpc_not_implemented(self, unused_session, rpc, *unused_params):
         if self.debug:
             msg_id = rpc.get(qmap("nc") + 'message-id')
@@ -126,8 +413,7 @@ class NetconfServerSession(base.NetconfSession):
         raise ncerror.OperationNotSupportedProtoError(rpc)
 
     def _send_rpc_reply_error(self, error):
-        #TODO: Need to look over the API bytes vs. str boundary
-        self.send_message(error.get_reply_msg().encode('utf-8'))
+        self.send_message(error.get_reply_msg(self.msg_format))
 
     def _reader_exits(self):
         if self.debug:
@@ -138,17 +424,22 @@ class NetconfServerSession(base.NetconfSession):
         #if not self.session_open:
         #    return
 
+        if self.reply_task is not None:
+            # A streamed reply is being sent, handle this after it.
+            self.pending_msgs.append(msg)
+            return
+
         # Any error with XML encoding here is going to cause a session close
         # Technically we should be able to return malformed message I think.
         try:
-            tree = etree.parse(io.BytesIO(msg.lstrip()))
+            tree = self._parse_message(msg)
             if not tree:
                 raise ncerror.SessionError(msg, "Invalid XML from client.")
         except etree.XMLSyntaxError:
             logger.warning("Closing session due to malformed message")
             raise ncerror.SessionError(msg, "Invalid XML from client.")
 
-        rpcs = tree.xpath("/nc:rpc", namespaces=NSMAP)
+        rpcs = compile_xpath("/nc:rpc")(tree)
         if not rpcs:
             raise ncerror.SessionError(msg, "No rpc found")
 
@@ -169,19 +460,19 @@ class NetconfServerSession(base.NetconfSession):
                     raise ncerror.MalformedMessageRPCError(rpc)
                 rpc_method = rpc_method[0]
 
-                rpcname = rpc_method.tag.replace(qmap('nc'), "")
-                params = rpc_method.getchildren()
-                paramslen = len(params)
+                handler = self.dispatcher.lookup(rpc_method.tag)
+                rpcname = handler.name
                 lock_target = None
 
                 if self.debug:
-                    logger.debug("%s: RPC: %s: paramslen: %s", str(self), rpcname, str(paramslen))
+                    logger.debug("%s: RPC: %s: paramslen: %s", str(self), rpcname,
+                                 str(len(rpc_method)))
 
                 if rpcname == "close-session":
                     # XXX should be RPC-unlocking if need be
                     if self.debug:
                         logger.debug("%s: Received close-session msg-id: %s", str(self), msg_id)
-                    sel._send_rpc_reply(etree.Element("ok"), rpc)
+                    self._send_rpc_reply(etree.Element("ok"), rpc)
                     self.close()
                     # XXX should we also call the user method if it exists?
                     return
@@ -193,84 +484,40 @@ class NetconfServerSession(base.NetconfSession):
                     self.close()
                     # XXX should we also call the user method if it exists?
                     return
-                elif rpcname == "get":
-                    # Validate GET parameters
-
-                    if paramslen > 1:
-                        # XXX need to specify all elements not known
-                        raise ncerror.MalformedMessageRPCError(rpc)
-                    if params and not util.filter_tag_match(params[0], "nc:filter"):
-                        raise ncerror.UnknownElementProtoError(rpc, params[0])
-                    if not params:
-                        params = [None]
-                elif rpcname == "get-config":
-                    # Validate GET-CONFIG parameters
-
-                    if paramslen > 2:
-                        # XXX Should be ncerror.UnknownElementProtoError? for each?
-                        raise ncerror.MalformedMessageRPCError(rpc)
-                    source_param = rpc_method.find("nc:source", namespaces=NSMAP)
-                    if source_param is None:
-                        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:source"))
-                    filter_param = None
-                    if paramslen == 2:
-                        filter_param = rpc_method.find("nc:filter", namespaces=NSMAP)
-                        if filter_param is None:
-                            unknown_elm = params[0] if params[0] != source_param else params[1]
-                            raise ncerror.UnknownElementProtoError(rpc, unknown_elm)
-                    params = [source_param, filter_param]
-                elif rpcname == "lock" or rpcname == "unlock":
-                    if paramslen != 1:
-                        raise ncerror.MalformedMessageRPCError(rpc)
-                    target_param = rpc_method.find("nc:target", namespaces=NSMAP)
-                    if target_param is None:
-                        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:target"))
-                    elms = target_param.getchildren()
-                    if len(elms) != 1:
-                        raise ncerror.MissingElementProtoError(rpc, util.qname("nc:target"))
-                    lock_target = elms[0].tag.replace(qmap('nc'), "")
-                    if lock_target not in ["running", "candidate"]:
-                        raise ncerror.BadElementProtoError(rpc, util.qname("nc:target"))
-                    params = [lock_target]
-
-                    if rpcname == "lock":
-                        logger.error("%s: Lock Target: %s", str(self), lock_target)
-                        # Try and obtain the lock.
-                        locksid = self.server.lock_target(self, lock_target)
-                        if locksid:
-                            raise ncerror.LockDeniedProtoError(rpc, locksid)
-                    elif rpcname == "unlock":
-                        logger.error("%s: Unlock Target: %s", str(self), lock_target)
-                        # Make sure we have the lock.
-                        locksid = self.server.is_target_locked(lock_target)
-                        if locksid != self.session_id:
-                            # An odd error to return
-                            raise ncerror.LockDeniedProtoError(rpc, locksid)
+
+                params = handler.validator(self, rpc, rpc_method)
+
+                if rpcname == "lock":
+                    lock_target = params[0]
+                    logger.error("%s: Lock Target: %s", str(self), lock_target)
+                    # Try and obtain the lock.
+                    locksid = self.server.lock_target(self, lock_target)
+                    if locksid:
+                        raise ncerror.LockDeniedProtoError(rpc, locksid)
+                elif rpcname == "unlock":
+                    lock_target = params[0]
+                    logger.error("%s: Unlock Target: %s", str(self), lock_target)
+                    # Make sure we have the lock.
+                    locksid = self.server.is_target_locked(lock_target, self)
+                    if locksid != self.session_id:
+                        # An odd error to return
+                        raise ncerror.LockDeniedProtoError(rpc, locksid)
 
                 #------------------
                 # Call the method.
                 #------------------
 
                 try:
-                    # Handle any namespaces or prefixes in the tag, other than
-                    # "nc" which was removed above. Of course, this does not handle
-                    # namespace collisions, but that seems reasonable for now.
-                    rpcname = rpcname.rpartition("}")[-1]
-                    method_name = "rpc_" + rpcname.replace('-', '_')
-                    method = getattr(self.methods, method_name, None)
-
-                    if method is None:
-                        if rpcname in self.handled_rpc_methods:
-                            self._send_rpc_reply(etree.Element("ok"), rpc)
-                            method = None
-                        else:
-                            method = self._rpc_not_implemented
-
+                    method = handler.method
                     if method is not None:
                         if self.debug:
-                            logger.debug("%s: Calling method: %s", str(self), method_name)
-                        reply = method(self, rpc, *params)
+                            logger.debug("%s: Calling method: %s", str(self), method.__name__)
+                        reply = method(self.methods, self, rpc, *params)
                         self._send_rpc_reply(reply, rpc)
+                    elif rpcname in self.handled_rpc_methods:
+                        self._send_rpc_reply(etree.Element("ok"), rpc)
+                    else:
+                        self._rpc_not_implemented(self, rpc, *params)
                 except Exception:
                     # If user raised error unlock if this was lock
                     if rpcname == "lock" and lock_target:
@@ -285,7 +532,7 @@ class NetconfServerSession(base.NetconfSession):
                 if self.new_framing:
                     if self.debug:
                         logger.debug("%s: MalformedMessageRPCError: %s", str(self), str(msgerr))
-                    self.send_message(msgerr.get_reply_msg())
+                    self.send_message(msgerr.get_reply_msg(self.msg_format))
                 else:
                     # If we are 1.0 we have to simply close the connection
                     # as we are not allowed to send this error
@@ -335,7 +582,9 @@ class NetconfMethods(object):
         :type rpc: `lxml.Element`
         :param filter_or_none: The filter element if present.
         :type filter_or_none: `lxml.Element` or None
-        :return: `lxml.Element` of "nc:data" type containing the requested state.
+        :return: `lxml.Element` of "nc:data" type containing the requested state,
+                 or an (async) iterator streaming the content of the rpc-reply.
+                 The nc:data start and end tags may then be yielded as bytes.
         :raises: `error.RPCServerError` which will be used to construct an XML error response.
         """
         raise ncerror.OperationNotSupportedProtoError(rpc)
@@ -352,7 +601,9 @@ class NetconfMethods(object):
         :type source_elm: `lxml.Element`
         :param filter_or_none: The filter element if present.
         :type filter_or_none: `lxml.Element` or None
-        :return: `lxml.Element` of "nc:data" type containing the requested state.
+        :return: `lxml.Element` of "nc:data" type containing the requested state,
+                 or an (async) iterator streaming the content of the rpc-reply.
+                 The nc:data start and end tags may then be yielded as bytes.
         :raises: `error.RPCServerError` which will be used to construct an XML error response.
         """
         raise ncerror.OperationNotSupportedProtoError(rpc)
@@ -457,15 +708,21 @@ class NetconfMethods(object):
 
 
 class SSHServerSession(asyncssh.SSHServerSession):
-    def __init__(self, server):
+    def __init__(self, server, methods=None):
         #print("SSHServerSession")
         self.server = server
+        self.methods = methods
     def connection_made(self, chan):
-        self.session = NetconfServerSession(chan, self.server, None, True)
+        self.session = NetconfServerSession(chan, self.server, None, self.server.debug,
+                                            self.methods)
     def subsystem_requested(self, subsystem):
         return subsystem == 'netconf'
     def data_received(self, data, datatype):
         self.session.data_received(data, datatype)
+    def pause_writing(self):
+        self.session.writable.clear()
+    def resume_writing(self):
+        self.session.writable.set()
     def eof_received(self):
         print("EOF")
         self._chan.exit(0)
@@ -477,10 +734,13 @@ class MySSHServer(asyncssh.SSHServer):
         self.server = server
         self.server_ctl = server_ctl
         self.server_methods = server_methods
+        self.conn = None
+        self.username = None
         #print(type(self), "__init__")
         super().__init__()
 
     def connection_made(self, conn: asyncssh.SSHServerConnection) -> None:
+        self.conn = conn
         print('SSH connection received from %s.' %
                   conn.get_extra_info('peername')[0])
 
@@ -505,6 +765,7 @@ class MySSHServer(asyncssh.SSHServer):
             print('SSH connection closed.')
 
     def begin_auth(self, username: str) -> bool:
+        self.username = username
         # If the user's password is the empty string, no auth is required
         return self.server_ctl.get(username) != ''
 
@@ -517,7 +778,48 @@ class MySSHServer(asyncssh.SSHServer):
         return crypt.crypt(password, pw) == pw
 
     def session_requested(self):
-        return SSHServerSession(self.server)
+        port = self.conn.get_extra_info('sockname')[1]
+        return SSHServerSession(self.server, self.server.get_methods(self.username, port))
+
+
+# (modification time, options) by host key file, shared by the servers using
+# the same key.
+_SERVER_OPTIONS = {}
+
+
+def server_options(host_key, **kwargs):
+    """Create SSH server options which can be shared by `NetconfSSHServer` instances.
+
+    The host key is read and parsed once here rather than each time a server
+    listens.
+
+    :param host_key: The file containing the host key or the loaded key.
+    :param kwargs: Any other `asyncssh.SSHServerConnectionOptions` to set.
+    :return: The options.
+    :rtype: `asyncssh.SSHServerConnectionOptions`
+    """
+    if isinstance(host_key, str):
+        host_key = asyncssh.read_private_key(host_key)
+    if host_key is not None:
+        kwargs["server_host_keys"] = [host_key]
+    return asyncssh.SSHServerConnectionOptions(line_editor=False,
+                                               allow_scp=False,
+                                               allow_pty=False,
+                                               **kwargs)
+
+
+def _get_server_options(host_key):
+    # The key is read again once the file changes, e.g., when rotated.
+    mtime = os.stat(host_key).st_mtime_ns if host_key is not None else None
+    entry = _SERVER_OPTIONS.get(host_key)
+    if entry is None or entry[0] != mtime:
+        entry = _SERVER_OPTIONS[host_key] = (mtime, server_options(host_key))
+    return entry[1]
+
+
+def clear_server_options():
+    """Forget the host keys read by servers listening without ``options``."""
+    _SERVER_OPTIONS.clear()
 
 
 class NetconfSSHServer:
@@ -526,16 +828,55 @@ class NetconfSSHServer:
     :param server_ctl: The object used for authenticating connections to the server.
     :type server_ctl: `ssh.ServerInterface`
     :param server_methods: An object which implements servers the rpc_* methods.
-    :param port: The port to bind the server to.
-    :param host_key: The file containing the host key.
+    :param port: The port to bind the server to, or a sequence (e.g., range) of ports.
+    :param host_key: The file containing the host key. The file is read once,
+                     and again when modified, and the key shared with other
+                     servers using it (see `clear_server_options`).
     :param debug: True to enable debug logging.
+    :param stream_parse: True to parse received messages as their data arrives
+                         rather than once they are complete.
+    :param msg_format: How to serialize sent messages, by default compact XML
+                       with an XML declaration.
+    :type msg_format: `async_netconf.base.MessageFormat`
+    :param session_ids: Where to allocate session-ids from, by default 1, 2, ...
+    :type session_ids: `SessionIdAllocator`
+    :param device_methods: A mapping to the rpc_* methods objects of the devices
+                           served. Connections for devices not in it use
+                           ``server_methods``.
+    :param route_by: What selects the device of a connection in ``device_methods``,
+                     the SSH "username" or the local "port".
+    :param options: SSH server options (see `server_options`) to use instead of
+                    those for ``host_key``.
+    :type options: `asyncssh.SSHServerConnectionOptions`
     """
-    def __init__(self, server_ctl=None, server_methods=None, port=830, host_key=None, debug=False):
+    def __init__(self,
+                 server_ctl=None,
+                 server_methods=None,
+                 port=830,
+                 host_key=None,
+                 debug=False,
+                 stream_parse=False,
+                 msg_format=None,
+                 session_ids=None,
+                 device_methods=None,
+                 route_by="username",
+                 options=None):
         self.server_ctl = server_ctl
         self.server_methods = server_methods if server_methods is not None else NetconfMethods()
         self.port = port
         self.host_key = host_key
+        self.options = options
         self.debug = debug
+        self.stream_parse = stream_parse
+        self.msg_format = msg_format if msg_format is not None else base.MessageFormat()
+        self.dispatcher = RPCDispatcher(type(self.server_methods))
+        if route_by not in ("username", "port"):
+            raise ValueError("Unknown route_by: {}".format(route_by))
+        self.device_methods = device_methods
+        self.route_by = route_by
+        self.device_locks = {}
+        self.acceptors = []
+        self.session_ids = session_ids
         self.session_id = 1
 #        self.session_locks_lock = threading.Lock()
         self.session_locks = {
@@ -550,19 +891,48 @@ class NetconfSSHServer:
         return MySSHServer(self, self.server_ctl, self.server_methods)
 
     async def listen(self):
-        options = asyncssh.SSHServerConnectionOptions(
-                            line_editor=False,
-                            allow_scp=False,
-                            allow_pty=False
-                            )
+        options = self.options
+        if options is None:
+            options = _get_server_options(self.host_key)
 
-        await asyncssh.listen('', self.port, reuse_port=True,
+        ports = [self.port] if isinstance(self.port, int) else self.port
+        self.acceptors = await asyncio.gather(*[
+            asyncssh.listen('', port, reuse_port=True,
                             options= options,
                             server_factory=self.serv_factory,
-                            server_host_keys=self.host_key,
                             encoding=None) # Enables bytes mode
+            for port in ports])
+        if not self.port:
+            self.port = self.acceptors[0].get_port()
+
+    def close(self):
+        for acceptor in self.acceptors:
+            acceptor.close()
+        self.acceptors = []
+
+    def get_methods(self, username, port):
+        """Get the rpc_* methods object for a connection.
+
+        :param username: The SSH username of the connection.
+        :param port: The local port of the connection.
+        :return: The methods object of the device connected to.
+        """
+        if self.device_methods is None:
+            return self.server_methods
+        key = port if self.route_by == "port" else username
+        return self.device_methods.get(key, self.server_methods)
+
+    def get_dispatcher(self, methods):
+        """Get the `RPCDispatcher` for a methods object.
+
+        Devices with methods objects of the same class share one, created from
+        ``dispatcher`` when first needed.
+        """
+        return self.dispatcher.get_dispatcher(type(methods))
 
     def _allocate_session_id(self):
+        if self.session_ids is not None:
+            return self.session_ids.allocate()
         #TODO: Async - with self.lock:
         sid = self.session_id
         self.session_id += 1
@@ -578,10 +948,11 @@ class NetconfSSHServer:
         locked = []
         #TODO: Async - with self.lock:
         #    with self.session_locks_lock:
+        session_locks = self._get_session_locks(session)
         sid = session.session_id
-        for target in self.session_locks:
-            if self.session_locks[target] == sid:
-                self.session_locks[target] = 0
+        for target in session_locks:
+            if session_locks[target] == sid:
+                session_locks[target] = 0
                 locked.append(target)
         return locked
 
@@ -589,8 +960,9 @@ class NetconfSSHServer:
         """Unlock the given target."""
         #TODO: Async - with self.lock:
             #with self.session_locks_lock:
-        if self.session_locks[target] == session.session_id:
-            self.session_locks[target] = 0
+        session_locks = self._get_session_locks(session)
+        if session_locks[target] == session.session_id:
+            session_locks[target] = 0
             return True
         return False
 
@@ -600,18 +972,185 @@ class NetconfSSHServer:
         """
         #with self.lock:
         #    with self.session_locks_lock:
-        if self.session_locks[target]:
-            return self.session_locks[target]
-        self.session_locks[target] = session.session_id
+        session_locks = self._get_session_locks(session)
+        if session_locks[target]:
+            return session_locks[target]
+        session_locks[target] = session.session_id
         return 0
 
-    def is_target_locked(self, target):
-        """Returns the sesions ID who owns the lock or 0 if not locked."""
+    def is_target_locked(self, target, session=None):
+        """Returns the sesions ID who owns the lock or 0 if not locked.
+
+        The locks are those of the device of the session if given."""
         #TODO: Async -with self.lock:
         #    with self.session_locks_lock:
-        if target not in self.session_locks:
+        session_locks = self._get_session_locks(session)
+        if target not in session_locks:
             return None
-        return self.session_locks[target]
+        return session_locks[target]
+
+    def _get_session_locks(self, session):
+        # Each device has its own datastores and so its own locks.
+        if session is None or session.methods is self.server_methods:
+            return self.session_locks
+        session_locks = self.device_locks.get(session.methods)
+        if session_locks is None:
+            session_locks = self.device_locks[session.methods] = {
+                "running": 0,
+                "candidate": 0,
+            }
+        return session_locks
+
+
+class SessionIdAllocator(object):
+    """Allocate session-ids from one part of the session-id space.
+
+    The ids first, first + step, first + 2 * step, ... are allocated so
+    allocators with the same step and different first ids never allocate the
+    same id.
+
+    :param first: The first id to allocate.
+    :param step: The distance between allocated ids.
+    :param allocated: A ``.value`` holder (e.g., `multiprocessing.RawValue`)
+                      counting the ids allocated so far. Sharing it with a
+                      process that replaces this one continues the sequence.
+    """
+
+    def __init__(self, first, step, allocated):
+        self.first = first
+        self.step = step
+        self.allocated = allocated
+
+    def allocate(self):
+        count = self.allocated.value
+        self.allocated.value = count + 1
+        return self.first + count * self.step
+
+
+async def _run_worker(server_factory, ports, session_ids):
+    servers = [server_factory(port, session_ids) for port in ports]
+    try:
+        await asyncio.gather(*[server.listen() for server in servers])
+        await asyncio.get_running_loop().create_future()
+    finally:
+        for server in servers:
+            server.close()
+
+
+def _worker_main(server_factory, ports, session_ids):
+    asyncio.run(_run_worker(server_factory, ports, session_ids))
+
+
+class NetconfMultiProcessServer(object):
+    """Run netconf servers in worker processes each with their own event loop.
+
+    Each worker calls ``server_factory(port, session_ids)`` for each port it
+    serves and then calls ``listen()`` on the returned servers (e.g.,
+    `NetconfSSHServer` instances created with ``session_ids``). Session-ids
+    are partitioned among the workers so that they are unique across all of
+    them. Workers that exit are restarted.
+
+    :param server_factory: Called with a port and a `SessionIdAllocator` to
+                           create a server in a worker.
+    :param ports: A single port that all workers listen on (using
+                  SO_REUSEPORT), or a sequence (e.g., range) of ports divided
+                  among the workers.
+    :param workers: The number of worker processes, by default the CPU count.
+    :param restart_delay: The minimum number of seconds between restarts of a
+                          worker.
+    """
+
+    def __init__(self, server_factory, ports, workers=None, restart_delay=1.0):
+        self.server_factory = server_factory
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if isinstance(ports, int):
+            self.ports = [[ports]] * workers
+        else:
+            ports = list(ports)
+            workers = min(workers, len(ports))
+            count, extra = divmod(len(ports), workers)
+            self.ports = []
+            for i in range(workers):
+                start = i * count + min(i, extra)
+                self.ports.append(ports[start:start + count + (i < extra)])
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.allocated = [multiprocessing.RawValue("Q", 0) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.started = [0] * workers
+        self.restarts = 0
+
+    def __str__(self):
+        return "NetconfMultiProcessServer(workers={})".format(self.workers)
+
+    def start(self):
+        """Start any worker processes which are not running."""
+        for i in range(self.workers):
+            process = self.processes[i]
+            if process is not None:
+                if process.is_alive():
+                    continue
+                logger.warning("%s: Worker %d exited with %s", str(self), i,
+                               str(process.exitcode))
+                process.join()
+                self.restarts += 1
+            session_ids = SessionIdAllocator(i + 1, self.workers, self.allocated[i])
+            process = multiprocessing.Process(target=_worker_main,
+                                              args=(self.server_factory, self.ports[i],
+                                                    session_ids),
+                                              daemon=True)
+            process.start()
+            self.processes[i] = process
+            self.started[i] = time.monotonic()
+
+    def supervise(self, timeout=None):
+        """Restart workers as they exit.
+
+        Returns at once if no workers are started, e.g., before `start` or
+        after `close`.
+
+        :param timeout: Seconds to supervise for or None to do so forever.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if end is not None and now >= end:
+                return
+            wait = None if end is None else end - now
+            sentinels = [p.sentinel for p in self.processes if p is not None]
+            if not sentinels:
+                return
+            if not multiprocessing.connection.wait(sentinels, wait):
+                continue
+            exited = [
+                i for i, p in enumerate(self.processes) if p is not None and not p.is_alive()
+            ]
+            if not exited:
+                continue
+            # Avoid spinning on workers that fail right away.
+            delay = max(self.started[i] for i in exited) + self.restart_delay - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.start()
+
+    def serve_forever(self):
+        """Start the workers and restart them as they exit until interrupted."""
+        self.start()
+        try:
+            self.supervise()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the worker processes."""
+        for process in self.processes:
+            if process is not None:
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
+        self.processes = [None] * self.workers
 
 
 __author__ = 'Christian Hopps'
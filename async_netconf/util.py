@@ -20,8 +20,9 @@ from __future__ import absolute_import, division, unicode_literals, print_functi
 import copy
 import logging
 from lxml import etree
-from async_netconf import NSMAP, qmap
+from async_netconf import NSMAP, qmap, compile_xpath
 from netconf import error
+from netconf.util import _copy_selected, subtree_filter_result
 
 # Tries to somewhat implement RFC6241 filtering
 logger = logging.getLogger(__name__)
@@ -147,46 +148,25 @@ def xpath_filter_result(data, xpath):
     '<data><devs><dev><name>dev1</name><slots>1</slots></dev><dev><name>dev2</name><slots>2</slots></dev></devs></data>'
     """
 
-    # First get a copy we can safely modify.
-    data = copy.deepcopy(data)
-
+    # Evaluate with each child as the root, which lxml does without moving it.
     results = []
-    children = []
-
-    # XXX Need to reset the namespace declarations to those found in the context of the filter node.
-
-    # Have to re-root the children to avoid having to match "/nc:data"
-    for child in data.getchildren():
-        data.remove(child)
-        children.append(child)
-        newtree = etree.ElementTree(child)
-        results.extend(newtree.xpath(xpath, namespaces=NSMAP))
-
-    # Add the children of data back.
-    for child in children:
-        data.append(child)
-
-    # Mark the tree up
+    for child in data.iterchildren(tag=etree.Element):
+        for result in etree.ElementTree(child).xpath(xpath, namespaces=NSMAP):
+            if isinstance(result, etree._Element):  # pylint: disable=W0212
+                results.append(result)
+
+    # Selected elements are copied whole and their ancestors without other children.
+    selected = set(results)
+    ancestors = set()
     for result in results:
-        # Mark all children
-        for e in result.iterdescendants():
-            e.attrib['__filter_marked__'] = ""
-        # Mark this element and all parents
-        while result is not data:
-            result.attrib['__filter_marked__'] = ""
-            result = result.getparent()
-
-    def prunedecendants(e):
-        for child in e.getchildren():
-            if '__filter_marked__' not in child.attrib:
-                e.remove(child)
-            else:
-                prunedecendants(child)
-                del child.attrib['__filter_marked__']
-
-    prunedecendants(data)
+        parent = result.getparent()
+        while parent is not data and parent not in ancestors:
+            if parent in selected:
+                break
+            ancestors.add(parent)
+            parent = parent.getparent()
 
-    return data
+    return _copy_selected(data, selected, ancestors, None)
 
 
 def _get_xpath_tag(nsmap, ns, child):
@@ -276,13 +256,15 @@ def filter_to_xpath(felm):
     return result
 
 
-def filter_results(rpc, data, filter_or_none, debug=False):
+def filter_results(rpc, data, filter_or_none, debug=False, index=None):
     """Check for a user filter and prune the result data accordingly.
 
     :param rpc: An RPC message element.
     :param data: The data to filter.
     :param filter_or_none: Filter element or None.
     :type filter_or_none: `lxml.Element`
+    :param index: A list key index of the data for subtree filters, see
+                  `subtree_filter_result`.
     """
     if filter_or_none is None:
         return data
@@ -296,7 +278,9 @@ def filter_results(rpc, data, filter_or_none, debug=False):
         if not filter_or_none.getchildren():
             return elm("nc:data")
 
-        xpf = filter_to_xpath(filter_or_none)
+        if debug:
+            logger.debug("Filtering on subtree: %s", etree.tounicode(filter_or_none))
+        return subtree_filter_result(data, filter_or_none, index)
 
     elif filter_or_none.attrib[type_attr_name] == "xpath":
         if select_attr_name not in filter_or_none.attrib:
@@ -492,7 +476,7 @@ def filter_leaf_allows(filter_elm, xpath, value):
         return True
 
     # No match or multiple matches not allowed for leaf.
-    flist = filter_elm.xpath(xpath, namespaces=NSMAP)
+    flist = compile_xpath(xpath)(filter_elm)
     if not flist or len(flist) > 1:
         return False
     felm = flist[0]
@@ -515,6 +499,7 @@ def filter_list_iter(filter_list, key_xpath, keys):
     if filter_list is None:
         for key in keys:
             yield key, None
+        return
 
     try:
         # If this an element then make it a list of elements
@@ -524,8 +509,8 @@ def filter_list_iter(filter_list, key_xpath, keys):
         pass
 
     for filter_elm in filter_list:
-        filter_elms = [x for x in filter_elm.xpath(key_xpath, namespaces=NSMAP)]
-        filter_keys = [x.text for x in filter_elms]
+        filter_elms = compile_xpath(key_xpath)(filter_elm)
+        filter_keys = set(x.text for x in filter_elms)
         if not filter_keys:
             for key in keys:
                 yield key, filter_elm
@@ -17,16 +17,21 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
-from lxml.etree import register_namespace
+from lxml.etree import register_namespace, XPath
 
 MAXSSHBUF = 16 * 1024
 NSMAP = {}
 
+# Compiled XPath expressions, cleared when NSMAP changes.
+_XPATHS = {}
+_MAX_XPATHS = 1024
+
 
 def nsmap_add(prefix, namespace):
     "Add a prefix namespace mapping to the modules mapping dictionary"
     NSMAP[prefix] = namespace
     register_namespace(prefix, namespace)
+    _XPATHS.clear()
 
 
 def nsmap_update(nsdict):
@@ -34,11 +39,29 @@ def nsmap_update(nsdict):
     NSMAP.update(nsdict)
     for key, val in nsdict.items():
         register_namespace(key, val)
+    _XPATHS.clear()
 
 
 def qmap(key):
     return "{" + NSMAP[key] + "}"
 
 
+def compile_xpath(expr):
+    """Get the compiled form of an XPath expression using the prefixes in NSMAP.
+
+    The compiled expressions are cached until NSMAP changes.
+
+    :param expr: The xpath expression string.
+    :returns: The compiled expression (`lxml.etree.XPath`).
+    """
+    try:
+        return _XPATHS[expr]
+    except KeyError:
+        if len(_XPATHS) >= _MAX_XPATHS:
+            _XPATHS.clear()
+        xpath = _XPATHS[expr] = XPath(expr, namespaces=NSMAP)
+        return xpath
+
+
 # Add base spec namespace
 nsmap_add('nc', "urn:ietf:params:xml:ns:netconf:base:1.0")
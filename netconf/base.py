@@ -26,7 +26,7 @@ import threading
 import traceback
 from lxml import etree
 
-from netconf import NSMAP, MAXSSHBUF
+from netconf import NSMAP, MAXSSHBUF, compile_xpath
 from netconf.error import ChannelClosed, FramingError, SessionError
 import netconf.util as ncutil
 
@@ -107,6 +107,35 @@ def chunkit(msg, maxsend, minsend=0, pad="\n"):
     yield msg[right:]
 
 
+class MessageFormat(object):
+    """How a session serializes the messages it sends.
+
+    A server shares one of these among all its sessions.
+
+    :param pretty_print: True to indent the sent XML. This is easier for humans
+                         to read but larger and slower to produce.
+    :param xml_declaration: True to start each message with the XML declaration.
+    :param cache_hello: True to encode the server hello once and reuse it for all
+                        sessions. Only use this if the capabilities added by
+                        ``nc_append_capabilities`` do not change.
+    """
+
+    def __init__(self, pretty_print=False, xml_declaration=True, cache_hello=False):
+        self.pretty_print = pretty_print
+        self.xml_declaration = xml_declaration
+        self.cache_hello = cache_hello
+        self.hello = None
+
+    def tostring(self, elm):
+        """Serialize an element.
+
+        :param elm: The element to serialize.
+        :return: The serialized element.
+        :rtype: str
+        """
+        return etree.tounicode(elm, pretty_print=self.pretty_print)
+
+
 class NetconfTransportMixin(object):
     def connect(self):
         raise NotImplementedError()
@@ -263,8 +292,9 @@ class NetconfSession(object):
     # figure a way to factor the commonality. One issue is that this class can
     # be used with any transport not just SSH so where should it go?
 
-    def __init__(self, stream, debug, session_id, max_chunk=MAXSSHBUF):
+    def __init__(self, stream, debug, session_id, max_chunk=MAXSSHBUF, msg_format=None):
         self.debug = debug
+        self.msg_format = msg_format if msg_format is not None else MessageFormat()
         self.pkt_stream = NetconfFramingTransport(stream, max_chunk, debug)
         self.new_framing = False
         self.capabilities = set()
@@ -292,7 +322,9 @@ class NetconfSession(object):
             return
         if self.debug:
             logger.debug("Sending message (%d): %s", len(msg), msg)
-        pkt_stream.send_pdu(XML_HEADER + msg, self.new_framing)
+        if self.msg_format.xml_declaration:
+            msg = XML_HEADER + msg
+        pkt_stream.send_pdu(msg, self.new_framing)
 
     def _receive_message(self):
         # private method to receive a full message.
@@ -303,21 +335,33 @@ class NetconfSession(object):
         return pkt_stream.receive_pdu(self.new_framing)
 
     def send_hello(self, caplist, session_id=None):
+        msg_format = self.msg_format
+        if session_id is not None and msg_format.cache_hello:
+            if msg_format.hello is None:
+                hello = msg_format.tostring(self._get_hello(caplist, True))
+                # Keep it open so the session-id can be appended.
+                msg_format.hello = hello[:hello.rindex("</hello>")]
+            msg = "{}<session-id>{}</session-id></hello>".format(msg_format.hello, session_id)
+        else:
+            msg = self._get_hello(caplist, session_id is not None)
+            if session_id is not None:
+                msg.append(ncutil.leaf_elm("session-id", str(session_id)))
+            msg = msg_format.tostring(msg)
+
+        if self.debug:
+            logger.debug("%s: Sending HELLO", str(self))
+        self.send_message(msg)
+
+    def _get_hello(self, caplist, is_server):
         msg = ncutil.elm("hello", attrib={'xmlns': NSMAP['nc']})
         caps = ncutil.elm("capabilities")
         for cap in caplist:
             ncutil.subelm(caps, "capability").text = str(cap)
-        if session_id is not None:
+        if is_server:
             assert hasattr(self, "methods")
             self.methods.nc_append_capabilities(caps)  # pylint: disable=E1101
         msg.append(caps)
-
-        if self.debug:
-            logger.debug("%s: Sending HELLO", str(self))
-        if session_id is not None:
-            msg.append(ncutil.leaf_elm("session-id", str(session_id)))
-        msg = etree.tostring(msg)
-        self.send_message(msg.decode('utf-8'))
+        return msg
 
     def close(self):
         if self.debug:
@@ -358,7 +402,7 @@ class NetconfSession(object):
             # Parse reply
             tree = etree.parse(io.BytesIO(reply.encode('utf-8')))
             root = tree.getroot()
-            caps = root.xpath("//nc:hello/nc:capabilities/nc:capability", namespaces=NSMAP)
+            caps = compile_xpath("//nc:hello/nc:capabilities/nc:capability")(root)
 
             # Store capabilities
             for cap in caps:
@@ -372,7 +416,7 @@ class NetconfSession(object):
 
             # Get session ID.
             try:
-                session_id = root.xpath("//nc:hello/nc:session-id", namespaces=NSMAP)[0].text
+                session_id = compile_xpath("//nc:hello/nc:session-id")(root)[0].text
                 # If we are a server it is a failure to receive a session id.
                 if is_server:
                     raise SessionError("Client sent a session-id")
@@ -27,7 +27,7 @@ from urllib.parse import urlparse, ParseResult
 from lxml import etree
 from monotonic import monotonic
 import sshutil.conn
-from netconf import NSMAP, qmap
+from netconf import NSMAP, qmap, compile_xpath
 from netconf.base import NetconfSession
 from netconf.error import RPCError, SessionError, ReplyTimeoutError
 from netconf import util
@@ -164,7 +164,7 @@ class NetconfClientSession(NetconfSession):
         del self.rpc_out[msg_id]
         self.cv.release()
 
-        error = reply.xpath("nc:rpc-error", namespaces=NSMAP)
+        error = compile_xpath("nc:rpc-error")(reply)
         if error:
             raise RPCError(msg, tree, error[0])
 
@@ -519,7 +519,7 @@ class NetconfClientSession(NetconfSession):
         except etree.XMLSyntaxError:
             raise SessionError(msg, "Invalid XML from server.")
 
-        replies = tree.xpath("/nc:rpc-reply", namespaces=NSMAP)
+        replies = compile_xpath("/nc:rpc-reply")(tree)
         if not replies:
             raise SessionError(msg, "No rpc-reply found")
 
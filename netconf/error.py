@@ -18,7 +18,7 @@
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
 from lxml import etree
-from netconf import NSMAP, qmap
+from netconf import qmap, compile_xpath
 
 
 class NetconfException(Exception):
@@ -49,7 +49,7 @@ class NetconfError(NetconfException):
 
     def _get_error_val(self, value):
         try:
-            return self.error.xpath("nc:" + value, namespaces=NSMAP)[0].text
+            return compile_xpath("nc:" + value)(self.error)[0].text
         except IndexError:
             return None
 
@@ -144,8 +144,15 @@ class RPCServerError(NetconfException):
         # This sort of sucks for humans
         super(RPCServerError, self).__init__(self.get_reply_msg())
 
-    def get_reply_msg(self):
-        return etree.tounicode(self.reply)
+    def get_reply_msg(self, msg_format=None):
+        """Get the serialized rpc-reply for this error.
+
+        :param msg_format: The message format of the session sending the reply.
+        :return: The reply serialized by ``msg_format`` or else as a compact string.
+        """
+        if msg_format is None:
+            return etree.tounicode(self.reply)
+        return msg_format.tostring(self.reply)
 
 
 class RPCSvrException(RPCServerError):
@@ -30,6 +30,7 @@ from netconf import base
 import netconf.error as ncerror
 from netconf import NSMAP
 from netconf import qmap
+from netconf import compile_xpath
 from netconf import util
 
 if sys.platform == 'win32' and sys.version_info < (3, 5):
@@ -219,7 +220,7 @@ class NetconfServerSession(base.NetconfSession):
             logger.debug("NetconfServerSession: Creating session-id %s", str(sid))
 
         self.methods = server.server_methods
-        super(NetconfServerSession, self).__init__(channel, debug, sid)
+        super(NetconfServerSession, self).__init__(channel, debug, sid, msg_format=server.msg_format)
         super(NetconfServerSession, self)._open_session(True)
 
         if self.debug:
@@ -268,13 +269,16 @@ class NetconfServerSession(base.NetconfSession):
         externally the return value from the rpc_* methods will be returned
         using this method.
         """
+        if rpc_reply is None:
+            # e.g., rpc_lock and rpc_unlock return None on success.
+            rpc_reply = etree.Element("ok")
         reply = etree.Element(qmap('nc') + "rpc-reply", attrib=origmsg.attrib, nsmap=origmsg.nsmap)
         try:
             rpc_reply.getchildren  # pylint: disable=W0104
             reply.append(rpc_reply)
         except AttributeError:
             reply.extend(rpc_reply)
-        ucode = etree.tounicode(reply, pretty_print=True)
+        ucode = self.msg_format.tostring(reply)
         if self.debug:
             logger.debug("%s: Sending RPC-Reply: %s", str(self), str(ucode))
         self.send_message(ucode)
@@ -286,7 +290,7 @@ class NetconfServerSession(base.NetconfSession):
         raise ncerror.OperationNotSupportedProtoError(rpc)
 
     def _send_rpc_reply_error(self, error):
-        self.send_message(error.get_reply_msg())
+        self.send_message(error.get_reply_msg(self.msg_format))
 
     def _reader_exits(self):
         if self.debug:
@@ -307,7 +311,7 @@ class NetconfServerSession(base.NetconfSession):
             logger.warning("Closing session due to malformed message")
             raise ncerror.SessionError(msg, "Invalid XML from client.")
 
-        rpcs = tree.xpath("/nc:rpc", namespaces=NSMAP)
+        rpcs = compile_xpath("/nc:rpc")(tree)
         if not rpcs:
             raise ncerror.SessionError(msg, "No rpc found")
 
@@ -444,7 +448,7 @@ class NetconfServerSession(base.NetconfSession):
                 if self.new_framing:
                     if self.debug:
                         logger.debug("%s: MalformedMessageRPCError: %s", str(self), str(msgerr))
-                    self.send_message(msgerr.get_reply_msg())
+                    self.send_message(msgerr.get_reply_msg(self.msg_format))
                 else:
                     # If we are 1.0 we have to simply close the connection
                     # as we are not allowed to send this error
@@ -624,9 +628,19 @@ class NetconfSSHServer(sshutil.server.SSHServer):
     :param port: The port to bind the server to.
     :param host_key: The file containing the host key.
     :param debug: True to enable debug logging.
+    :param msg_format: How to serialize sent messages, by default compact XML
+                       with an XML declaration.
+    :type msg_format: `netconf.base.MessageFormat`
     """
-    def __init__(self, server_ctl=None, server_methods=None, port=830, host_key=None, debug=False):
+    def __init__(self,
+                 server_ctl=None,
+                 server_methods=None,
+                 port=830,
+                 host_key=None,
+                 debug=False,
+                 msg_format=None):
         self.server_methods = server_methods if server_methods is not None else NetconfMethods()
+        self.msg_format = msg_format if msg_format is not None else base.MessageFormat()
         self.session_id = 1
         self.session_locks_lock = threading.Lock()
         self.session_locks = {
@@ -18,9 +18,10 @@
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
 import copy
+import hashlib
 import logging
 from lxml import etree
-from netconf import NSMAP, qmap
+from netconf import NSMAP, qmap, compile_xpath
 from netconf import error
 
 # Tries to somewhat implement RFC6241 filtering
@@ -147,46 +148,51 @@ def xpath_filter_result(data, xpath):
     '<data><devs><dev><name>dev1</name><slots>1</slots></dev><dev><name>dev2</name><slots>2</slots></dev></devs></data>'
     """
 
-    # First get a copy we can safely modify.
-    data = copy.deepcopy(data)
-
+    # Evaluate with each child as the root, which lxml does without moving it.
     results = []
-    children = []
-
-    # XXX Need to reset the namespace declarations to those found in the context of the filter node.
-
-    # Have to re-root the children to avoid having to match "/nc:data"
-    for child in data.getchildren():
-        data.remove(child)
-        children.append(child)
-        newtree = etree.ElementTree(child)
-        results.extend(newtree.xpath(xpath, namespaces=NSMAP))
-
-    # Add the children of data back.
-    for child in children:
-        data.append(child)
-
-    # Mark the tree up
+    for child in data.iterchildren(tag=etree.Element):
+        for result in etree.ElementTree(child).xpath(xpath, namespaces=NSMAP):
+            if isinstance(result, etree._Element):  # pylint: disable=W0212
+                results.append(result)
+
+    # Selected elements are copied whole and their ancestors without other children.
+    selected = set(results)
+    ancestors = set()
     for result in results:
-        # Mark all children
-        for e in result.iterdescendants():
-            e.attrib['__filter_marked__'] = ""
-        # Mark this element and all parents
-        while result is not data:
-            result.attrib['__filter_marked__'] = ""
-            result = result.getparent()
-
-    def prunedecendants(e):
-        for child in e.getchildren():
-            if '__filter_marked__' not in child.attrib:
-                e.remove(child)
-            else:
-                prunedecendants(child)
-                del child.attrib['__filter_marked__']
+        parent = result.getparent()
+        while parent is not data and parent not in ancestors:
+            if parent in selected:
+                break
+            ancestors.add(parent)
+            parent = parent.getparent()
+
+    return _copy_selected(data, selected, ancestors, None)
 
-    prunedecendants(data)
 
-    return data
+def _copy_selected(elm, selected, ancestors, parent, children=None):
+    if children is None:
+        # The selected elements and ancestors by parent.
+        children = {}
+        for child in selected | ancestors:
+            children.setdefault(child.getparent(), []).append(child)
+    if parent is None:
+        copy_elm = etree.Element(elm.tag, elm.attrib, nsmap=elm.nsmap)
+    else:
+        copy_elm = etree.SubElement(parent, elm.tag, elm.attrib, nsmap=elm.nsmap)
+    copy_elm.text = elm.text
+    copy_elm.tail = elm.tail
+    found = children.get(elm, ())
+    if len(found) > 8:
+        found = elm
+    elif len(found) > 1:
+        # Finding the position of a few is faster than checking every child.
+        found = sorted(found, key=elm.index)
+    for child in found:
+        if child in selected:
+            copy_elm.append(copy.deepcopy(child))
+        elif child in ancestors:
+            _copy_selected(child, selected, ancestors, copy_elm, children)
+    return copy_elm
 
 
 def _get_xpath_tag(nsmap, ns, child):
@@ -276,13 +282,15 @@ def filter_to_xpath(felm):
     return result
 
 
-def filter_results(rpc, data, filter_or_none, debug=False):
+def filter_results(rpc, data, filter_or_none, debug=False, index=None):
     """Check for a user filter and prune the result data accordingly.
 
     :param rpc: An RPC message element.
     :param data: The data to filter.
     :param filter_or_none: Filter element or None.
     :type filter_or_none: `lxml.Element`
+    :param index: A list key index of the data for subtree filters, see
+                  `subtree_filter_result`.
     """
     if filter_or_none is None:
         return data
@@ -296,7 +304,9 @@ def filter_results(rpc, data, filter_or_none, debug=False):
         if not filter_or_none.getchildren():
             return elm("nc:data")
 
-        xpf = filter_to_xpath(filter_or_none)
+        if debug:
+            logger.debug("Filtering on subtree: %s", etree.tounicode(filter_or_none))
+        return subtree_filter_result(data, filter_or_none, index)
 
     elif filter_or_none.attrib[type_attr_name] == "xpath":
         if select_attr_name not in filter_or_none.attrib:
@@ -310,6 +320,159 @@ def filter_results(rpc, data, filter_or_none, debug=False):
     return xpath_filter_result(data, xpf)
 
 
+def subtree_filter_result(data, felm, index=None):
+    """Filter a result given a subtree filter (RFC6241 section 6).
+
+    Sibling filter nodes are content match nodes (leaves with a value),
+    selection nodes (empty) or containment nodes (with children). A data node
+    is only selected if all of its content match nodes match a child. If they
+    are the only filter nodes the whole data node is selected. Otherwise the
+    matching leaves are included along with what the selection and
+    containment nodes select. A containment node is only included if
+    something below it is selected.
+
+    :param data: The nc:data result element.
+    :param felm: The nc:filter element.
+    :param index: A list key index of the data, e.g., `netconf_merge.KeyIndex`.
+                  ``index.find(parent, tag, values)`` returns the list entries
+                  that may match the leaf values by name, or None if it can't
+                  tell.
+    :returns: New nc:data result element with copies of the selected nodes.
+
+    >>> xml = '''
+    ... <data>
+    ...   <devs>
+    ...     <dev>
+    ...       <name>dev1</name>
+    ...       <slots>1</slots>
+    ...     </dev>
+    ...     <dev>
+    ...       <name>dev2</name>
+    ...       <slots>2</slots>
+    ...     </dev>
+    ...   </devs>
+    ... </data>
+    ... '''
+    >>> data = etree.fromstring(xml.replace(' ', '').replace('\\n', ''))
+    >>> felm = etree.fromstring('<filter><devs><dev><name>dev2</name></dev></devs></filter>')
+    >>> etree.tounicode(subtree_filter_result(data, felm))
+    '<data><devs><dev><name>dev2</name><slots>2</slots></dev></devs></data>'
+    >>> felm = etree.fromstring('<filter><devs><dev><name/></dev></devs></filter>')
+    >>> etree.tounicode(subtree_filter_result(data, felm))
+    '<data><devs><dev><name>dev1</name></dev><dev><name>dev2</name></dev></devs></data>'
+    >>> felm = etree.fromstring('<filter><devs><dev><name>dev1</name><slots/></dev></devs></filter>')
+    >>> etree.tounicode(subtree_filter_result(data, felm))
+    '<data><devs><dev><name>dev1</name><slots>1</slots></dev></devs></data>'
+    """
+    selected = set()
+    ancestors = set()
+    if _filter_containment(_FilterNode(felm), data, selected, ancestors, index) and data in selected:
+        return copy.deepcopy(data)
+    return _copy_selected(data, selected, ancestors, None)
+
+
+# Lists longer than this are searched with XPath for content match nodes.
+_XPATH_CHILDREN = 32
+
+
+class _FilterNode(object):
+    """A subtree filter node prepared for matching."""
+    __slots__ = ("tag", "attrib", "value", "matches", "others", "values", "xpath", "variables")
+
+    def __init__(self, felm):
+        # lxml matches "{*}" to any namespace.
+        self.tag = felm.tag if felm.tag[0] == "{" else "{*}" + felm.tag
+        self.attrib = dict(felm.attrib)
+        self.value = None
+        self.matches = []
+        self.others = []
+        for child in felm.iterchildren(tag=etree.Element):
+            node = _FilterNode(child)
+            if len(child) or is_selection_node(child):
+                self.others.append(node)
+            else:
+                node.value = child.text.strip()
+                self.matches.append(node)
+        # Content match values by local name, for index lookups.
+        self.values = {etree.QName(x.tag).localname: x.value for x in self.matches}
+        self.xpath = None
+        self.variables = None
+
+    def match(self, delm):
+        # The attributes of the filter node must be present, others may be.
+        return all(delm.get(k) == v for k, v in self.attrib.items())
+
+    def candidates(self, delm):
+        """Get the children of delm which may match this node's content match
+        nodes. XPath checks them in C, which is faster for long lists.
+        """
+        if self.xpath is None:
+            namespaces = {}
+            path = _xpath_name_test(self.tag, namespaces)
+            self.variables = {}
+            for i, fmatch in enumerate(self.matches):
+                # Literals are faster than variables, which need no quoting.
+                if "'" not in fmatch.value:
+                    value = "'{}'".format(fmatch.value)
+                elif '"' not in fmatch.value:
+                    value = '"{}"'.format(fmatch.value)
+                else:
+                    value = "$v{}".format(i)
+                    self.variables["v{}".format(i)] = fmatch.value
+                path += "[{} = {}]".format(_xpath_name_test(fmatch.tag, namespaces), value)
+            self.xpath = etree.XPath(path, namespaces=namespaces)
+        return self.xpath(delm, **self.variables)
+
+
+def _xpath_name_test(tag, namespaces):
+    # An XPath name test for a tag, which may have the namespace "*".
+    ns, localname = tag[1:].split("}", 1)
+    if ns == "*":
+        return "*[local-name() = '{}']".format(localname)
+    prefixes = {namespace: prefix for prefix, namespace in namespaces.items()}
+    prefix = prefixes.get(ns)
+    if prefix is None:
+        prefix = "n{}".format(len(namespaces))
+        namespaces[prefix] = ns
+    return "{}:{}".format(prefix, localname)
+
+
+def _filter_containment(fnode, delm, selected, ancestors, index):
+    # Apply the children of a filter node to the children of the data node it
+    # matched, adding what they select to selected and ancestors. Return True
+    # if anything was selected.
+    leaf_elms = []
+    for fmatch in fnode.matches:
+        found = [x for x in delm.iterchildren(fmatch.tag) if x.text == fmatch.value and fmatch.match(x)]
+        if not found:
+            return False
+        leaf_elms.extend(found)
+    if not fnode.others:
+        selected.add(delm)
+        return True
+
+    rv = bool(leaf_elms)
+    selected.update(leaf_elms)
+    for fother in fnode.others:
+        children = None
+        if index is not None and fother.matches:
+            children = index.find(delm, fother.tag, fother.values)
+        if children is None and fother.matches and len(delm) > _XPATH_CHILDREN:
+            children = fother.candidates(delm)
+        if children is None:
+            children = delm.iterchildren(fother.tag)
+        for child in children:
+            if not fother.match(child):
+                continue
+            if not fother.matches and not fother.others:
+                selected.add(child)
+                rv = True
+            elif _filter_containment(fother, child, selected, ancestors, index):
+                ancestors.add(child)
+                rv = True
+    return rv
+
+
 def filter_tag_match(filter_tag, elm_tag):
     fqname = etree.QName(filter_tag)
     eqname = qname(elm_tag)
@@ -492,7 +655,7 @@ def filter_leaf_allows(filter_elm, xpath, value):
         return True
 
     # No match or multiple matches not allowed for leaf.
-    flist = filter_elm.xpath(xpath, namespaces=NSMAP)
+    flist = compile_xpath(xpath)(filter_elm)
     if not flist or len(flist) > 1:
         return False
     felm = flist[0]
@@ -515,6 +678,7 @@ def filter_list_iter(filter_list, key_xpath, keys):
     if filter_list is None:
         for key in keys:
             yield key, None
+        return
 
     try:
         # If this an element then make it a list of elements
@@ -524,8 +688,8 @@ def filter_list_iter(filter_list, key_xpath, keys):
         pass
 
     for filter_elm in filter_list:
-        filter_elms = [x for x in filter_elm.xpath(key_xpath, namespaces=NSMAP)]
-        filter_keys = [x.text for x in filter_elms]
+        filter_elms = compile_xpath(key_xpath)(filter_elm)
+        filter_keys = set(x.text for x in filter_elms)
         if not filter_keys:
             for key in keys:
                 yield key, filter_elm
@@ -541,6 +705,63 @@ def filter_list_iter(filter_list, key_xpath, keys):
                 #     pass
 
 
+# Attributes of edits left out of fingerprints, they are removed when edits are applied.
+_EDIT_ATTRIBUTES = ("operation", "key", qmap("nc") + "operation")
+
+
+class Fingerprints(object):
+    """Merkle hashes of the subtrees of trees, computed when first asked for.
+
+    The hash of an element covers its tag, attributes, stripped text and the
+    hashes of its element children, so equal subtrees have equal hashes
+    whatever their whitespace and comments. The ``operation`` and ``key``
+    attributes of edits are left out.
+
+    The hashes are kept until invalidated, so hashing a slightly changed tree
+    again only hashes the changed subtrees. After a change `invalidate` must
+    be called with the changed element and `discard` with removed subtrees;
+    ``netconf_merge.merge_tree`` does both when passed the fingerprints.
+    """
+
+    def __init__(self):
+        # element -> digest
+        self.hashes = {}
+
+    def get(self, elm):
+        """Get the hash of an element.
+
+        :param elm: The element to hash.
+        :return: The SHA-1 digest of the element subtree.
+        """
+        digest = self.hashes.get(elm)
+        if digest is None:
+            m = hashlib.sha1(elm.tag.encode("utf-8"))
+            for name, value in sorted(elm.attrib.items()):
+                if name not in _EDIT_ATTRIBUTES:
+                    m.update("\0{}={}".format(name, value).encode("utf-8"))
+            m.update(b"\0" + (elm.text or "").strip().encode("utf-8") + b"\0")
+            for child in elm.iterchildren(tag=etree.Element):
+                m.update(self.get(child))
+            digest = self.hashes[elm] = m.digest()
+        return digest
+
+    def equal(self, elm, other):
+        """Check if two subtrees are equal by their hashes."""
+        return self.get(elm) == self.get(other)
+
+    def invalidate(self, elm):
+        """Drop the hashes of an element and its ancestors when it changes."""
+        # Hashing an element hashes all of its descendants, so the ancestors
+        # of an element without a hash have none either.
+        while elm is not None and self.hashes.pop(elm, None) is not None:
+            elm = elm.getparent()
+
+    def discard(self, elm):
+        """Drop the hashes of an element and its descendants when it is removed."""
+        for e in elm.iter():
+            self.hashes.pop(e, None)
+
+
 __author__ = 'Christian Hopps'
 __date__ = 'March 31 2015'
 __version__ = '1.0'
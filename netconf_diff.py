@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- mode: python; python-indent: 4 -*-
+
+from copy import deepcopy
+import json
+import sys
+from  lxml import etree as ET
+
+from netconf_merge import Fingerprints, MergeError, SchemaNode, compile_schema, get_key, get_schema_node, no_ns
+
+"""
+Compute the edit-config that changes one configuration into another.
+
+The edit uses the operations of netconf_merge: create for new nodes,
+delete for removed ones, merge (the default) for changed leaves and
+replace for subtrees where that is smaller than the changes. Merging it
+into the old tree with netconf_merge.merge_tree gives the new tree, except
+for the order of siblings which merge can't change.
+
+Identical subtrees are skipped by comparing their hashes. Passing the
+same netconf_merge.Fingerprints to the diffs and merges of a tree keeps
+the hashes of its unchanged subtrees between diffs.
+"""
+
+def get_identity(e, node):
+    # What matches e to an element of the other tree: its tag and its keys,
+    # or value for leaf-lists.
+    if node.kind == 'list' and node.keys:
+        key = get_key(e, node.keys)
+        if key is None:
+            raise MergeError(f'List key leaf "{", ".join(node.keynames())}" not found.')
+        return (e.tag, key)
+    if node.kind == 'leaf-list':
+        return (e.tag, (e.text or '').strip())
+    return (e.tag, None)
+
+def group_children(parent, schema):
+    # The children of parent by identity, in order.
+    children = {}
+    for c in parent:
+        if not isinstance(c.tag, str):
+            continue
+        node = schema.child(c.tag)
+        if node is None:
+            raise MergeError(f"ERROR: Tag {no_ns(c.tag)} not found in schema.")
+        children.setdefault(get_identity(c, node), []).append(c)
+    return children
+
+def count_nodes(e):
+    return sum(1 for _ in e.iter())
+
+def with_operation(e, operation):
+    e = deepcopy(e)
+    e.tail = None
+    e.set('operation', operation)
+    return e
+
+def delete_element(e, node):
+    # An element deleting e, with only its keys.
+    d = ET.Element(e.tag)
+    d.set('operation', 'delete')
+    if node.kind == 'list' and node.keys:
+        for keytag in node.keys:
+            d.append(deepcopy(next(e.iterchildren(keytag))))
+            d[-1].tail = None
+    elif node.kind == 'leaf-list':
+        d.text = e.text
+    return d
+
+def diff_children(lnode, rnode, schema, fingerprints):
+    # The edits of the children of lnode giving those of rnode, or None if
+    # merge can't tell them apart, then rnode has to replace lnode.
+    schema = get_schema_node(schema)
+    old = group_children(lnode, schema)
+    new = group_children(rnode, schema)
+
+    deletes = []
+    edits = []
+    for identity, lcs in old.items():
+        if identity not in new:
+            deletes.append(delete_element(lcs[0], schema.child(identity[0])))
+    for identity, rcs in new.items():
+        node = schema.child(identity[0])
+        lcs = old.get(identity)
+        if lcs is None:
+            edits.extend(with_operation(c, 'create') for c in rcs)
+            continue
+        if [fingerprints.get(c) for c in lcs] == [fingerprints.get(c) for c in rcs]:
+            continue
+        if len(lcs) > 1 or len(rcs) > 1:
+            # E.g. several instances of a container.
+            return None
+        lc, rc = lcs[0], rcs[0]
+        if node.kind not in ('container', 'list'):
+            leaf = deepcopy(rc)
+            leaf.tail = None
+            edits.append(leaf)
+            continue
+
+        children = diff_children(lc, rc, node, fingerprints)
+        if children is not None and not children:
+            # Only the order differs.
+            continue
+        if children is not None:
+            edit = ET.Element(rc.tag)
+            for keytag in node.keys:
+                edit.append(deepcopy(next(rc.iterchildren(keytag))))
+                edit[-1].tail = None
+            edit.extend(children)
+            if count_nodes(edit) < count_nodes(rc) or len(rc) == 0:
+                edits.append(edit)
+                continue
+        if len(rc) == 0:
+            # Replace can't be used with text only elements.
+            edits.append(delete_element(lc, node))
+            edits.append(with_operation(rc, 'create'))
+        else:
+            edits.append(with_operation(rc, 'replace'))
+    return deletes + edits
+
+def diff_tree(lnode, rnode, schema, fingerprints=None):
+    """Get the edit which merged into the tree lnode gives rnode.
+
+    schema is a SchemaNode, or the raw JSON schema of the children of the
+    roots. fingerprints is a Fingerprints of both trees, by default a new
+    one. Returns a new root element, without children if the trees are
+    equal.
+    """
+    if fingerprints is None:
+        fingerprints = Fingerprints()
+    edit = ET.Element(rnode.tag, nsmap=rnode.nsmap)
+    if fingerprints.equal(lnode, rnode):
+        return edit
+    children = diff_children(lnode, rnode, schema, fingerprints)
+    if children is None:
+        raise MergeError(f'Can not diff the children of {no_ns(rnode.tag)}.')
+    edit.extend(children)
+    return edit
+
+def main(files, schema):
+    # schema is the raw JSON schema of the children of the root, or a
+    # compiled schema with the root as a child.
+    try:
+        parser = ET.XMLParser(remove_blank_text=True)
+        ltree, rtree = (ET.parse(filename, parser) for filename in files)
+        if ltree.getroot().tag != rtree.getroot().tag:
+            raise MergeError(f'The roots {no_ns(ltree.getroot().tag)} and {no_ns(rtree.getroot().tag)} differ.')
+        if isinstance(schema, SchemaNode) and schema.kind == 'tree':
+            schema = schema.child(ltree.getroot().tag)
+            if schema is None:
+                raise MergeError(f"ERROR: Tag {ltree.getroot().tag} not found in schema.")
+        edit = diff_tree(ltree.getroot(), rtree.getroot(), schema)
+        return 0, ET.tostring(edit, pretty_print=True).decode('utf-8')
+    except MergeError as e:
+        return 1, f"ERROR: {e}"
+
+
+if __name__ == "__main__":
+    schema = compile_schema(json.loads(open(sys.argv[1]).read()))
+    status, xml = main(sys.argv[2:4], schema)
+    print(xml)
+    sys.exit(status)
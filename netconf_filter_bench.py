@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- mode: python; python-indent: 4 -*-
+
+# Benchmark of the native subtree filter against converting it to XPath.
+#
+# The data is async_example/router.xml with the interface list grown to
+# the given number of entries.
+
+import argparse
+import copy
+import timeit
+
+from lxml import etree
+
+from netconf import nsmap_add, util
+
+ROUTER = "http://example.com/router"
+
+FILTERS = {
+    "key": """<filter><sys xmlns="{}"><interfaces><interface>
+                <name>eth{}</name></interface></interfaces></sys></filter>""",
+    "select": """<filter><sys xmlns="{}"><interfaces><interface>
+                   <name/><unit><name/></unit></interface></interfaces></sys></filter>""",
+    "container": """<filter><sys xmlns="{}"><dns/></sys></filter>""",
+}
+
+
+def get_data(interfaces):
+    root = etree.parse("async_example/router.xml", etree.XMLParser(remove_blank_text=True)).getroot()
+    ifs = root.find("{%s}interfaces" % ROUTER)
+    template = ifs[0]
+    ifs.clear()
+    for i in range(interfaces):
+        interface = copy.deepcopy(template)
+        interface.find("{%s}name" % ROUTER).text = "eth{}".format(i)
+        ifs.append(interface)
+    data = util.elm("nc:data")
+    data.append(root)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-i", "--interfaces", type=int, default=1000, help="Interfaces in the data")
+    parser.add_argument("-n", "--number", type=int, default=20, help="Filter runs to time")
+    args = parser.parse_args()
+
+    nsmap_add("r", ROUTER)
+    data = get_data(args.interfaces)
+    for name, fxml in sorted(FILTERS.items()):
+        felm = etree.fromstring(fxml.format(ROUTER, args.interfaces // 2))
+        xpath = util.filter_to_xpath(felm)
+        subtree = util.subtree_filter_result(data, felm)
+        assert etree.tostring(subtree) == etree.tostring(util.xpath_filter_result(data, xpath))
+
+        native = timeit.timeit(lambda: util.subtree_filter_result(data, felm), number=args.number)
+        # Convert each time, as filter_results used to.
+        xp = timeit.timeit(lambda: util.xpath_filter_result(data, util.filter_to_xpath(felm)),
+                           number=args.number)
+        print("{:10} subtree {:8.3f} ms  xpath {:8.3f} ms  {:6.1f}x".format(
+            name, native * 1000 / args.number, xp * 1000 / args.number, xp / native))
+
+
+if __name__ == "__main__":
+    main()
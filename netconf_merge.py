@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 # -*- mode: python; python-indent: 4 -*-
 
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 import json
+import shutil
 import sys
+import tempfile
 from  lxml import etree as ET
+from netconf.util import Fingerprints  # re-exported for netconf_diff
 
 """
 Operations:
@@ -25,9 +29,15 @@ TODO:
 # - Handle xmlns prefix on operation
 # - Check key presence on lnode 
 
+NC_OPERATION = '{urn:ietf:params:xml:ns:netconf:base:1.0}operation'
+
 class MergeError(Exception):
     pass
 
+class StreamMergeError(MergeError):
+    # The edits can't be merged while streaming, merge in memory instead.
+    pass
+
 def fix_indentation(lnode, rnode):
     # add indentation (note! any garbage text will be copied as well!)
     # remove one newline to not add one extra empty line
@@ -73,13 +83,281 @@ def find_all_no_ns(c, tag):
             elems.append(e)
     return elems
 
-def merge_tree(lnode, rnode, schema):
-    for c in rnode:
+class SchemaNode:
+    """A compiled schema node.
+
+    kind is e.g. 'container', 'list', 'leaf' or 'leaf-list'. tag is the
+    qualified name in Clark notation. keys are the tags of the key leaves of
+    a list. children maps the tags of the child nodes to their nodes.
+    """
+    __slots__ = ('name', 'tag', 'kind', 'keys', 'children')
+
+    def __init__(self, name, tag, kind, keys=()):
+        self.name = name
+        self.tag = tag
+        self.kind = kind
+        self.keys = keys
+        self.children = {}
+
+    def child(self, tag):
+        return self.children.get(tag)
+
+    def keynames(self):
+        return tuple(no_ns(k) for k in self.keys)
+
+
+class LocalSchemaNode(SchemaNode):
+    """A schema node without namespaces, children are found by local name.
+
+    Used for the schema JSON tree without the modules, where tags are
+    matched regardless of namespace. Keys are in the '{*}name' form which
+    lxml matches in any namespace.
+    """
+    __slots__ = ()
+
+    def child(self, tag):
+        return self.children.get(no_ns(tag))
+
+
+def compile_schema(doc):
+    """Compile a schema JSON document (with modules and tree).
+
+    Returns a node with the roots of the tree as children.
+    """
+    namespaces = {m: ns for m, (prefix, ns) in doc['modules'].items()}
+    root = SchemaNode(None, None, 'tree')
+    compile_children(root, doc['tree'], None, namespaces)
+    return root
+
+def compile_children(node, children, ns, namespaces):
+    for name, (kind, *rest) in children.items():
+        cns = ns
+        if ':' in name:
+            module, name = name.split(':', 1)
+            cns = namespaces[module]
+        keys = ()
+        if kind == 'list' and len(rest) > 1 and rest[1]:
+            keys = tuple(f'{{{namespaces[m]}}}{l}' for m, l in rest[1])
+        child = SchemaNode(name, f'{{{cns}}}{name}', kind, keys)
+        if kind in ('container', 'list'):
+            compile_children(child, rest[0], cns, namespaces)
+        node.children[child.tag] = child
+
+_LOCAL_SCHEMAS = {}
+
+def get_schema_node(schema):
+    """Get the schema node of a compiled schema or of a raw JSON tree.
+
+    The raw JSON children of a node, e.g. tree[root][1], are compiled once
+    into a LocalSchemaNode.
+    """
+    if isinstance(schema, SchemaNode):
+        return schema
+    try:
+        return _LOCAL_SCHEMAS[id(schema)][1]
+    except KeyError:
+        pass
+    node = LocalSchemaNode(None, None, 'container')
+    compile_local_children(node, schema)
+    # Keep the JSON alive so that its id is not reused.
+    _LOCAL_SCHEMAS[id(schema)] = (schema, node)
+    return node
+
+def compile_local_children(node, children):
+    for name, (kind, *rest) in children.items():
+        name = name.split(':', 1)[-1]
+        keys = ()
+        if kind == 'list' and len(rest) > 1 and rest[1]:
+            keys = tuple(f'{{*}}{l}' for m, l in rest[1])
+        child = LocalSchemaNode(name, name, kind, keys)
+        if kind in ('container', 'list'):
+            compile_local_children(child, rest[0])
+        node.children[name] = child
+
+def key_text(e, keytag):
+    # The stripped text of the key leaf of e or None.
+    k = next(e.iterchildren(keytag), None)
+    if k is None or k.text is None:
+        return None
+    return k.text.strip()
+
+def get_key(e, keys):
+    # The texts of the key leaves of the list entry e, or None if one is
+    # missing or empty.
+    key = tuple(key_text(e, keytag) for keytag in keys)
+    if not all(key):
+        return None
+    return key
+
+def key_str(node, key):
+    return ', '.join(f'{name}={k}' for name, k in zip(node.keynames(), key))
+
+
+class KeyIndex:
+    """Index of the list entries in a tree by their key leaf values.
+
+    The entries of a list are indexed per parent element the first time
+    they are looked up. merge_tree keeps the index up to date when it is
+    passed one, so the tree must not be changed by other means.
+
+    schema is the schema of the children of root.
+    """
+
+    def __init__(self, root, schema):
+        self.root = root
+        self.schema = get_schema_node(schema)
+        # parent -> {list tag: ListEntries}
+        self.parents = {}
+
+    def get_entries(self, parent, tag, keys):
+        lists = self.parents.setdefault(parent, {})
+        entries = lists.get(tag)
+        if entries is None:
+            entries = lists[tag] = ListEntries(parent, tag, keys)
+        return entries
+
+    def get_schema(self, parent):
+        """Get the schema node of parent or None if unknown."""
+        path = []
+        while parent is not self.root:
+            if parent is None:
+                return None
+            path.append(parent.tag)
+            parent = parent.getparent()
+        node = self.schema
+        for tag in reversed(path):
+            node = node.child(tag)
+            if node is None or node.kind not in ('container', 'list'):
+                return None
+        return node
+
+    def find(self, parent, tag, values):
+        """Find the list entries of parent which may match leaf values.
+
+        values maps leaf names (without namespace) to values. Returns None if
+        tag is not a list or values does not have all of its keys.
+        """
+        if tag.startswith('{*}'):
+            return None
+        schema = self.get_schema(parent)
+        node = schema.child(tag) if schema is not None else None
+        if node is None or node.kind != 'list' or not node.keys:
+            return None
+        keynames = node.keynames()
+        if any(k not in values for k in keynames):
+            return None
+        entry = self.get_entries(parent, tag, node.keys).get(tuple(values[k] for k in keynames))
+        return [entry] if entry is not None else []
+
+    def discard(self, elm):
+        """Drop the index of elm and its descendants when removed."""
+        if self.parents:
+            for e in elm.iter():
+                self.parents.pop(e, None)
+
+
+class ListEntries:
+    """The entries of a list under a parent by key."""
+
+    def __init__(self, parent, tag, keys):
+        self.parent = parent
+        self.keys = keys
+        self.entries = {}
+        self.last = None
+        for e in parent.iterchildren(tag):
+            key = self.get_key(e)
+            if key is not None:
+                self.entries.setdefault(key, e)
+            self.last = e
+
+    def get_key(self, e):
+        return get_key(e, self.keys)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def insert(self, key, e):
+        # Insert after the last entry, as merge_tree does without an index.
+        if self.last is None:
+            self.parent.append(e)
+        else:
+            self.last.addnext(e)
+        self.entries[key] = e
+        self.last = e
+
+    def replace(self, key, e):
+        lc = self.entries[key]
+        self.parent.replace(lc, e)
+        self.entries[key] = e
+        if self.last is lc:
+            self.last = e
+
+    def remove(self, key):
+        lc = self.entries.pop(key)
+        self.parent.remove(lc)
+        if self.last is lc:
+            self.last = None
+            for self.last in self.parent.iterchildren(lc.tag, reversed=True):
+                break
+        return lc
+
+
+def take(c, move):
+    # The element to put in the tree, c itself when moving
+    return c if move else deepcopy(c)
+
+def merge_list_entry(lnode, c, operation, node, index, move=False, fingerprints=None):
+    # Merge list entry c into lnode using the index. The entries are matched
+    # on all key leaves.
+    rtag = no_ns(c.tag)
+    entries = index.get_entries(lnode, c.tag, node.keys)
+    key = entries.get_key(c)
+    if key is None:
+        raise MergeError(f'List key leaf "{", ".join(node.keynames())}" not found.')
+    lc = entries.get(key)
+
+    if operation == 'create':
+        if lc is not None:
+            raise MergeError(f'Element {rtag} with {key_str(node, key)} already exists.')
+        entries.insert(key, c)
+    elif operation == 'merge':
+        if lc is None:
+            entries.insert(key, take(c, move))
+        else:
+            merge_tree(lc, take(c, move), node, index, move, fingerprints)
+    elif operation == 'replace':
+        if lc is None:
+            entries.insert(key, take(c, move))
+        else:
+            index.discard(lc)
+            if fingerprints is not None:
+                fingerprints.discard(lc)
+            entries.replace(key, take(c, move))
+    elif operation in ['delete', 'remove']:
+        if lc is not None:
+            lc = entries.remove(key)
+            index.discard(lc)
+            if fingerprints is not None:
+                fingerprints.discard(lc)
+        elif operation == 'delete' and entries.last is not None:
+            raise MergeError(f'Element {rtag} with {key_str(node, key)} does not exists.')
+
+
+def merge_tree(lnode, rnode, schema, index=None, move=False, fingerprints=None):
+    # schema is a SchemaNode, or the raw JSON schema of the children of
+    # lnode. With move the elements of rnode are moved into lnode instead
+    # of being copied, so rnode must not be used afterwards. The hashes of
+    # the changed elements of lnode are dropped from fingerprints.
+    schema = get_schema_node(schema)
+    if fingerprints is not None:
+        fingerprints.invalidate(lnode)
+    for c in list(rnode):
         rtag = no_ns(c.tag)
-        rtype, *rrest = schema[rtag]
+        node = schema.child(c.tag)
         # Schema validation
-        if rtag not in schema.keys():
+        if node is None:
             raise MergeError(f"ERROR: Tag {rtag} not found in schema.")
+        rtype = node.kind
 
         operation = 'merge' # default
         if 'operation' in c.attrib:
@@ -89,42 +367,16 @@ def merge_tree(lnode, rnode, schema):
             operation = c.attrib.get('{urn:ietf:params:xml:ns:netconf:base:1.0}operation')
             del c.attrib['{urn:ietf:params:xml:ns:netconf:base:1.0}operation']
 
-        keyname = key = None 
-        if rtype == 'list': 
-            # TODO: Support for multiple leafs in key
-            keyname = rrest[1][0][1]
-            if keyname:
-                # TODO: Handle namespaces...
-                for z in c:
-                    if keyname == no_ns(z.tag):
-                        key = z.text.strip()
-                if not key:
-                    raise MergeError(f'List key leaf "{keyname}" not found.')
-
-        ## TODO: Use schema
-        #if 'key' in c.attrib:
-        #    keyname = c.attrib.get('key')
-        #    if keyname:
-        #        v = c.find(keyname)
-        #        if v is not None:
-        #            key = v.text.strip()
-        #    del c.attrib['key'], v
-        #    if no_subelements(c):
-        #        if operation == 'create':
-        #            raise MergeError('Attribute key can not be used with '
-        #                             'operation create.')
-        #        else:
-        #            raise MergeError('Attribute key can not be used with '
-        #                             'text only elements.')
-
-        if keyname is not None:
-            assert rtype == 'list'
-            t,tc,kl = schema[rtag]
-            if not name_in_keyleafs(keyname, kl):
-                print(f"ERROR: Key leaf {keyname} not in schema.")
-                sys.exit(1)
-
+        if index is not None and rtype == 'list' and node.keys:
+            merge_list_entry(lnode, c, operation, node, index, move, fingerprints)
+            continue
 
+        keys = key = None
+        if rtype == 'list' and node.keys:
+            keys = node.keys
+            key = get_key(c, keys)
+            if key is None:
+                raise MergeError(f'List key leaf "{", ".join(node.keynames())}" not found.')
 
         lcs = lnode.findall(c.tag)
 
@@ -133,12 +385,10 @@ def merge_tree(lnode, rnode, schema):
                 lnode.append(c)
             else:
                 for zc in lcs:
-                    for zl in zc:
-                        if keyname == no_ns(zl.tag):
-                            if key == zl.text.strip():
-                                raise MergeError(f'Element {no_ns(zc.tag)} '
-                                                 f'with {keyname}={key} '
-                                                 f'already exists.')
+                    if keys is not None and key == get_key(zc, keys):
+                        raise MergeError(f'Element {no_ns(zc.tag)} '
+                                         f'with {key_str(node, key)} '
+                                         f'already exists.')
                 lc = lcs.pop() # Last element
                 lnode.insert(lnode.index(lc)+1, c)
 
@@ -146,16 +396,13 @@ def merge_tree(lnode, rnode, schema):
 
             if operation == 'merge':
                 fix_indentation(lnode, rnode)
-                lnode.append(deepcopy(c))
+                lnode.append(take(c, move))
             elif operation == 'replace':
                 if no_subelements(c):
                     raise MergeError('Operation replace can not be used '
                                      'with text only elements.')
                 fix_indentation(lnode, rnode)
-                lnode.append(deepcopy(c))
-            elif operation == 'merge':
-                fix_indentation(lnode, rnode)
-                lnode.append(deepcopy(c))
+                lnode.append(take(c, move))
             else: # delete
                 pass
 
@@ -166,113 +413,687 @@ def merge_tree(lnode, rnode, schema):
                     pos = lnode.index(lcs[0])
                     for lc in lcs:
                         lnode.remove(lc)
-                    lnode.insert(pos, deepcopy(c))
+                        if index is not None:
+                            index.discard(lc)
+                        if fingerprints is not None:
+                            fingerprints.discard(lc)
+                    lnode.insert(pos, take(c, move))
                     del pos
                 else:
-                    if keyname is not None:
-                        found = False
-                        for lc in lcs:
-                            ltag = no_ns(lc.tag)
-                            # Schema validation
-                            if ltag not in schema.keys():
-                                print(f"ERROR: Tag {ltag} not found in schema:")
-                                sys.exit(1)
-                            k = find_no_ns(lc, keyname)
-                            if k is not None and k.text.strip() == key:
-                                found = True
-                                cschema = schema[ltag]
-                                merge_tree(lc, deepcopy(c), cschema[1])
+                    if keys is not None:
+                        found = [lc for lc in lcs if get_key(lc, keys) == key]
+                        # Copy c for all but the last, which may take it.
+                        for zc in found:
+                            merge_tree(zc, take(c, move and zc is found[-1]), node, index, move, fingerprints)
                         if not found:
-                            lnode.insert(lnode.index(lc)+1, deepcopy(c))
-                            del found
+                            lnode.insert(lnode.index(lcs[-1])+1, take(c, move))
+                        del found
                     else:
                         for lc in lcs:
-                            ltag = no_ns(lc.tag)
-                            # Schema validation
-                            if ltag not in schema.keys():
-                                print(f"ERROR: Tag {ltag} not found in schema:")
-                                sys.exit(1)
-                            cschema = schema[ltag]
-                            merge_tree(lc, deepcopy(c), cschema[1])
+                            merge_tree(lc, take(c, move and lc is lcs[-1]), node, index, move, fingerprints)
 
             elif operation == 'replace':
                 if no_subelements(c):
                     raise MergeError('Operation replace can not be used '
                                      'with text only elements.')
                 else:
-                    if keyname is not None:
-                        found = False
-                        for lc in lcs:
-                            ltag = no_ns(lc.tag)
-                            # Schema validation
-                            if ltag not in schema.keys():
-                                print(f"ERROR: Tag {ltag} not found in schema:")
-                                sys.exit(1)
-                            k = find_no_ns(lc, keyname)
-                            if k is not None and k.text.strip() == key:
-                                found = True
-                                lnode.replace(lc, deepcopy(c))
+                    if keys is not None:
+                        found = [lc for lc in lcs if get_key(lc, keys) == key]
+                        for zc in found:
+                            if fingerprints is not None:
+                                fingerprints.discard(zc)
+                            lnode.replace(zc, take(c, move and zc is found[-1]))
                         if not found:
-                            lnode.insert(lnode.index(lc)+1, deepcopy(c))
+                            lnode.insert(lnode.index(lcs[-1])+1, take(c, move))
                         del found
                     else:
                         # Can this be a list with no key?
                         # Currently assuming only containers...
                         if len(lcs) == 1:
-                            lnode.replace(lcs[0], deepcopy(c))
+                            if index is not None:
+                                index.discard(lcs[0])
+                            if fingerprints is not None:
+                                fingerprints.discard(lcs[0])
+                            lnode.replace(lcs[0], take(c, move))
                         else:
                             raise MergeError('Replacement of multiple non-list'
                                              ' elements not possible.')
 
-
-
             elif operation in ['delete', 'remove']:
                 if no_subelements(c):
                     for lc in lcs:
                         if c.text is None or c.text.strip() == lc.text.strip():
                             lnode.remove(lc)
+                            if index is not None:
+                                index.discard(lc)
+                            if fingerprints is not None:
+                                fingerprints.discard(lc)
                 else:
                     #if keyname is None:
                     #    raise MergeError('No key specified for operation delete.')
                     deleted = False
                     for lc in lcs:
-                        k = find_no_ns(lc, keyname)
-                        if k is not None and k.text.strip() == key:
+                        if keys is not None and get_key(lc, keys) == key:
                             lnode.remove(lc)
+                            if fingerprints is not None:
+                                fingerprints.discard(lc)
                             deleted = True
                     if operation == 'delete' and not deleted:
-                            raise MergeError(f'Element {no_ns(lc.tag)} '
-                                             f'with {keyname}={key} '
+                            raise MergeError(f'Element {no_ns(lcs[-1].tag)} '
+                                             f'with {key_str(node, key) if keys else None} '
                                              f'does not exists.')
                     del deleted
 
 
-def main(files, schema, unit_test=False):
-    ltree = None
+
+class EditEntries:
+    """The children of an edit element with a tag, by their key."""
+
+    def __init__(self, parent, tag, keys):
+        self.parent = parent
+        self.keys = keys
+        # key (None if not a list) -> children
+        self.entries = {}
+        self.last = None
+        self.deletes = False
+        for e in parent.iterchildren(tag):
+            self.add(e)
+
+    def add(self, e):
+        key = get_key(e, self.keys) if self.keys else None
+        self.entries.setdefault(key, []).append(e)
+        self.last = e
+        if e.get('operation') in ('delete', 'remove'):
+            self.deletes = True
+
+    def get(self, key):
+        return self.entries.get(key, ())
+
+    def insert(self, key, e):
+        # Keep the order of the children with the same tag.
+        if self.last is None:
+            self.parent.append(e)
+        else:
+            self.last.addnext(e)
+        self.add(e)
+
+    def replace(self, key, e):
+        lc = self.entries[key][0]
+        self.parent.replace(lc, e)
+        self.entries[key] = [e]
+        if self.last is lc:
+            self.last = e
+
+def coalesce(acc, new, schema, entries=None):
+    """Coalesce the edit new into the edit acc.
+
+    Merging the result gives the same tree as merging acc and then new.
+    Returns False, with both unchanged, when that can't be ensured, e.g.
+    when they both operate on the same node with other operations than
+    merge. The elements of new are moved into acc.
+
+    entries is a dict kept by the caller to look up the children of acc
+    in later calls, acc must not be changed by other means.
+    """
+    schema = get_schema_node(schema)
+    if entries is None:
+        entries = {}
+    plan = []
+    if not coalesce_children(acc, new, schema, entries, True, plan):
+        return False
+    for method, key, n in plan:
+        method(key, n)
+    return True
+
+def coalesce_children(acc, new, schema, entries, root, plan):
+    # Check the coalescing of the children and add the changes to acc to
+    # plan. The children of the root always exist in the tree, below it
+    # they may be new and then are inserted as they are.
+    seen = set()
+    for n in list(new):
+        if not isinstance(n.tag, str) or NC_OPERATION in n.attrib:
+            return False
+        node = schema.child(n.tag)
+        if node is None:
+            return False
+        operation = n.get('operation', 'merge')
+        if operation not in ('merge', 'create', 'replace', 'delete', 'remove'):
+            return False
+
+        lists = entries.setdefault(acc, {})
+        key = keys = None
+        if node.kind == 'list':
+            if not node.keys:
+                return False
+            keys = node.keys
+            key = get_key(n, keys)
+            if key is None:
+                return False
+        siblings = lists.get(n.tag)
+        if siblings is None:
+            siblings = lists[n.tag] = EditEntries(acc, n.tag, keys)
+        same = siblings.get(key)
+        # Children of new must not match each other.
+        if (n.tag, key) in seen or len(same) > 1:
+            return False
+        seen.add((n.tag, key))
+
+        if same:
+            a = same[0]
+            if operation != 'merge' or a.get('operation', 'merge') != 'merge' or NC_OPERATION in a.attrib:
+                return False
+            if no_subelements(a) != no_subelements(n):
+                return False
+            if no_subelements(n):
+                # The later value replaces the leaf.
+                plan.append((siblings.replace, key, n))
+            elif not coalesce_children(a, n, node, entries, False, plan):
+                return False
+        else:
+            if not root and (operation in ('delete', 'remove') or
+                             (operation == 'replace' and no_subelements(n))):
+                return False
+            if siblings.deletes:
+                return False
+            plan.append((siblings.insert, key, n))
+    return True
+
+
+def merge_parallel(lnode, rnodes, schema, use_index=False, max_workers=None):
+    """Merge the edits rnodes in turn into lnode in a process pool.
+
+    The subtrees under lnode with the same tag are merged independently of
+    the others, each tag in its own worker. They are passed serialized and
+    put back in the order merging in turn would give. Raises the
+    MergeError of the first edit that fails, lnode is then unchanged.
+
+    Returns False, with nothing changed, if the order could differ, e.g.
+    when the subtrees with a tag are not adjacent or are all deleted and
+    then added again.
+    """
+    schema = get_schema_node(schema)
+    # tag -> [(step, serialized edit of the subtree)]
+    parts = {}
+    for i, rnode in enumerate(rnodes):
+        for j, c in enumerate(rnode):
+            if not isinstance(c.tag, str):
+                continue
+            part = ET.Element(rnode.tag, nsmap=rnode.nsmap)
+            part.append(deepcopy(c))
+            parts.setdefault(c.tag, []).append(((i, j), ET.tostring(part)))
+
+    # Check all tags before starting any worker.
+    bases = {}
+    for tag in parts:
+        lcs = list(lnode.iterchildren(tag))
+        if lcs and lnode.index(lcs[-1]) - lnode.index(lcs[0]) != len(lcs) - 1:
+            return False
+        base = ET.Element(lnode.tag, nsmap=lnode.nsmap)
+        base.extend(deepcopy(lc) for lc in lcs)
+        bases[tag] = ET.tostring(base)
+
+    futures = {}
+    with ProcessPoolExecutor(max_workers) as executor:
+        for tag, edits in parts.items():
+            futures[tag] = executor.submit(merge_partition, bases[tag], edits, schema, use_index)
+        results = {tag: future.result() for tag, future in futures.items()}
+
+    errors = [(result[1], result[2]) for result in results.values() if result[0] is None]
+    if errors:
+        raise MergeError(min(errors)[1])
+    if any(result[2] for result in results.values()):
+        return False
+
+    added = []
+    for tag, (merged, first, _) in results.items():
+        subtrees = list(ET.fromstring(merged))
+        lcs = list(lnode.iterchildren(tag))
+        if lcs:
+            pos = lnode.index(lcs[0])
+            for lc in lcs:
+                lnode.remove(lc)
+            for k, e in enumerate(subtrees):
+                lnode.insert(pos+k, e)
+        elif subtrees:
+            added.append((first, subtrees))
+    # New tags are appended in the order they were first added.
+    for _, subtrees in sorted(added, key=lambda x: x[0]):
+        lnode.extend(subtrees)
+    return True
+
+def merge_partition(lnode, rnodes, schema, use_index):
+    # Merge the serialized edits of the subtrees with one tag in a worker.
+    # Returns the merged subtrees, the step they were first added and if
+    # they were all deleted and added again, or None, the step and the
+    # message of a MergeError.
+    lnode = ET.fromstring(lnode)
+    index = KeyIndex(lnode, schema) if use_index else None
+    first = None if len(lnode) == 0 else (-1, -1)
+    readded = False
+    emptied = False
+    for step, rnode in rnodes:
+        try:
+            merge_tree(lnode, ET.fromstring(rnode), schema, index, True)
+        except MergeError as e:
+            return None, step, str(e)
+        if len(lnode) == 0:
+            emptied = first is not None
+        else:
+            readded = readded or emptied
+            if first is None:
+                first = step
+    return ET.tostring(lnode), first, readded
+
+
+def get_operation(c):
+    return c.get('operation', c.get(NC_OPERATION, 'merge'))
+
+def plan_child(plan, schema, step, c):
+    # Add the touch (step, c) of the edit element c to the plan of its
+    # level: tag -> key -> [touches, plan of the children]. Containers that
+    # are only merged get the plan of their children in plan_children.
+    if not isinstance(c.tag, str):
+        raise StreamMergeError('Comments in edits can not be streamed.')
+    node = schema.child(c.tag)
+    if node is None:
+        raise MergeError(f"ERROR: Tag {no_ns(c.tag)} not found in schema.")
+    key = None
+    if node.kind == 'list' and node.keys:
+        key = get_key(c, node.keys)
+        if key is None:
+            raise MergeError(f'List key leaf "{", ".join(node.keynames())}" not found.')
+    plan.setdefault(c.tag, {}).setdefault(key, [[], None])[0].append((step, c))
+
+def plan_children(plan, schema):
+    for tag, entries in plan.items():
+        node = schema.child(tag)
+        if node.kind != 'container':
+            continue
+        touches = entries[None][0]
+        if all(get_operation(c) == 'merge' and has_subelements(c) for _, c in touches):
+            children = entries[None][1] = {}
+            for step, p in touches:
+                for j, c in enumerate(p):
+                    plan_child(children, node, step + (j,), c)
+            plan_children(children, node)
+
+def stream_plan(sources, schema):
+    # Iterparse the edit documents sources and plan the children of their
+    # roots by identity, their tag and key. The edits need not follow the
+    # order of the source, so the plan keeps them all. Returns the root
+    # tags and the plan.
+    tags = set()
+    plan = {}
+    for i, source in enumerate(sources):
+        j = 0
+        for event, e in ET.iterparse(source, events=('start', 'end', 'comment', 'pi')):
+            parent = e.getparent()
+            if parent is None:
+                if event == 'start':
+                    tags.add(e.tag)
+            elif event != 'start' and parent.getparent() is None:
+                plan_child(plan, schema, (i, j), e)
+                j += 1
+    plan_children(plan, schema)
+    return tags, plan
+
+class StreamGroup:
+    # The source elements with a tag of a container and their edits.
+
+    def __init__(self, tag, entries):
+        self.tag = tag
+        # key -> [touches, plan of the children]
+        self.entries = entries
+        self.matched = set()
+        # The source elements, the ones kept and the steps they were deleted
+        self.count = 0
+        self.kept = 0
+        self.deleted = []
+        # Touches to merge as new elements after the source elements, and
+        # the keys they were taken from
+        self.new = []
+        self.pooled = set()
+        self.closed = False
+
+class StreamLevel:
+    # A container of the source being streamed.
+
+    def __init__(self, elem, schema, plan, context):
+        self.elem = elem
+        self.schema = schema
+        self.context = context
+        # tag -> StreamGroup of the edited tags
+        self.groups = {tag: StreamGroup(tag, entries) for tag, entries in plan.items()}
+        # The tag of the current child (None for comments)
+        self.tag = None
+        self.started = False
+        # (last child, write its tail) once written
+        self.pending = None
+        # (step, elements) to append
+        self.tail = []
+        self.error = None
+
+def write_element(xf, e, with_tail=True):
+    e.attrib.pop('operation', None)
+    e.attrib.pop('key', None)
+    cleanup_attributes(e)
+    xf.write(e, with_tail=with_tail)
+
+def stream_flush(level, xf):
+    # Write what comes before the next child.
+    if not level.started:
+        if level.elem.text:
+            xf.write(level.elem.text)
+        level.started = True
+    elif level.pending is not None:
+        e, with_tail = level.pending
+        if with_tail and e.tail:
+            xf.write(e.tail)
+        level.pending = None
+        # The tail is written, drop the element to save memory.
+        level.elem.remove(e)
+
+def stream_next(level, xf, tag):
+    # A child with tag (None for comments) starts. Returns its StreamGroup
+    # if it is edited.
+    stream_flush(level, xf)
+    group = level.groups.get(tag)
+    if tag != level.tag:
+        if level.tag in level.groups:
+            stream_group(level, xf, level.groups[level.tag])
+        if group is not None and group.closed:
+            raise StreamMergeError(f'The elements {no_ns(tag)} are not adjacent.')
+        level.tag = tag
+    return group
+
+def stream_new(level, group, touches):
+    # Merge the touches of elements not in the source. Returns the
+    # elements and the step the first one was added since there were
+    # none.
+    tag = group.tag
+    tmp = ET.Element(level.elem.tag, nsmap=level.elem.nsmap)
+    first = None
+    for step, c in sorted(touches, key=lambda x: x[0]):
+        operation = get_operation(c)
+        if operation == 'delete' and has_subelements(c) and next(tmp.iterchildren(tag), None) is None:
+            # Fails if the source still has elements with the tag.
+            if group.count > sum(1 for d in group.deleted if d < step):
+                node = level.schema.child(tag)
+                key = None
+                if node.kind == 'list' and node.keys:
+                    key = key_str(node, get_key(c, node.keys))
+                raise MergeError(f'Element {no_ns(tag)} '
+                                 f'with {key} '
+                                 f'does not exists.')
+            continue
+        w = ET.Element(level.elem.tag, nsmap=level.elem.nsmap)
+        w.append(deepcopy(c))
+        merge_tree(tmp, w, level.schema, None, True)
+        if not len(tmp):
+            first = None
+        elif first is None:
+            first = step
+    return list(tmp), first
+
+def stream_group(level, xf, group):
+    # The source elements with the tag of group have ended, add the new
+    # ones after them.
+    group.closed = True
+    touches = group.new
+    for key, (entry_touches, _) in group.entries.items():
+        if key not in group.matched:
+            touches.extend(entry_touches)
+    if not touches:
+        return
+    try:
+        elements, first = stream_new(level, group, touches)
+    except MergeError as e:
+        # Raised when the container ends, unless the tag comes again.
+        level.error = level.error or e
+        return
+    if not elements:
+        return
+    if group.kept or any(d > first for d in group.deleted):
+        for e in elements:
+            write_element(xf, e)
+    else:
+        # All were deleted before, append them as new.
+        level.tail.append((first, elements))
+
+def stream_element(level, xf, b, group):
+    # Merge the touches of the source element b and write the result.
+    tag = b.tag
+    key = None
+    entry = None
+    if group is not None:
+        group.count += 1
+        node = level.schema.child(tag)
+        if node.kind == 'list' and node.keys:
+            key = get_key(b, node.keys)
+        entry = group.entries.get(key)
+    if entry is None:
+        if group is not None:
+            group.kept += 1
+        write_element(xf, b, False)
+        level.pending = (b, True)
+        return
+
+    touches = entry[0]
+    operations = [get_operation(c) for _, c in touches]
+    if key in group.matched:
+        # More elements with the same identity, e.g. leaf-list values.
+        if not (all(op == 'merge' for op in operations) and all(has_subelements(c) for _, c in touches) or
+                all(op in ('delete', 'remove') for op in operations)):
+            raise StreamMergeError(f'Several elements {no_ns(tag)} can not be streamed.')
+    group.matched.add(key)
+
+    if key is None and 'create' in operations:
+        # Created after the last element with the tag.
+        if len(touches) > 1:
+            raise StreamMergeError(f'Element {no_ns(tag)} created and edited can not be streamed.')
+        group.new.extend(touches)
+        group.kept += 1
+        write_element(xf, b, False)
+        level.pending = (b, True)
+        return
+
+    tmp = ET.Element(level.elem.tag, nsmap=level.elem.nsmap)
+    bcopy = deepcopy(b)
+    tmp.append(bcopy)
+    for k, (step, c) in enumerate(touches):
+        w = ET.Element(level.elem.tag, nsmap=level.elem.nsmap)
+        w.append(deepcopy(c))
+        merge_tree(tmp, w, level.schema, None, True)
+        if len(tmp) == 0:
+            group.deleted.append(step)
+            if k + 1 < len(touches) and key not in group.pooled:
+                # Added again after the last element with the tag.
+                group.pooled.add(key)
+                group.new.extend(touches[k+1:])
+            break
+
+    results = list(tmp)
+    if results:
+        group.kept += 1
+    if bcopy in results:
+        for e in results:
+            write_element(xf, e, e is not bcopy)
+        level.pending = (b, True)
+    else:
+        for e in results:
+            write_element(xf, e)
+        level.pending = (b, False)
+
+def stream_close(level, xf):
+    # The container ends, add the new elements and close it.
+    stream_flush(level, xf)
+    # Tags the source does not have are all new.
+    for group in [level.groups.get(level.tag)] + list(level.groups.values()):
+        if group is not None and not group.closed:
+            stream_group(level, xf, group)
+    if level.error is not None:
+        raise level.error
+    for _, elements in sorted(level.tail, key=lambda x: x[0]):
+        for e in elements:
+            write_element(xf, e)
+    level.context.__exit__(None, None, None)
+
+def merge_stream(source, edits, schema, output):
+    """Merge the edits in turn into the document source while streaming it
+    to output.
+
+    source, output and the edits are file names or files. The edits are
+    iterparsed and grouped first, then the source is iterparsed and
+    merged. Only the edits, the open containers and the current list entry
+    are kept in memory, so the source can be larger than it.
+
+    The output is what main gives without unit_test, except that the
+    namespaces are declared again on the list entries and comments outside
+    the root are dropped. If several edits fail the one reported may
+    differ.
+
+    Raises StreamMergeError if the edits can't be merged while streaming,
+    possibly after some output is written. That is when an edit has
+    comments below the root, when an element with several instances in the
+    source (e.g. leaf-list values) is replaced or merged as a leaf, or
+    when the elements with a tag which is edited are not adjacent in the
+    source.
+    """
+    schema = get_schema_node(schema)
+    tags, plan = stream_plan(edits, schema)
+    stack = []
+    skip = None
+    with ET.xmlfile(output) as xf:
+        for event, e in ET.iterparse(source, events=('start', 'end', 'comment', 'pi')):
+            if skip is not None:
+                if event == 'end' and e is skip:
+                    skip = None
+                    stream_element(stack[-1], xf, e, group)
+                continue
+
+            if event in ('comment', 'pi'):
+                if stack:
+                    stream_next(stack[-1], xf, None)
+                    xf.write(e, with_tail=False)
+                    stack[-1].pending = (e, True)
+            elif event == 'end':
+                level = stack.pop()
+                stream_close(level, xf)
+                if stack:
+                    stack[-1].pending = (e, True)
+            elif not stack:
+                # Verify that the root tags are the same
+                assert(tags <= {e.tag})
+                context = xf.element(e.tag, dict(e.attrib), e.nsmap)
+                context.__enter__()
+                stack.append(StreamLevel(e, schema, plan, context))
+            else:
+                level = stack[-1]
+                group = stream_next(level, xf, e.tag)
+                node = level.schema.child(e.tag) if level.schema is not None else None
+                entry = group.entries.get(None) if group is not None else None
+                if node is not None and node.kind == 'container' and (entry is None or entry[1] is not None):
+                    # Merged, stream its children.
+                    if group is not None:
+                        group.count += 1
+                        group.kept += 1
+                        group.matched.add(None)
+                    attrib = {k: v for k, v in e.attrib.items() if k not in ('operation', 'key')}
+                    nsmap = {k: v for k, v in e.nsmap.items() if level.elem.nsmap.get(k) != v}
+                    context = xf.element(e.tag, attrib, nsmap)
+                    context.__enter__()
+                    stack.append(StreamLevel(e, node, entry[1] if entry is not None else {}, context))
+                else:
+                    skip = e
+
+
+def main(files, schema, unit_test=False, use_index=False, move=True, batch=False, workers=0, output=None):
+    # schema is the raw JSON schema of the children of the root, or a
+    # compiled schema with the root as a child. With batch the edits are
+    # coalesced and merged together when possible. With workers the
+    # subtrees are merged in a pool of that many processes. With output,
+    # a file name or a file, the first file is streamed into it instead,
+    # and the result is ''.
+    if output is not None:
+        return main_stream(files, schema, use_index, output)
+    ltree = index = acc = None
+    entries = {}
+    rnodes = []
     try:
         parser = ET.XMLParser(remove_blank_text=True) if unit_test else None
         for filename in files:
             doc = ET.parse(filename, parser)
             if ltree is None:
                 ltree = doc
+                if isinstance(schema, SchemaNode) and schema.kind == 'tree':
+                    schema = schema.child(ltree.getroot().tag)
+                    if schema is None:
+                        raise MergeError(f"ERROR: Tag {ltree.getroot().tag} not found in schema.")
+                if use_index:
+                    index = KeyIndex(ltree.getroot(), schema)
             else:
                 # Verify that the root tags are the same
                 assert(ltree.getroot().tag == doc.getroot().tag)
-                # Merge the trees
-                merge_tree(ltree.getroot(), doc.getroot(), schema)
+                if workers:
+                    rnodes.append(doc.getroot())
+                elif not batch:
+                    # Merge the trees
+                    merge_tree(ltree.getroot(), doc.getroot(), schema, index, move)
+                elif acc is None:
+                    acc = doc.getroot()
+                elif not coalesce(acc, doc.getroot(), schema, entries):
+                    merge_tree(ltree.getroot(), acc, schema, index, True)
+                    acc = doc.getroot()
+                    entries = {}
+        if acc is not None:
+            merge_tree(ltree.getroot(), acc, schema, index, True)
+        if rnodes and not merge_parallel(ltree.getroot(), rnodes, schema, use_index, workers):
+            for rnode in rnodes:
+                merge_tree(ltree.getroot(), rnode, schema, index, move)
 
         if ltree is not None:
             cleanup_attributes(ltree.getroot())
             return 0, ET.tostring(ltree, pretty_print=unit_test).decode('utf-8')
     except MergeError as e:
+        if batch:
+            # Merge in turn to fail the same way.
+            return main(files, schema, unit_test, use_index, move)
         return 1, f"ERROR: {e}"
 
 
+def main_stream(files, schema, use_index, output):
+    try:
+        if isinstance(schema, SchemaNode) and schema.kind == 'tree':
+            _, root = next(ET.iterparse(files[0], events=('start',)))
+            schema = schema.child(root.tag)
+            if schema is None:
+                raise MergeError(f"ERROR: Tag {root.tag} not found in schema.")
+        if isinstance(output, str):
+            merge_stream(files[0], files[1:], schema, output)
+        else:
+            # Buffered so that nothing is written to output if the edits
+            # can't be streamed, output need not be seekable.
+            with tempfile.TemporaryFile() as f:
+                merge_stream(files[0], files[1:], schema, f)
+                f.seek(0)
+                shutil.copyfileobj(f, output)
+        return 0, ''
+    except StreamMergeError:
+        # Merge in memory instead.
+        status, result = main(files, schema, use_index=use_index)
+        if status == 0:
+            if isinstance(output, str):
+                with open(output, 'wb') as f:
+                    f.write(result.encode('utf-8'))
+            else:
+                output.write(result.encode('utf-8'))
+            result = ''
+        return status, result
+    except MergeError as e:
+        return 1, f"ERROR: {e}"
+
 if __name__ == "__main__":
-    schema_file = json.loads(open(sys.argv[1]).read())
-    tree = schema_file['tree']
-    rootkey = list(tree.keys())[0]
-    schema = tree[rootkey][1]
+    schema = compile_schema(json.loads(open(sys.argv[1]).read()))
     status, xml = main(sys.argv[2:], schema, True)
     print(xml)
     sys.exit(status)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- mode: python; python-indent: 4 -*-
+
+# Benchmark of netconf_merge.merge_tree on the tailf-ncs-config payloads.
+#
+# enable-ha.xml is the base configuration. The stream payloads are
+# repeated for the given number of event streams, both as one edit per
+# stream and as one bulk edit with all streams. Batch coalesces the edits
+# before merging them.
+
+import argparse
+import copy
+import json
+import timeit
+
+from lxml import etree
+
+from netconf_merge import KeyIndex, coalesce, compile_schema, merge_tree
+
+PAYLOADS = ["merge_stream.xml", "replace_stream.xml", "merge_stream.xml"]
+
+
+def get_schema(filename, raw):
+    doc = json.loads(open(filename).read())
+    if raw:
+        tree = doc['tree']
+        return tree[list(tree.keys())[0]][1]
+    return compile_schema(doc)
+
+
+def get_edits(filename, streams):
+    doc = etree.parse(filename).getroot()
+    stream = doc.find('.//{*}stream')
+    parent = stream.getparent()
+    parent.remove(stream)
+    edits = []
+    for i in range(streams):
+        edit = copy.deepcopy(doc)
+        s = copy.deepcopy(stream)
+        s.find('{*}name').text = f'stream-{i}'
+        edit.find('.//{*}event-streams').append(s)
+        edits.append(edit)
+    return edits
+
+
+def get_bulk(edits):
+    bulk = copy.deepcopy(edits[0])
+    streams = bulk.find('.//{*}event-streams')
+    for edit in edits[1:]:
+        streams.extend(copy.deepcopy(edit.find('.//{*}event-streams')))
+    return bulk
+
+
+def run(base, edits, schema, use_index, move, batch):
+    ltree = copy.deepcopy(base)
+    index = KeyIndex(ltree, schema) if use_index else None
+    if batch:
+        acc, entries = edits[0], {}
+        for edit in edits[1:]:
+            if not coalesce(acc, edit, schema, entries):
+                merge_tree(ltree, acc, schema, index, True)
+                acc, entries = edit, {}
+        edits = [acc]
+    for edit in edits:
+        merge_tree(ltree, edit, schema, index, move)
+    return ltree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--streams', type=int, default=1000, help='Event streams')
+    parser.add_argument('-n', '--number', type=int, default=3, help='Runs to time')
+    parser.add_argument('--schema', default='tailf-ncs-config-5.7.json')
+    parser.add_argument('--raw', action='store_true', help='Use the JSON schema uncompiled')
+    args = parser.parse_args()
+
+    base = etree.parse('enable-ha.xml').getroot()
+    schema = get_schema(args.schema, args.raw)
+    if not args.raw:
+        schema = schema.child(base.tag)
+    edits = []
+    for filename in PAYLOADS:
+        edits.extend(get_edits(filename, args.streams))
+    bulk = [get_bulk(edits[i:i + args.streams]) for i in range(0, len(edits), args.streams)]
+
+    for name, payload in (('single', edits), ('bulk', bulk)):
+        results = {}
+        for use_index in (False, True):
+            for move, batch in ((False, False), (True, False), (True, True)):
+                # Each run needs its own edits when moving.
+                runs = [copy.deepcopy(payload) for _ in range(args.number)]
+                result = etree.tostring(run(base, runs[0], schema, use_index, move, batch))
+                results.setdefault(result, []).append((use_index, move, batch))
+                elapsed = timeit.timeit(lambda: run(base, runs.pop(), schema, use_index, move, batch),
+                                        number=args.number - 1) if args.number > 1 else 0
+                print(f'{name:6} index={use_index!s:5} move={move!s:5} batch={batch!s:5} '
+                      f'{elapsed * 1000 / max(args.number - 1, 1):9.1f} ms')
+        assert len(results) == 1, 'Results differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Copyright (c) 2015, Deutsche Telekom AG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import asyncio
+import getpass
+import logging
+import os
+import shutil
+import socket
+
+from async_netconf import base
+from async_netconf import client
+from async_netconf import server
+from async_netconf import util
+from netconf.error import RPCError
+
+logger = logging.getLogger(__name__)
+NC_DEBUG = False
+
+
+class NetconfMethods(server.NetconfMethods):
+    def rpc_get(self, session, rpc, filter_or_none):
+        del session, rpc, filter_or_none  # unused
+        data = util.elm("nc:data")
+        util.subelm(data, "nc:ok")
+        return data
+
+    def rpc_get_config(self, session, rpc, source_elm, filter_or_none):
+        del session, source_elm, filter_or_none  # unused
+        raise server.ncerror.AccessDeniedAppError(rpc)
+
+    def rpc_echo(self, session, rpc, value):
+        del session, rpc  # unused
+        return util.leaf_elm("nc:value", value.text)
+
+    def rpc_count(self, session, rpc, count):
+        del session, rpc  # unused
+        for i in range(int(count.text)):
+            yield util.leaf_elm("nc:value", i)
+        yield b"<nc:value>done</nc:value>"
+
+    def rpc_serialized(self, session, rpc):
+        del session, rpc  # unused
+        return b'<value xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">serialized</value>'
+
+    def rpc_bad(self, session, rpc):
+        del session, rpc  # unused
+        yield util.leaf_elm("nc:value", "x" * 100000)
+        yield object()
+
+    async def rpc_acount(self, session, rpc, count, fail=None):
+        del session  # unused
+        for i in range(int(count.text)):
+            if fail is not None and i == int(fail.text):
+                raise server.ncerror.AccessDeniedAppError(rpc)
+            await asyncio.sleep(0)
+            yield util.leaf_elm("nc:value", "x" * 1000)
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+async def _start_server(stream_parse=False, msg_format=None):
+    nc_server = server.NetconfSSHServer(server_ctl={getpass.getuser(): "admin"},
+                                        server_methods=NetconfMethods(),
+                                        port=_free_port(),
+                                        host_key="tests/host_key",
+                                        debug=NC_DEBUG,
+                                        stream_parse=stream_parse,
+                                        msg_format=msg_format)
+    await nc_server.listen()
+    return nc_server
+
+
+def _connect(nc_server, max_outstanding=None, stream_parse=False):
+    return client.connect_ssh("127.0.0.1",
+                              port=nc_server.port,
+                              username=getpass.getuser(),
+                              password="admin",
+                              debug=NC_DEBUG,
+                              max_outstanding=max_outstanding,
+                              stream_parse=stream_parse,
+                              known_hosts=None)
+
+
+def test_async_get():
+    async def run():
+        nc_server = await _start_server()
+        async with _connect(nc_server) as session:
+            assert session.session_id is not None
+            assert session.new_framing
+            data = await session.get(timeout=5)
+            assert data.find("nc:ok", namespaces=util.NSMAP) is not None
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_msg_format():
+    async def run():
+        msg_format = base.MessageFormat(xml_declaration=False, cache_hello=True)
+        nc_server = await _start_server(msg_format=msg_format)
+        session_ids = set()
+        for _ in range(2):
+            async with _connect(nc_server) as session:
+                session_ids.add(session.session_id)
+                data = await session.get(timeout=5)
+                assert data.find("nc:ok", namespaces=util.NSMAP) is not None
+                try:
+                    await session.get_config(timeout=5)
+                except RPCError as error:
+                    assert error.get_error_tag() == "access-denied"
+                else:
+                    assert False, "Expected RPCError"
+        assert len(session_ids) == 2
+        assert msg_format.hello.startswith(b"<hello")
+        assert b"session-id" not in msg_format.hello
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_dispatch_validator():
+    def validate_echo(session, rpc, rpc_method):
+        del session  # unused
+        value = rpc_method.find("nc:value", namespaces=util.NSMAP)
+        if value is None or not value.text:
+            raise server.ncerror.MissingElementProtoError(rpc, util.qname("nc:value"))
+        return [value]
+
+    async def run():
+        nc_server = await _start_server()
+        nc_server.dispatcher.add_validator("nc:echo", validate_echo)
+        async with _connect(nc_server) as session:
+            _, reply, _ = await session.send_rpc("<nc:echo><nc:value>x</nc:value></nc:echo>",
+                                                 timeout=5)
+            assert reply[0].text == "x"
+            try:
+                await session.send_rpc("<nc:echo><nc:other/></nc:echo>", timeout=5)
+            except RPCError as error:
+                assert error.get_error_tag() == "missing-element"
+            else:
+                assert False, "Expected RPCError"
+            # Other namespaces are dispatched on the local name.
+            _, reply, _ = await session.send_rpc(
+                '<echo xmlns="urn:test:other"><value>y</value></echo>', timeout=5)
+            assert reply[0].text == "y"
+            try:
+                await session.send_rpc("<nc:missing/>", timeout=5)
+            except RPCError as error:
+                assert error.get_error_tag() == "operation-not-supported"
+            else:
+                assert False, "Expected RPCError"
+        assert "{urn:test:other}echo" in nc_server.dispatcher.handlers
+        assert util.qname("nc:missing").text not in nc_server.dispatcher.handlers
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_shared_options():
+    async def run():
+        options = server.server_options("tests/host_key")
+        nc_servers = [
+            server.NetconfSSHServer(server_ctl={getpass.getuser(): "admin"},
+                                    server_methods=NetconfMethods(),
+                                    port=_free_port(),
+                                    debug=NC_DEBUG,
+                                    options=options) for _ in range(3)
+        ]
+        await asyncio.gather(*[s.listen() for s in nc_servers])
+        for nc_server in nc_servers:
+            async with _connect(nc_server) as session:
+                data = await session.get(timeout=5)
+                assert data.find("nc:ok", namespaces=util.NSMAP) is not None
+            nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_server_options_reload(tmp_path):
+    host_key = str(tmp_path / "host_key")
+    shutil.copy("tests/host_key", host_key)
+    options = server._get_server_options(host_key)  # pylint: disable=W0212
+    assert server._get_server_options(host_key) is options  # pylint: disable=W0212
+    # A rotated key is read again.
+    stat = os.stat(host_key)
+    os.utime(host_key, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert server._get_server_options(host_key) is not options  # pylint: disable=W0212
+    server.clear_server_options()
+    assert not server._SERVER_OPTIONS  # pylint: disable=W0212
+
+
+def test_async_rpc_error():
+    async def run():
+        nc_server = await _start_server()
+        async with _connect(nc_server) as session:
+            try:
+                await session.get_config(timeout=5)
+            except RPCError as error:
+                assert error.get_error_tag() == "access-denied"
+            else:
+                assert False, "Expected RPCError"
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_concurrent_sessions():
+    async def run():
+        nc_server = await _start_server()
+        sessions = [await client.NetconfSSHSession.connect("127.0.0.1",
+                                                            port=nc_server.port,
+                                                            password="admin",
+                                                            known_hosts=None)
+                    for _ in range(5)]
+        results = await asyncio.gather(*[s.get(timeout=5) for s in sessions for _ in range(4)])
+        assert len(results) == 20
+        for session in sessions:
+            session.close()
+            await session.wait_closed()
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+class DeviceMethods(NetconfMethods):
+    def __init__(self, name):
+        self.name = name
+
+    def rpc_get(self, session, rpc, filter_or_none):
+        del session, rpc, filter_or_none  # unused
+        return util.leaf_elm("nc:data", self.name)
+
+
+def test_async_device_routing():
+    def validate_get(session, rpc, rpc_method):
+        del session, rpc, rpc_method  # unused
+        return [None]
+
+    async def get_device(port, username):
+        async with client.connect_ssh("127.0.0.1",
+                                      port=port,
+                                      username=username,
+                                      password="admin",
+                                      known_hosts=None) as session:
+            await session.lock("running", timeout=5)
+            data = await session.get(timeout=5)
+            return data.text
+
+    async def run():
+        devices = {name: DeviceMethods(name) for name in ("dev1", "dev2")}
+        nc_server = server.NetconfSSHServer(server_ctl={name: "admin" for name in devices},
+                                            port=_free_port(),
+                                            host_key="tests/host_key",
+                                            debug=NC_DEBUG,
+                                            device_methods=devices)
+        await nc_server.listen()
+        # Each device has its own locks so both sessions can lock running.
+        async with client.connect_ssh("127.0.0.1",
+                                      port=nc_server.port,
+                                      username="dev1",
+                                      password="admin",
+                                      known_hosts=None) as session:
+            await session.lock("running", timeout=5)
+            assert await get_device(nc_server.port, "dev2") == "dev2"
+        assert await get_device(nc_server.port, "dev1") == "dev1"
+        assert len(nc_server.acceptors) == 1
+        # Devices of a class share a dispatcher, which gets validators added later.
+        dispatcher = nc_server.get_dispatcher(devices["dev1"])
+        assert dispatcher is nc_server.get_dispatcher(devices["dev2"])
+        assert dispatcher is not nc_server.dispatcher
+        nc_server.dispatcher.add_validator("nc:get", validate_get)
+        assert dispatcher.lookup(util.qname("nc:get").text).validator is validate_get
+        nc_server.close()
+
+        ports = [_free_port(), _free_port()]
+        devices = {port: DeviceMethods(str(port)) for port in ports}
+        nc_server = server.NetconfSSHServer(server_ctl={getpass.getuser(): "admin"},
+                                            port=ports,
+                                            host_key="tests/host_key",
+                                            debug=NC_DEBUG,
+                                            device_methods=devices,
+                                            route_by="port")
+        await nc_server.listen()
+        for port in ports:
+            assert await get_device(port, getpass.getuser()) == str(port)
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def _worker_server(port, session_ids):
+    return server.NetconfSSHServer(server_ctl={getpass.getuser(): "admin"},
+                                   server_methods=NetconfMethods(),
+                                   port=port,
+                                   host_key="tests/host_key",
+                                   debug=NC_DEBUG,
+                                   session_ids=session_ids)
+
+
+async def _get_session_ids(port, count):
+    session_ids = []
+    for _ in range(count):
+        for _ in range(50):
+            try:
+                session = await client.NetconfSSHSession.connect("127.0.0.1",
+                                                                 port=port,
+                                                                 password="admin",
+                                                                 known_hosts=None)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        await session.get(timeout=5)
+        session_ids.append(int(session.session_id))
+        session.close()
+        await session.wait_closed()
+    return session_ids
+
+
+def test_multi_process_server():
+    port = _free_port()
+    mp_server = server.NetconfMultiProcessServer(_worker_server, port, workers=2, restart_delay=0)
+    mp_server.start()
+    try:
+        session_ids = asyncio.run(_get_session_ids(port, 6))
+        assert len(set(session_ids)) == 6
+
+        # Killed workers are restarted and do not reuse session-ids.
+        for process in mp_server.processes:
+            process.kill()
+        mp_server.supervise(timeout=0.5)
+        assert mp_server.restarts == 2
+        assert all(p.is_alive() for p in mp_server.processes)
+        more_ids = asyncio.run(_get_session_ids(port, 6))
+        assert not set(more_ids) & set(session_ids)
+        assert len(set(more_ids)) == 6
+    finally:
+        mp_server.close()
+
+
+def test_multi_process_server_not_started():
+    mp_server = server.NetconfMultiProcessServer(_worker_server, _free_port(), workers=2)
+    # Without workers there is nothing to wait for.
+    mp_server.supervise()
+    mp_server.supervise(timeout=5)
+    mp_server.close()
+    mp_server.supervise()
+    assert mp_server.restarts == 0
+
+
+def test_async_pipelined_batch():
+    async def run():
+        nc_server = await _start_server()
+        async with _connect(nc_server, max_outstanding=3) as session:
+            in_flight = []
+            send_rpc_async = session.send_rpc_async
+
+            def counting_send(rpc, noreply=False):
+                msg_id = send_rpc_async(rpc, noreply)
+                in_flight.append(len(session.rpc_out))
+                return msg_id
+
+            session.send_rpc_async = counting_send
+            rpcs = ["<nc:echo><nc:value>{}</nc:value></nc:echo>".format(i) for i in range(20)]
+            results = await session.send_rpcs(rpcs, timeout=5)
+            assert [r[1][0].text for r in results] == [str(i) for i in range(20)]
+            assert max(in_flight) == 3
+            assert not session.rpc_out
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_stream_parse():
+    async def run():
+        nc_server = await _start_server(stream_parse=True)
+        async with _connect(nc_server, stream_parse=True) as session:
+            value = "x" * 100000
+            _, reply, _ = await session.send_rpc(
+                "<nc:echo><nc:value>{}</nc:value></nc:echo>".format(value), timeout=5)
+            assert reply[0].text == value
+            try:
+                await session.get_config(timeout=5)
+            except RPCError as error:
+                assert error.get_error_tag() == "access-denied"
+            else:
+                assert False, "Expected RPCError"
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_serialized_reply():
+    async def run():
+        nc_server = await _start_server(msg_format=base.MessageFormat(pretty_print=True))
+        async with _connect(nc_server) as session:
+            _, reply, _ = await session.send_rpc("<nc:serialized/>", timeout=5)
+            assert [e.text for e in reply] == ["serialized"]
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_streamed_reply():
+    async def run():
+        nc_server = await _start_server()
+        async with _connect(nc_server) as session:
+            results = await session.send_rpcs([
+                "<nc:count><nc:count>10</nc:count></nc:count>",
+                "<nc:acount><nc:count>1000</nc:count></nc:acount>",
+                "<nc:echo><nc:value>after</nc:value></nc:echo>",
+                "<nc:acount><nc:count>5</nc:count><nc:fail>0</nc:fail></nc:acount>",
+                "<nc:acount><nc:count>5</nc:count><nc:fail>3</nc:fail></nc:acount>",
+            ],
+                                              timeout=5,
+                                              return_exceptions=True)
+            assert [e.text for e in results[0][1]] == [str(i) for i in range(10)] + ["done"]
+            assert len(results[1][1]) == 1000
+            assert results[2][1][0].text == "after"
+            for error in results[3:]:
+                assert isinstance(error, RPCError)
+                assert error.get_error_tag() == "access-denied"
+            assert len(results[4].tree.getroot()) == 4
+        nc_server.close()
+
+    asyncio.run(run())
+
+
+def test_async_streamed_reply_bad_item(caplog):
+    async def run():
+        nc_server = await _start_server()
+        async with _connect(nc_server) as session:
+            try:
+                await session.send_rpc("<nc:bad/>", timeout=5)
+            except asyncio.TimeoutError:
+                assert False, "Expected the session to be closed"
+            except Exception:  # pylint: disable=W0703
+                pass
+            else:
+                assert False, "Expected an error"
+        nc_server.close()
+
+    asyncio.run(run())
+    assert "Closing session due to error while streaming reply" in caplog.text
+    assert "never retrieved" not in caplog.text
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import copy
+import json
+
+import pytest
+from lxml import etree
+
+from async_netconf import util
+from async_netconf.datastore import Datastore, DatastoreCache, DeltaBackend, ReplyCache, XMLBackend
+from async_netconf.datastore import get_filter_key, get_filter_tags
+from netconf.util import Fingerprints
+from netconf_merge import merge_tree, MergeError
+
+ROUTER = "{http://example.com/router}"
+PARSER = etree.XMLParser(remove_blank_text=True)
+SCHEMA = json.load(open("async_example/router.json"))["tree"]["router:sys"][1]
+BASELINE = etree.parse("async_example/router.xml", PARSER).getroot()
+
+EDIT = """<sys xmlns="http://example.com/router">
+  <interfaces>
+    <interface>
+      <name>eth0</name>
+      <unit><name>{}</name><enabled>false</enabled></unit>
+    </interface>
+  </interfaces>
+  <dns><server><address>10.0.0.{}</address></server></dns>
+</sys>"""
+
+
+def _merge(lnode, rnode, fingerprints=None):
+    merge_tree(lnode, rnode, SCHEMA, move=True, fingerprints=fingerprints)
+
+
+def test_datastore_edits():
+    datastore = Datastore(BASELINE, _merge, max_deltas=4)
+    expected = copy.deepcopy(BASELINE)
+    for i in range(10):
+        edit = etree.fromstring(EDIT.format(i + 10, i), PARSER)
+        datastore.edit(edit)
+        merge_tree(expected, copy.deepcopy(edit), SCHEMA)
+        assert etree.tostring(datastore.get()) == etree.tostring(expected)
+    # Deltas are folded once there are too many.
+    assert set(datastore.subtrees) == {ROUTER + "interfaces", ROUTER + "dns"}
+    assert all(len(deltas) <= 4 for deltas in datastore.deltas.values())
+    assert etree.tostring(BASELINE) == etree.tostring(
+        etree.parse("async_example/router.xml", PARSER).getroot())
+
+
+def test_datastore_failed_edit():
+    datastore = Datastore(BASELINE, _merge)
+    datastore.edit(etree.fromstring(EDIT.format(10, 1), PARSER))
+    before = etree.tostring(datastore.get())
+    edit = etree.fromstring(EDIT.format(11, 2), PARSER)
+    edit[0][0][1].set("operation", "create")
+    edit[0][0][1][0].text = "10"
+    with pytest.raises(MergeError):
+        datastore.edit(edit)
+    assert etree.tostring(datastore.get()) == before
+
+
+def test_datastore_filtered_get():
+    datastore = Datastore(BASELINE, _merge)
+    datastore.edit(etree.fromstring(EDIT.format(10, 1), PARSER))
+    felm = util.elm("nc:filter")
+    etree.SubElement(etree.SubElement(felm, ROUTER + "sys"), ROUTER + "dns")
+    assert get_filter_tags(BASELINE.tag, felm) == [ROUTER + "dns"]
+    root = datastore.get(felm)
+    assert [child.tag for child in root] == [ROUTER + "dns"]
+    assert root.find(ROUTER + "dns/" + ROUTER + "server[" + ROUTER + "address='10.0.0.1']") is not None
+
+    # A root without namespace matches too.
+    plain = etree.fromstring("<filter><sys><dns xmlns='http://example.com/router'/></sys></filter>")
+    assert get_filter_tags(BASELINE.tag, plain) == [ROUTER + "dns"]
+    assert etree.tostring(datastore.get(plain)) == etree.tostring(root)
+    plain = etree.fromstring("<filter><sys><dns/></sys></filter>")
+    assert get_filter_tags(BASELINE.tag, plain) is None
+    assert etree.tostring(datastore.get(plain)) == etree.tostring(datastore.get())
+
+    felm[0].clear()
+    assert get_filter_tags(BASELINE.tag, felm) is None
+    felm.set(util.qname("nc:type").text, "xpath")
+    assert get_filter_tags(BASELINE.tag, felm) is None
+
+
+@pytest.mark.parametrize("backend", [DeltaBackend(), XMLBackend()])
+def test_datastore_cache_eviction(backend):
+    cache = DatastoreCache(max_trees=2, backend=backend)
+    datastores = [Datastore(BASELINE, _merge, max_deltas=2, cache=cache) for _ in range(4)]
+    expected = [copy.deepcopy(BASELINE) for _ in datastores]
+    for i in range(5):
+        for datastore, tree in zip(datastores, expected):
+            edit = etree.fromstring(EDIT.format(i + 10, i), PARSER)
+            datastore.edit(edit)
+            merge_tree(tree, copy.deepcopy(edit), SCHEMA)
+            assert len(cache.datastores) <= 2
+        # Evicted datastores are reloaded on use.
+        for datastore, tree in zip(datastores, expected):
+            assert etree.tostring(datastore.get()) == etree.tostring(tree)
+    assert all(datastore.stored is not None for datastore in datastores[:2])
+    assert all(datastore.tree is not None for datastore in datastores[2:])
+
+
+def test_reply_cache():
+    datastore = Datastore(BASELINE, _merge)
+    replies = ReplyCache(max_size=2 * len(etree.tostring(BASELINE)))
+    builds = []
+
+    def build():
+        builds.append(datastore.version)
+        return datastore.get()
+
+    felm = etree.fromstring("<filter><sys xmlns='http://example.com/router'><dns/></sys></filter>")
+    spaced = etree.fromstring("<filter>\n  <sys xmlns='http://example.com/router'>\n"
+                              "    <dns/>\n  </sys>\n</filter>")
+    assert get_filter_key(felm) == get_filter_key(spaced)
+    assert get_filter_key(None) is None
+
+    first = replies.get(datastore, None, build)
+    assert replies.get(datastore, None, build) is first
+    assert replies.get(datastore, felm, build) is replies.get(datastore, spaced, build)
+    assert builds == [0, 0]
+
+    # An edit bumps the version so older replies are not used.
+    datastore.edit(etree.fromstring(EDIT.format(10, 1), PARSER))
+    assert datastore.version == 1
+    assert replies.get(datastore, None, build) == etree.tostring(datastore.get())
+    assert builds == [0, 0, 1]
+    replies.invalidate(datastore)
+    assert not replies.entries and not replies.filters and replies.size == 0
+
+    # The least recently used replies are dropped to stay within the size.
+    other = Datastore(BASELINE, _merge)
+    for store in (datastore, other, datastore, other):
+        replies.get(store, None, store.get)
+        replies.get(store, felm, build)
+    assert replies.size <= replies.max_size
+
+
+@pytest.mark.parametrize("cache", [None, DatastoreCache(max_trees=1)])
+@pytest.mark.parametrize("fingerprints", [False, True])
+def test_datastore_fingerprint(cache, fingerprints):
+    datastore = Datastore(BASELINE, _merge, cache=cache, fingerprints=fingerprints)
+    other = Datastore(BASELINE, _merge, cache=cache)
+    felm = etree.fromstring("<filter><sys xmlns='http://example.com/router'><dns/></sys></filter>")
+    assert datastore.fingerprint() == other.fingerprint()
+    dns = datastore.fingerprint(felm)
+
+    # Edits of other subtrees and edits which change nothing keep the hash.
+    datastore.edit(etree.fromstring(EDIT.format(10, 1), PARSER))
+    assert datastore.fingerprint() != other.fingerprint()
+    assert datastore.fingerprint(felm) != dns
+    dns = datastore.fingerprint(felm)
+    datastore.edit(etree.fromstring(EDIT.format(11, 1), PARSER))
+    assert datastore.fingerprint(felm) == dns
+    other.edit(etree.fromstring(EDIT.format(10, 1), PARSER))
+    other.edit(etree.fromstring(EDIT.format(11, 1), PARSER))
+    assert datastore.fingerprint() == other.fingerprint()
+    assert set(datastore.digests) == set(datastore.get_tags())
+
+
+def test_datastore_fingerprints_in_place():
+    datastore = Datastore(BASELINE, _merge, cache=DatastoreCache(), fingerprints=True)
+    datastore.fingerprint()
+    tree = datastore.tree
+    hashes = datastore.fingerprints.hashes
+    dns = tree.find(ROUTER + "dns")
+    unit = tree.find(ROUTER + "interfaces/" + ROUTER + "interface/" + ROUTER + "unit")
+    edit = etree.fromstring(EDIT.format(10, 1), PARSER)
+    datastore.edit(edit)
+    # Only the hashes along the edited paths are dropped.
+    assert datastore.tree.find(ROUTER + "dns") is dns and dns not in hashes
+    assert unit in hashes
+    other = Datastore(BASELINE, _merge)
+    other.edit(edit)
+    assert etree.tostring(datastore.get()) == etree.tostring(other.get())
+    assert datastore.fingerprint() == other.fingerprint()
+    for e in datastore.tree.iter(etree.Element):
+        assert datastore.fingerprints.get(e) == Fingerprints().get(e)
+
+
+def test_reply_cache_fingerprints():
+    datastore = Datastore(BASELINE, _merge)
+    replies = ReplyCache(fingerprints=True)
+    felm = etree.fromstring("<filter><sys xmlns='http://example.com/router'><dns/></sys></filter>")
+    builds = []
+
+    def build():
+        builds.append(datastore.version)
+        return datastore.get(felm)
+
+    first = replies.get(datastore, felm, build)
+    edit = etree.fromstring(EDIT.format(10, 1), PARSER)
+    edit.remove(edit.find(ROUTER + "dns"))
+    datastore.edit(edit)
+    # Only the interfaces changed so the reply is still valid.
+    assert replies.get(datastore, felm, build) is first
+    datastore.edit(etree.fromstring(EDIT.format(10, 1), PARSER))
+    assert replies.get(datastore, felm, build) == etree.tostring(datastore.get(felm))
+    assert builds == [0, 2]
+    assert replies.get(datastore, felm, build) is replies.get(datastore, felm, build)
+    assert builds == [0, 2]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Copyright (c) 2015, Deutsche Telekom AG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import pytest
+
+from lxml import etree
+
+from async_netconf.base import NetconfFramingTransport, NetconfStreamParser
+from netconf.error import FramingError
+
+
+def _frame_11(msg, chunksize):
+    data = b""
+    for i in range(0, len(msg), chunksize):
+        chunk = msg[i:i + chunksize]
+        data += b"\n#%d\n" % len(chunk) + chunk
+    return data + b"\n##\n"
+
+
+def _feed(transport, data, new_framing, step):
+    msgs = []
+    for i in range(0, len(data), step):
+        msg = transport.add_to_buffer(data[i:i + step], new_framing)
+        while msg is not None:
+            msgs.append(msg)
+            msg = transport.add_to_buffer(b"", new_framing)
+    return msgs
+
+
+@pytest.mark.parametrize("step", [1, 2, 7, 64, 100000])
+def test_receive_11(step):
+    msgs = [b"<a/>", b"<rpc>" + b"x" * 5000 + b"</rpc>", b"<b>\n##\n</b>"]
+    data = b"".join(_frame_11(m, 1000) for m in msgs)
+    transport = NetconfFramingTransport(None, 16 * 1024, False)
+    assert _feed(transport, data, True, step) == msgs
+    assert not transport.rbuffer and transport.rpos == 0
+
+
+@pytest.mark.parametrize("step", [1, 5, 64, 100000])
+def test_receive_10(step):
+    msgs = [b"<a/>", b"<rpc>]]>" + b"x" * 5000 + b"]]></rpc>", b"<b/>"]
+    data = b"".join(m + b"]]>]]>" for m in msgs)
+    transport = NetconfFramingTransport(None, 16 * 1024, False)
+    assert _feed(transport, data, False, step) == msgs
+    assert not transport.rbuffer
+
+
+def test_receive_11_errors():
+    for data in (b"\n#abc\n", b"\n#0\n", b"xx#4\n", b"\n#12345678901234\n"):
+        transport = NetconfFramingTransport(None, 16 * 1024, False)
+        with pytest.raises(FramingError):
+            transport.add_to_buffer(data, True)
+
+
+class _Stream(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("new_framing", [False, True])
+def test_send_receive(new_framing):
+    stream = _Stream()
+    sender = NetconfFramingTransport(stream, 1000, False)
+    parts = (b"<?xml?>", b"<rpc>" + b"x" * 5000 + b"</rpc>")
+    sender.send_pdu(parts, new_framing)
+    sender.send_pdu(b"<b/>", new_framing)
+    assert max(len(w) for w in stream.writes) <= 1000
+
+    receiver = NetconfFramingTransport(None, 1000, False)
+    assert _feed(receiver, b"".join(stream.writes), new_framing, 333) == [b"".join(parts), b"<b/>"]
+
+
+@pytest.mark.parametrize("new_framing", [False, True])
+@pytest.mark.parametrize("step", [1, 7, 100000])
+def test_stream_parse(new_framing, step):
+    msgs = [b"\n<a/>", b"<rpc>" + b"<x>y</x>" * 1000 + b"</rpc>", b"<b><c/></a>", b"<d/>"]
+    if new_framing:
+        data = b"".join(_frame_11(m, 1000) for m in msgs)
+    else:
+        data = b"".join(m + b"]]>]]>" for m in msgs)
+    transport = NetconfFramingTransport(None, 16 * 1024, False)
+    transport.feeder = NetconfStreamParser()
+    results = _feed(transport, data, new_framing, step)
+    assert len(results) == 4
+    assert results[0].getroot().tag == "a"
+    assert len(results[1].getroot()) == 1000
+    assert isinstance(results[2], etree.XMLSyntaxError)
+    assert results[3].getroot().tag == "d"
+    assert len(transport.rbuffer) < 14
+
+
+def test_stream_parse_keeps_nothing():
+    parser = NetconfStreamParser()
+    for _ in range(3):
+        parser.feed(b"<rpc>" + b"<x/>" * 1000 + b"</rpc>")
+        assert len(parser.close().getroot()) == 1000
+    # Nothing of the parsed messages is held by the parser.
+    assert not list(parser.parser.read_events())
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import copy
+import json
+
+import pytest
+from lxml import etree
+
+import netconf_diff
+from netconf_merge import KeyIndex, MergeError, cleanup_attributes, compile_schema, merge_tree
+
+ROUTER = "{http://example.com/router}"
+PARSER = etree.XMLParser(remove_blank_text=True)
+SCHEMA = compile_schema(json.load(open("async_example/router.json"))).child(ROUTER + "sys")
+BASELINE = etree.parse("async_example/router.xml", PARSER).getroot()
+# The serial interface is not in the router schema.
+BASELINE.find(ROUTER + "interfaces").remove(BASELINE.find(".//{http://example.com/example-serial}serial"))
+
+
+def _unordered(e):
+    # The tree with the children in a canonical order.
+    children = tuple(sorted(_unordered(c) for c in e))
+    return (e.tag, (e.text or "").strip() if not children else "", children)
+
+
+def _check(old, new):
+    edit = netconf_diff.diff_tree(old, new, SCHEMA)
+    for index in (False, True):
+        merged = copy.deepcopy(old)
+        merge_tree(merged, copy.deepcopy(edit), SCHEMA, KeyIndex(merged, SCHEMA) if index else None)
+        cleanup_attributes(merged)
+        assert _unordered(merged) == _unordered(new)
+    return edit
+
+
+def test_diff_tree():
+    assert len(netconf_diff.diff_tree(BASELINE, copy.deepcopy(BASELINE), SCHEMA)) == 0
+
+    new = copy.deepcopy(BASELINE)
+    eth0 = new.find("{0}interfaces/{0}interface".format(ROUTER))
+    etree.SubElement(eth0, ROUTER + "mtu").text = "1400"
+    unit = eth0.find(ROUTER + "unit")
+    unit.find(ROUTER + "enabled").text = "false"
+    routes = new.find("{0}routes/{0}inet".format(ROUTER))
+    routes.remove(routes[1])
+    new.remove(new.find(ROUTER + "dns"))
+    facility = new.find(".//{}facility".format(ROUTER))
+    facility.text = "kern"
+    edit = _check(BASELINE, new)
+
+    operations = [(etree.QName(e).localname, e.get("operation")) for e in edit.iter() if e.get("operation")]
+    assert sorted(operations) == [("dns", "delete"), ("facility", "create"), ("facility", "delete"),
+                                  ("mtu", "create"), ("route", "delete")]
+    # Only the key of the changed unit and the new value are sent.
+    edit_unit = edit.find("{0}interfaces/{0}interface/{0}unit".format(ROUTER))
+    assert [etree.QName(e).localname for e in edit_unit] == ["name", "enabled"]
+    assert len(etree.tostring(edit)) < len(etree.tostring(new)) // 3
+
+    # A new entry with the first key of a deleted one is created after it.
+    route = copy.deepcopy(routes[0])
+    route.find(ROUTER + "prefix-length").text = "24"
+    routes.remove(routes[0])
+    routes.append(route)
+    _check(BASELINE, new)
+
+    # A subtree mostly changed is replaced.
+    newer = copy.deepcopy(new)
+    for leaf in newer.find(ROUTER + "syslog").iter():
+        if len(leaf) == 0 and leaf.tag != ROUTER + "name":
+            leaf.text = "changed"
+    edit = _check(new, newer)
+    assert edit.find(ROUTER + "syslog").get("operation") == "replace"
+
+    with pytest.raises(MergeError):
+        netconf_diff.diff_tree(BASELINE, etree.fromstring('<sys xmlns="{}"><x/></sys>'.format(ROUTER[1:-1])), SCHEMA)
+
+
+def test_diff_main(tmp_path):
+    schema = compile_schema(json.load(open("tailf-ncs-config-5.7.json")))
+    new = tmp_path / "new.xml"
+    new.write_text(open("enable-ha.xml").read().replace("<enabled>true</enabled>", "<enabled>false</enabled>", 1))
+    status, xml = netconf_diff.main(["enable-ha.xml", str(new)], schema)
+    assert status == 0
+    edit = etree.fromstring(xml)
+    assert [e.text for e in edit.iter("{*}enabled")] == ["false"]
+    assert netconf_diff.main(["enable-ha.xml", "async_example/router.xml"], schema)[0] == 1
+
+
+def test_diff_missing_key(tmp_path):
+    old = etree.fromstring('<sys xmlns="http://example.com/router"><interfaces>'
+                           '<interface><mtu>1</mtu></interface></interfaces></sys>')
+    new = etree.fromstring('<sys xmlns="http://example.com/router"><interfaces/></sys>')
+    with pytest.raises(MergeError, match='List key leaf "name" not found'):
+        netconf_diff.diff_tree(old, new, SCHEMA)
+    with pytest.raises(MergeError, match='List key leaf "name" not found'):
+        netconf_diff.diff_tree(new, old, SCHEMA)
+
+    files = [tmp_path / "old.xml", tmp_path / "new.xml"]
+    for filename, root in zip(files, (old, new)):
+        filename.write_bytes(etree.tostring(root))
+    assert netconf_diff.main([str(f) for f in files], SCHEMA) == (
+        1, 'ERROR: List key leaf "name" not found.')
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import copy
+import io
+import json
+
+import pytest
+from lxml import etree
+
+from async_netconf import util
+import netconf_merge
+from netconf_merge import Fingerprints, KeyIndex, compile_schema, merge_tree, MergeError
+
+ROUTER = "{http://example.com/router}"
+PARSER = etree.XMLParser(remove_blank_text=True)
+SCHEMA = json.load(open("async_example/router.json"))["tree"]["router:sys"][1]
+BASELINE = etree.parse("async_example/router.xml", PARSER).getroot()
+
+EDITS = [
+    """<interfaces><interface><name>eth0</name>
+         <unit><name>7</name><enabled>false</enabled></unit>
+         <unit><name>0</name><description>merged</description></unit>
+       </interface></interfaces>""",
+    """<interfaces><interface operation="create"><name>eth9</name><mtu>1400</mtu></interface>
+       </interfaces>""",
+    """<interfaces><interface operation="replace"><name>ppp0</name><mtu>1200</mtu></interface>
+       </interfaces>""",
+    """<routes><inet><route><name>10.20.0.0</name><prefix-length>16</prefix-length>
+         <description>changed</description></route></inet></routes>""",
+    """<routes><inet><route operation="delete"><name>10.30.0.0</name>
+         <prefix-length>16</prefix-length></route></inet></routes>""",
+    """<dns><server operation="remove"><address>10.2.3.4</address></server></dns>""",
+    """<interfaces><interface><name>eth9</name><unit><name>1</name></unit></interface>
+       </interfaces>""",
+]
+
+
+def _edit(xml):
+    return etree.fromstring('<sys xmlns="http://example.com/router">{}</sys>'.format(xml), PARSER)
+
+
+def test_merge_key_index():
+    tree = copy.deepcopy(BASELINE)
+    indexed = copy.deepcopy(BASELINE)
+    index = KeyIndex(indexed, SCHEMA)
+    for xml in EDITS:
+        merge_tree(tree, _edit(xml), SCHEMA)
+        merge_tree(indexed, _edit(xml), SCHEMA, index)
+        assert etree.tostring(indexed) == etree.tostring(tree)
+    assert index.parents
+
+    with pytest.raises(MergeError):
+        merge_tree(indexed, _edit(EDITS[1]), SCHEMA, index)
+    with pytest.raises(MergeError):
+        merge_tree(indexed, _edit(EDITS[4]), SCHEMA, index)
+
+    # Routes are keyed by both name and prefix-length, with or without index.
+    for xml in [
+            """<routes><inet><route><name>10.20.0.0</name><prefix-length>24</prefix-length>
+               <description>new</description></route></inet></routes>""",
+            """<routes><inet><route><name>10.20.0.0</name><prefix-length>16</prefix-length>
+               <description>old</description></route></inet></routes>""",
+            """<routes><inet><route operation="delete"><name>10.20.0.0</name>
+               <prefix-length>24</prefix-length></route></inet></routes>""",
+            """<routes><inet><route operation="create"><name>10.20.0.0</name>
+               <prefix-length>8</prefix-length></route></inet></routes>""",
+    ]:
+        merge_tree(tree, _edit(xml), SCHEMA)
+        merge_tree(indexed, _edit(xml), SCHEMA, index)
+        assert etree.tostring(indexed) == etree.tostring(tree)
+    routes = indexed.findall("{0}routes/{0}inet/{0}route".format(ROUTER))
+    assert [r[1].text for r in routes if r[0].text == "10.20.0.0"] == ["16", "8"]
+    with pytest.raises(MergeError, match="name=10.20.0.0, prefix-length=8 already exists"):
+        merge_tree(tree, _edit(xml), SCHEMA)
+
+
+def test_filter_key_index():
+    tree = copy.deepcopy(BASELINE)
+    index = KeyIndex(tree, SCHEMA)
+    data = util.elm("nc:data")
+    data.append(tree)
+    for felm in [
+            """<interfaces><interface><name>ppp0</name></interface></interfaces>""",
+            """<interfaces><interface><name>eth0</name><unit><name>1</name></unit>
+               <unit><name>2</name><enabled/></unit></interface></interfaces>""",
+            """<routes><inet><route><name>10.20.0.0</name><prefix-length>16</prefix-length>
+               <next-hop/></route></inet></routes>""",
+            """<interfaces><interface><name>none</name></interface></interfaces>""",
+    ]:
+        felm = etree.fromstring(
+            '<filter><sys xmlns="http://example.com/router">{}</sys></filter>'.format(felm), PARSER)
+        expected = util.subtree_filter_result(data, felm)
+        assert etree.tostring(util.subtree_filter_result(data, felm, index)) == etree.tostring(expected)
+    assert index.parents
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_merge_move(use_index):
+    tree = copy.deepcopy(BASELINE)
+    moved = copy.deepcopy(BASELINE)
+    index = KeyIndex(moved, SCHEMA) if use_index else None
+    for xml in EDITS:
+        merge_tree(tree, _edit(xml), SCHEMA)
+        merge_tree(moved, _edit(xml), SCHEMA, index, move=True)
+        assert etree.tostring(moved) == etree.tostring(tree)
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_merge_fingerprints(use_index):
+    tree = copy.deepcopy(BASELINE)
+    fingerprints = Fingerprints()
+    index = KeyIndex(tree, SCHEMA) if use_index else None
+    dns = tree.find(ROUTER + "dns")
+    for xml in EDITS:
+        before = fingerprints.get(dns)
+        merge_tree(tree, _edit(xml), SCHEMA, index, move=True, fingerprints=fingerprints)
+        # The hashes kept are those of the changed tree.
+        assert fingerprints.get(tree) == Fingerprints().get(tree)
+        assert len(fingerprints.hashes) == sum(1 for e in tree.iter() if isinstance(e.tag, str))
+        assert (fingerprints.get(dns) == before) == ("<dns>" not in xml)
+
+    # Whitespace and comments are not hashed, attributes are.
+    spaced = etree.fromstring(etree.tostring(tree, pretty_print=True))
+    spaced[0].append(etree.Comment("comment"))
+    assert fingerprints.equal(tree, spaced)
+    spaced[0].set("changed", "true")
+    fingerprints.invalidate(spaced[0])
+    assert not fingerprints.equal(tree, spaced)
+
+
+def test_compile_schema():
+    schema = compile_schema(json.load(open("tailf-ncs-config-5.7.json")))
+    ncs = "{http://tail-f.com/yang/tailf-ncs-config}"
+    root = schema.child(ncs + "ncs-config")
+    assert root.kind == "container"
+    stream = root.child(ncs + "notifications").child(ncs + "event-streams").child(ncs + "stream")
+    assert (stream.kind, stream.keys, stream.keynames()) == ("list", (ncs + "name",), ("name",))
+    assert stream.child(ncs + "name").kind == "leaf"
+    assert root.child("{urn:other}webui") is None
+    assert root.child(ncs + "webui") is not None
+
+    status, result = netconf_merge.main(["enable-ha.xml", "merge_stream.xml", "replace_stream.xml"], schema,
+                                        True)
+    assert status == 0
+    tree = json.load(open("tailf-ncs-config-5.7.json"))["tree"]
+    assert (status, result) == netconf_merge.main(
+        ["enable-ha.xml", "merge_stream.xml", "replace_stream.xml"], tree["tailf-ncs-config:ncs-config"][1], True)
+
+
+def test_merge_compiled_schema():
+    schema = compile_schema(json.load(open("async_example/router.json"))).child(ROUTER + "sys")
+    tree = copy.deepcopy(BASELINE)
+    compiled = copy.deepcopy(BASELINE)
+    for xml in EDITS:
+        merge_tree(tree, _edit(xml), SCHEMA)
+        merge_tree(compiled, _edit(xml), schema)
+        assert etree.tostring(compiled) == etree.tostring(tree)
+
+    # Tags are only matched in their namespace.
+    edit = etree.fromstring('<sys xmlns="http://example.com/router"><dns xmlns="urn:other"/></sys>')
+    with pytest.raises(MergeError):
+        merge_tree(compiled, edit, schema)
+
+
+def test_coalesce():
+    merged = copy.deepcopy(BASELINE)
+    for xml in EDITS:
+        merge_tree(merged, _edit(xml), SCHEMA)
+
+    tree = copy.deepcopy(BASELINE)
+    acc, entries, batches = None, {}, 0
+    for xml in EDITS:
+        edit = _edit(xml)
+        if acc is None:
+            acc = edit
+        elif not netconf_merge.coalesce(acc, edit, SCHEMA, entries):
+            merge_tree(tree, acc, SCHEMA)
+            acc, entries, batches = edit, {}, batches + 1
+    merge_tree(tree, acc, SCHEMA)
+    assert etree.tostring(tree) == etree.tostring(merged)
+    # Only the merge into the created eth9 is not coalesced.
+    assert batches == 1
+
+    # Later leaf values replace earlier ones.
+    acc = _edit("<interfaces><interface><name>eth0</name><mtu>1300</mtu></interface></interfaces>")
+    assert netconf_merge.coalesce(acc, _edit(EDITS[0]), SCHEMA)
+    assert netconf_merge.coalesce(
+        acc, _edit("<interfaces><interface><name>eth0</name><mtu>1500</mtu></interface></interfaces>"), SCHEMA)
+    assert [e.text for e in acc.iter(ROUTER + "mtu")] == ["1500"]
+    assert len(acc.findall(".//" + ROUTER + "unit")) == 2
+
+    before = etree.tostring(acc)
+    edit = _edit("<interfaces><interface operation='delete'><name>eth0</name></interface></interfaces>")
+    assert not netconf_merge.coalesce(acc, edit, SCHEMA)
+    assert etree.tostring(acc) == before
+
+
+def test_main_batch(tmp_path):
+    schema = compile_schema(json.load(open("tailf-ncs-config-5.7.json")))
+    files = [
+        "enable-ha.xml", "merge_stream.xml", "replace_stream.xml", "merge_stream.xml", "delete_stream.xml",
+        "merge_stream.xml"
+    ]
+    for unit_test in (False, True):
+        for use_index in (False, True):
+            result = netconf_merge.main(files, schema, unit_test, use_index)
+            assert result[0] == 0
+            assert netconf_merge.main(files, schema, unit_test, use_index, batch=True) == result
+
+    # Errors are reported as when merging in turn.
+    files = ["async_example/router.xml"]
+    for i, xml in enumerate(EDITS + EDITS[:2]):
+        files.append(str(tmp_path / "edit{}.xml".format(i)))
+        etree.ElementTree(_edit(xml)).write(files[-1])
+    schema = compile_schema(json.load(open("async_example/router.json")))
+    result = netconf_merge.main(files, schema)
+    assert result == (1, "ERROR: Element interface with name=eth9 already exists.")
+    assert netconf_merge.main(files, schema, batch=True) == result
+
+
+def test_merge_parallel(monkeypatch):
+    tree = copy.deepcopy(BASELINE)
+    for xml in EDITS:
+        merge_tree(tree, _edit(xml), SCHEMA)
+    parallel = copy.deepcopy(BASELINE)
+    edits = [_edit(xml) for xml in EDITS]
+    # Comments in the edits are skipped.
+    edits[0].insert(0, etree.Comment("comment"))
+    assert netconf_merge.merge_parallel(parallel, edits, SCHEMA, max_workers=2)
+    assert etree.tostring(parallel) == etree.tostring(tree)
+
+    # The first failing edit is reported and nothing is changed.
+    before = etree.tostring(parallel)
+    edits = [_edit(EDITS[3]), _edit(EDITS[1]), _edit(EDITS[4])]
+    with pytest.raises(MergeError, match="eth9 already exists"):
+        netconf_merge.merge_parallel(parallel, edits, SCHEMA, max_workers=2)
+    assert etree.tostring(parallel) == before
+
+    # Deleted and added again it would be appended after the new subtrees.
+    edits = [_edit("<dns operation='delete'/>"), _edit("<syslog><server><name>10.3.4.5</name></server></syslog>"), _edit(EDITS[5])]
+    assert not netconf_merge.merge_parallel(parallel, edits, SCHEMA, max_workers=2)
+    assert etree.tostring(parallel) == before
+
+    # Subtrees which are not adjacent are found before starting any worker.
+    split = copy.deepcopy(parallel)
+    split.append(copy.deepcopy(split[0]))
+    monkeypatch.setattr(netconf_merge, "ProcessPoolExecutor", None)
+    assert not netconf_merge.merge_parallel(split, [_edit(EDITS[0])], SCHEMA)
+    monkeypatch.undo()
+
+    schema = compile_schema(json.load(open("tailf-ncs-config-5.7.json")))
+    files = ["enable-ha.xml", "merge_stream.xml", "replace_stream.xml", "delete_stream.xml", "merge_stream.xml"]
+    assert netconf_merge.main(files, schema, workers=2) == netconf_merge.main(files, schema)
+
+
+def test_merge_stream(tmp_path):
+    files = ["async_example/router.xml"]
+    for i, xml in enumerate(EDITS):
+        files.append(str(tmp_path / "edit{}.xml".format(i)))
+        etree.ElementTree(_edit(xml)).write(files[-1])
+    schema = compile_schema(json.load(open("async_example/router.json")))
+
+    def c14n(data):
+        return etree.tostring(etree.fromstring(data), method="c14n")
+
+    status, result = netconf_merge.main(files, schema)
+    output = io.BytesIO()
+    assert netconf_merge.main(files, schema, output=output) == (0, "")
+    assert c14n(output.getvalue()) == c14n(result.encode("utf-8"))
+    assert netconf_merge.main(files + files[2:3], schema, output=io.BytesIO()) == \
+        (1, "ERROR: Element interface with name=eth9 already exists.")
+
+    # Interfaces added after all others are gone go after the serial one.
+    readd = [files[0]]
+    for i, xml in enumerate([
+            """<interfaces><interface><name>eth9</name></interface></interfaces>""",
+            """<interfaces><interface operation="remove"><name>eth0</name></interface>
+               </interfaces>""",
+            """<interfaces><interface operation="delete"><name>eth9</name></interface>
+               </interfaces>""",
+            """<interfaces><interface><name>eth8</name></interface></interfaces>""",
+    ]):
+        readd.append(str(tmp_path / "readd{}.xml".format(i)))
+        etree.ElementTree(_edit(xml)).write(readd[-1])
+    status, result = netconf_merge.main(readd, schema)
+    assert [e.tag for e in etree.fromstring(result.encode("utf-8"))[0]][-1] == ROUTER + "interface"
+    output = io.BytesIO()
+    assert netconf_merge.main(readd, schema, output=output) == (0, "")
+    assert c14n(output.getvalue()) == c14n(result.encode("utf-8"))
+
+    # Routes apart can't be streamed, merged in memory instead.
+    base = open(files[0]).read().replace("</route>", "</route><!-- 10.10 -->", 1)
+    files[0] = str(tmp_path / "base.xml")
+    open(files[0], "w").write(base)
+    with pytest.raises(netconf_merge.StreamMergeError):
+        netconf_merge.merge_stream(files[0], files[1:], schema.child(ROUTER + "sys"), io.BytesIO())
+    output = str(tmp_path / "output.xml")
+    assert netconf_merge.main(files, schema, output=output) == (0, "")
+    assert open(output).read() == netconf_merge.main(files, schema)[1]
+
+    # Output which can't seek, e.g. a pipe, gets the result either way.
+    class Pipe(io.BytesIO):
+        def seekable(self):
+            return False
+
+        def seek(self, *args):
+            raise io.UnsupportedOperation("seek")
+
+        truncate = seek
+
+    output = Pipe()
+    assert netconf_merge.main(files, schema, output=output) == (0, "")
+    assert output.getvalue().decode("utf-8") == netconf_merge.main(files, schema)[1]
+    output = Pipe()
+    assert netconf_merge.main(readd, schema, output=output) == (0, "")
+    assert c14n(output.getvalue()) == c14n(result.encode("utf-8"))
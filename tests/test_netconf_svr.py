@@ -51,6 +51,9 @@ class NetconfMethods(server.NetconfMethods):
     def rpc_namespaced(self, unused_session, rpc, *unused_params):
         return util.elm("nc:ok")
 
+    def rpc_no_reply(self, unused_session, rpc, *unused_params):
+        return None
+
 
 def setup_module(unused_module):
     global nc_server
@@ -125,6 +128,16 @@ def test_namespaced_rpc():
     session.close()
 
 
+def test_none_reply():
+    """TEST: Checked that a None reply is sent as ok."""
+    session = client.NetconfSSHSession("127.0.0.1", password="admin", port=nc_server.port)
+    assert session
+
+    rval = session.send_rpc("<no-reply/>")
+    assert rval[1][0].tag == "ok"
+    session.close()
+
+
 def test_malformed():
     session = client.NetconfSSHSession("127.0.0.1", password="admin", port=nc_server.port)
     assert session
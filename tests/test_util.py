@@ -0,0 +1,132 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+from lxml import etree
+
+import async_netconf
+from async_netconf import util
+
+
+def test_compile_xpath_nsmap_change():
+    felm = etree.fromstring('<filter xmlns="urn:test:a"><name>x</name></filter>')
+    async_netconf.nsmap_add("tu", "urn:test:a")
+    xpath = async_netconf.compile_xpath("tu:name")
+    assert async_netconf.compile_xpath("tu:name") is xpath
+    assert util.filter_leaf_allows(felm, "tu:name", "x")
+    assert not util.filter_leaf_allows(felm, "tu:name", "y")
+    assert [k for k, _ in util.filter_list_iter(felm, "tu:name", ["x", "y"])] == ["x"]
+
+    async_netconf.nsmap_update({"tu": "urn:test:b"})
+    assert async_netconf.compile_xpath("tu:name") is not xpath
+    assert not util.filter_leaf_allows(felm, "tu:name", "x")
+
+
+def test_xpath_filter_result():
+    data = etree.fromstring("""<data xmlns="urn:test:a"><devs>
+      <dev><name>dev1</name><slots>1</slots></dev>
+      <dev><name>dev2</name><slots>2</slots></dev>
+    </devs><other>x</other></data>""")
+    before = etree.tostring(data)
+    async_netconf.nsmap_add("tu", "urn:test:a")
+
+    result = util.xpath_filter_result(data, "/tu:devs/tu:dev[tu:slots='2']/tu:name")
+    assert [e.text for e in result.iter("{urn:test:a}name")] == ["dev2"]
+    assert not list(result.iter("{urn:test:a}slots"))
+    assert [e.tag for e in result] == ["{urn:test:a}devs"]
+
+    # A selected element includes its selected descendants once.
+    result = util.xpath_filter_result(data, "/tu:devs/tu:dev/tu:name | /tu:devs/tu:dev[1]")
+    assert [len(e) for e in result[0]] == [2, 1]
+
+    result = util.xpath_filter_result(data, "/tu:other")
+    assert [(e.tag, e.text) for e in result] == [("{urn:test:a}other", "x")]
+    assert etree.tostring(data) == before
+
+
+def test_subtree_filter_result():
+    data = etree.fromstring("""<data><devs xmlns="urn:test:c">
+      <dev><name>dev1</name><slots>1</slots><ports><port>a</port></ports></dev>
+      <dev><name>dev2</name><slots>2</slots><ports><port>b</port></ports></dev>
+    </devs><other xmlns="urn:test:d">x</other></data>""")
+    before = etree.tostring(data)
+
+    def names(felm):
+        result = util.filter_results(None, data, etree.fromstring(felm))
+        return [(etree.QName(e).localname, e.text) for e in result.iter() if e.text and e.text.strip()]
+
+    # Selection of a top-level node in a namespace unknown to NSMAP.
+    assert names('<filter><other xmlns="urn:test:d"/></filter>') == [("other", "x")]
+    # Content match nodes only select the whole node.
+    assert names("<filter><devs><dev><name>dev2</name></dev></devs></filter>") == [("name", "dev2"),
+                                                                                    ("slots", "2"),
+                                                                                    ("port", "b")]
+    # All content match nodes must match.
+    assert names("<filter><devs><dev><name>dev2</name><slots>1</slots></dev></devs></filter>") == []
+    # Content match with selection and containment nodes.
+    felm = "<filter><devs><dev><name>dev1</name><ports><port/></ports></dev></devs></filter>"
+    assert names(felm) == [("name", "dev1"), ("port", "a")]
+    # Containment nodes are only included if something below is selected.
+    assert names("<filter><devs><dev><ports><none/></ports></dev></devs></filter>") == []
+    # Sibling filter nodes select the union.
+    felm = "<filter><devs><dev><name>dev1</name></dev><dev><slots/></dev></devs></filter>"
+    assert names(felm) == [("name", "dev1"), ("slots", "1"), ("port", "a"), ("slots", "2")]
+    assert etree.tostring(data) == before
+
+    felm = etree.fromstring('<filter><devs xmlns="urn:test:c"><dev><name/></dev></devs></filter>')
+    async_netconf.nsmap_add("tc", "urn:test:c")
+    assert etree.tostring(util.subtree_filter_result(data, felm)) == etree.tostring(
+        util.xpath_filter_result(data, util.filter_to_xpath(felm)))
+
+
+def test_subtree_filter_long_list():
+    # Content match nodes of long lists are looked up with XPath.
+    data = etree.fromstring('<data><devs xmlns="urn:test:c"/></data>')
+    for i in range(100):
+        dev = etree.SubElement(data[0], "{urn:test:c}dev")
+        etree.SubElement(dev, "{urn:test:c}name").text = "dev{}".format(i)
+        etree.SubElement(dev, "{urn:test:c}slots").text = str(i % 2)
+    data[0][42][0].text = "it's \"quoted\""
+
+    def names(felm):
+        result = util.subtree_filter_result(data, etree.fromstring(felm))
+        return [e.text for e in result.iter("{urn:test:c}name")]
+
+    felm = '<filter><devs xmlns="urn:test:c"><dev><name>dev50</name></dev></devs></filter>'
+    assert names(felm) == ["dev50"]
+    # Filter nodes without namespace match any.
+    felm = "<filter><devs><dev><name>dev7</name><slots>{}</slots></dev></devs></filter>"
+    assert names(felm.format(1)) == ["dev7"]
+    assert names(felm.format(0)) == []
+    assert names("<filter><devs><dev><name>it's \"quoted\"</name></dev></devs></filter>") == [
+        "it's \"quoted\""
+    ]
+    # Selected entries are in document order.
+    felm = "<filter><devs><dev><name>dev9</name></dev><dev><name>dev3</name></dev></devs></filter>"
+    assert names(felm) == ["dev3", "dev9"]
+
+
+def test_subtree_filter_attributes():
+    data = etree.fromstring('<data><devs><dev a="1" b="2"><name>dev1</name></dev>'
+                            '<dev a="2"><name>dev2</name></dev></devs></data>')
+
+    def names(felm):
+        result = util.subtree_filter_result(data, etree.fromstring(felm))
+        return [e.text for e in result.iter("name")]
+
+    # Data nodes may have more attributes than the filter node.
+    assert names('<filter><devs><dev a="1"/></devs></filter>') == ["dev1"]
+    assert names('<filter><devs><dev a="2"><name/></dev></devs></filter>') == ["dev2"]
+    assert names('<filter><devs><dev a="1" b="3"/></devs></filter>') == []
+    assert names('<filter><devs><dev c="1"/></devs></filter>') == []
@@ -37,17 +37,10 @@ def xml_eq(a, b):
             if not xml_eq(ae, be):
                 return False
 
-    if a.text is None and b.text is not None:
-        logger.error("a.text (None) != b.text (%s)", str(b.text))
-        return False
-    elif a.text is not None and b.text is None:
-        logger.error("a.text (%s) != b.text (None)", str(a.text))
-        return False
-    elif a.text:
-        atext = a.text.strip()
-        btext = b.text.strip()
-        if atext == btext:
-            return True
+    # Whitespace only text (e.g., from pretty printing) is the same as no text.
+    atext = a.text.strip() if a.text is not None else ""
+    btext = b.text.strip() if b.text is not None else ""
+    if atext != btext:
         logger.error("a.text (%s) != b.text (%s)", atext, btext)
         return False
     return True